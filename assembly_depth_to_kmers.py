@@ -6,6 +6,13 @@ import numpy as np
 import settings_configs
 import phylogeny_utilities.utilities as phy
 
+# the kmers C extension (ext/) does the actual k-mer work; it's optional so the
+#   depth-file conversion can still be run without it.
+try:
+    import kmers
+except ImportError:
+    kmers = None
+
 
 parser = argparse.ArgumentParser()
 
@@ -135,6 +142,53 @@ def samtools_depth_to_numpy_dict(depth_file_path: str, out_numpy_path=None, retu
     if return_dicts:
         return depth_nps_sorted, ctg_min_row, ctg_max_row
 
+def depth_weighted_kmers(assembly_file_path: str, coverage, k: int, scaled: int = 0, seed: int = 42) -> tuple:
+    '''
+    Takes an assembly and the per-contig coverage arrays for it (the output of
+    `samtools_depth_to_numpy_dict`) and gets the k-mers of every contig weighted by the mean
+    coverage over each k-mer's window. This all happens in one pass in the C extension
+    (`kmers.seqiter_depthiter_to_kmers_ull`), and gives an abundance-aware sketch of the
+    assembly without going back to the reads.
+
+    Contigs are matched to coverage arrays by the first word of their fasta header (which is
+    what samtools uses as the contig name). Contigs with no coverage array are skipped.
+
+    Args:
+        assembly_file_path (str):   path to the assembly fasta (e.g. MEGAHIT's final.contigs.fa)
+        coverage (str or dict):     path to the .npz file written by `samtools_depth_to_numpy_dict`,
+                                    or a dict-like object of {<contig_name>: <coverage_array>}.
+        k (int):                    k-mer length
+        scaled (int):               if 0, every canonical k-mer is returned. Otherwise only the
+                                    k-mers kept by FracMinHash at this scaled value (same hash as
+                                    adapted_sourmash.py) are, summed by hash.
+        seed (int):                 murmurhash seed (only used if scaled > 0)
+
+    Returns:
+        if scaled == 0:
+            w_array (np.ndarray):   uint64 canonical k-mers in ULL format, one row per window
+            weights (np.ndarray):   float64 mean coverage of each window
+        if scaled > 0:
+            hashes (np.ndarray):    uint64 hashes of the retained k-mers, in first-seen order
+            counts (np.ndarray):    uint64 number of times each hash occurs in the assembly
+            weights (np.ndarray):   float64 summed mean window coverage of each hash
+    '''
+    if kmers is None:
+        raise ImportError('depth_weighted_kmers needs the kmers C extension (see ext/setup2.py)')
+    if isinstance(coverage, str):
+        coverage = np.load(coverage)
+    fa = phy.read_from_fasta(assembly_file_path)
+    seqs = []; depths = []; n_missing = 0
+    for name, seq in fa.items():
+        ctg_name = name.split()[0]
+        if ctg_name not in coverage:
+            n_missing += 1
+            continue
+        seqs.append(seq)
+        depths.append(coverage[ctg_name])
+    if n_missing > 0:
+        print(f'{n_missing} contigs in {assembly_file_path} had no coverage array and were skipped.')
+    return kmers.seqiter_depthiter_to_kmers_ull(seqs, depths, k, scaled, seed)
+
 def get_assembly_and_depth_filepaths(bioproject: str, runid: str) -> tuple:
     '''
     Given a bioproject and runid, returns the paths to the depth file and the assembly file.
@@ -175,6 +229,15 @@ def parse_args():
     parser.add_argument('-a','--auxoutput', dest='auxoutput', type=str, 
                         help='Path to another .npz file that can have the auxiliary data written to it, namely the asserts '
                             ' matrix if it\'s needed for debugging.')
+    parser.add_argument('--assembly', dest='assembly', type=str, default=None,
+                        help='Path to the assembly fasta. If given (along with --sketch_output), the coverage arrays are '
+                             'also used to make a depth-weighted k-mer sketch of the assembly.')
+    parser.add_argument('--sketch_output', dest='sketch_output', type=str, default=None,
+                        help='Path to the .npz file that the depth-weighted sketch is written to (arrays \'hashes\', '
+                             '\'counts\' and \'weights\'; with --scaled 0 every k-mer window instead, arrays '
+                             '\'kmers\' and \'weights\').')
+    parser.add_argument('-k', '--ksize', dest='ksize', type=int, default=31, help='k-mer length for the sketch.')
+    parser.add_argument('--scaled', dest='scaled', type=int, default=1000, help='FracMinHash scaled value for the sketch (0 keeps every k-mer).')
     
     args = parser.parse_args()
     return args
@@ -184,5 +247,15 @@ if __name__=='__main__':
     in_depth_f = cmd_args.input
     out_depth_npz = cmd_args.output
     aux_out_npz = cmd_args.auxoutput
+    if cmd_args.assembly is not None and cmd_args.sketch_output is not None and out_depth_npz is None:
+        parser.error('--assembly needs -o/--output (the sketch is made from the coverage arrays written there)')
     samtools_depth_to_numpy_dict(in_depth_f, out_depth_npz)
+    if cmd_args.assembly is not None and cmd_args.sketch_output is not None:
+        npz_path = out_depth_npz if out_depth_npz.endswith('.npz') else out_depth_npz + '.npz'
+        if cmd_args.scaled > 0:
+            hashes, counts, weights = depth_weighted_kmers(cmd_args.assembly, npz_path, cmd_args.ksize, cmd_args.scaled)
+            np.savez(cmd_args.sketch_output, hashes=hashes, counts=counts, weights=weights)
+        else:
+            w_array, weights = depth_weighted_kmers(cmd_args.assembly, npz_path, cmd_args.ksize, 0)
+            np.savez(cmd_args.sketch_output, kmers=w_array, weights=weights)
 
@@ -25,6 +25,11 @@ static PyObject *kmers_seqToKmer(PyObject *self, PyObject *args);
 static PyObject *kmers_seq_to_kmers_ull_array(PyObject *self, PyObject *args);
 static PyObject *kmers_seqiter_to_kmers_ull_array(PyObject *self, PyObject *args);
 static PyObject *kmers_ull_array_batch_set_min_RC(PyObject *self, PyObject *args);
+static PyObject *kmers_fracminhash_count(PyObject *self, PyObject *args);
+static PyObject *kmers_fracminhash_count_batch(PyObject *self, PyObject *args);
+static PyObject *fmh_counter_to_python(fmh_counter *counter);
+static int get_sequence_chars(PyObject *item, const char **seq, Py_ssize_t *l_seq);
+static PyObject *kmers_seqiter_depthiter_to_kmers_ull(PyObject *self, PyObject *args);
 
 /* Docstrings */
 static char version_str[] = "Version 0.1 (beta)";
@@ -52,6 +57,26 @@ static char ull_arr_batch_min_RC_docstring[] =
         "itself and its reverse-complement. Since we are doing a lot of counting unique k-mers this cuts down\n"
         "on the total kmer counts and is a more parsimonious representation.                                 \n"
         "";
+static char seqiter_depthiter_docstring[] =
+        "Function: seqiter_depthiter_to_kmers_ull(seq_iter, depth_iter, k, scaled=0, seed=42)                 \n"
+        "Takes contig sequences and their per-base coverage arrays (same order, one value per base) and      \n"
+        "weights each k-mer by the mean coverage over its window. With scaled=0 returns (w_array, weights)   \n"
+        "with every canonical k-mer in ULL format and its window coverage. With scaled>0 does FracMinHash    \n"
+        "counting instead and returns (hashes, counts, weights) with the coverage summed per hash.           \n"
+        "";
+static char fracminhash_count_batch_docstring[] =
+        "Function: fracminhash_count_batch(seqs, k, scaled, seed, n_threads=0, return_kmers=False)           \n"
+        "Same as fracminhash_count, but takes a list of sequences and splits them into consecutive blocks     \n"
+        "counted by n_threads native threads (0 = one per core), without the GIL. The block counts are merged \n"
+        "in order, so the result (including the order) is the same as fracminhash_count on the same list.    \n"
+        "";
+static char fracminhash_count_docstring[] =
+        "Function: fracminhash_count(seq_iter, k, scaled, seed, return_kmers=False)                          \n"
+        "Runs the FracMinHash counting from adapted_sourmash.py over an iterator of sequences (str or bytes):\n"
+        "canonical k-mer, murmurhash3 (x64, first 64 bits) with the given seed, keep if the hash is below    \n"
+        "2**64/scaled, count. Returns (hashes, counts) as parallel numpy uint64 arrays in the order each hash \n"
+        "was first seen. With return_kmers=True a third element lists the canonical k-mer for each hash.     \n"
+        "";
 
 
 /* Module specification */
@@ -61,6 +86,9 @@ static PyMethodDef module_methods[] = {
         {"seq_to_kmer_ull_array", kmers_seq_to_kmers_ull_array, METH_VARARGS, seq_to_kmers_ull_array_docstring},
         {"seqiter_to_kmer_ull_array", kmers_seqiter_to_kmers_ull_array, METH_VARARGS, seqiter_to_kmers_ull_array_docstring},
         {"kmer_ull_array_batch_set_min_RC", kmers_ull_array_batch_set_min_RC, METH_VARARGS, ull_arr_batch_min_RC_docstring},
+        {"fracminhash_count", kmers_fracminhash_count, METH_VARARGS, fracminhash_count_docstring},
+        {"fracminhash_count_batch", kmers_fracminhash_count_batch, METH_VARARGS, fracminhash_count_batch_docstring},
+        {"seqiter_depthiter_to_kmers_ull", kmers_seqiter_depthiter_to_kmers_ull, METH_VARARGS, seqiter_depthiter_docstring},
         // Testing functions w/ no docstring for now...
         {"test_inplace_numpy_replace", kmers_test_InplaceNumpyMove, METH_VARARGS, seq_to_kmer_binary_docstring},
         {"test_ull_binary_rc", kmers_test_binaryRC, METH_VARARGS, NULL},
@@ -301,9 +329,13 @@ static PyObject *kmers_seq_to_kmers_ull_array(PyObject *self, PyObject *args)
             return NULL;
         }
         w_ptr = (unsigned long long *)PyArray_DATA(w_array);
+        Py_BEGIN_ALLOW_THREADS
         dna_sequence_to_ull_array_list_provided(seq, l_seq, k, w_ptr);
+        Py_END_ALLOW_THREADS
     } else {
+        Py_BEGIN_ALLOW_THREADS
         w_ptr = dna_sequence_to_kmer_ull_array_list(seq, l_seq, k);
+        Py_END_ALLOW_THREADS
         // Convert w_ptr to a Numpy array:
         npy_intp outdims[2];
         outdims[0] = l_seq - k + 1;
@@ -365,7 +397,10 @@ static PyObject *kmers_seqiter_to_kmers_ull_array(PyObject *self, PyObject *args
     while ((str_item = PyIter_Next(str_iter))) {
         seq = PyUnicode_AsUTF8AndSize(str_item, &str_size);
         l_seq = strlen(seq);
+        // str_item keeps seq alive while the GIL is released
+        Py_BEGIN_ALLOW_THREADS
         dna_sequence_to_ull_array_list_provided(seq, str_size, k, &w_ptr[w_pos]);
+        Py_END_ALLOW_THREADS
         w_pos = w_pos + (l_seq - k + 1)*stride;
         tot_w_len = tot_w_len + l_seq - k + 1;
         if (DEBUG_ON) printf("i=%d, l_seq=%lu, str_size=%lu, w_pos=%lu, tot_w_len=%lu\n", i, l_seq, str_size, w_pos, tot_w_len);
@@ -377,7 +412,9 @@ static PyObject *kmers_seqiter_to_kmers_ull_array(PyObject *self, PyObject *args
     if (use_min_RC) {
         printf("running final min-RC swap on results.\n");
         unsigned long n_swaps;
+        Py_BEGIN_ALLOW_THREADS
         n_swaps = ull_array_list_set_to_min_RC(w_ptr, k, tot_w_len);
+        Py_END_ALLOW_THREADS
     }
 
     /* Build the output tuple */
@@ -457,7 +494,9 @@ static PyObject *kmers_ull_array_batch_set_min_RC(PyObject *self, PyObject *args
         w_ptr = (unsigned long long *)PyArray_DATA(w_array);
     }
 
+    Py_BEGIN_ALLOW_THREADS
     num_swaps = ull_array_list_set_to_min_RC(w_ptr, k, array_size);
+    Py_END_ALLOW_THREADS
 
     if (!w) {Py_XDECREF(w); return NULL;}
 
@@ -467,6 +506,321 @@ static PyObject *kmers_ull_array_batch_set_min_RC(PyObject *self, PyObject *args
     return ret;
 }
 
+static PyObject *kmers_fracminhash_count(PyObject *self, PyObject *args) {
+    // MODULE FUNCTION: fracminhash_count(seq_iter, k, scaled, seed, OPTIONAL return_kmers = False)
+    // -------------------------------------------------------------------------
+    // Takes an iterator of sequences (str or bytes) and runs the whole FracMinHash counting step from
+    //  adapted_sourmash.py in C: canonical k-mer, murmurhash3, keep if hash < 2**64/scaled, count. The
+    //  counts go in an open-addressing table. Returns a tuple (hashes, counts) of parallel numpy uint64
+    //  arrays in the order each hash was first seen. If 'return_kmers' is True the tuple also has a
+    //  third element, a list with the canonical k-mer string for each hash.
+    PyObject *str_iter_obj, *str_iter, *str_item;
+    int k, return_kmers, status;
+    unsigned long long scaled, max_hash;
+    unsigned int seed;
+    const char *seq;
+    Py_ssize_t l_seq;
+    return_kmers = 0;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "OiKI|p", &str_iter_obj, &k, &scaled, &seed, &return_kmers))
+        return NULL;
+    if (k < 1) {
+        PyErr_SetString(PyExc_ValueError, "k must be at least 1");
+        return NULL;
+    }
+
+    str_iter = PyObject_GetIter(str_iter_obj);
+    if (str_iter == NULL) return NULL;
+
+    fmh_counter *counter = fmh_counter_new(k, return_kmers, 0);
+    if (counter == NULL) {
+        Py_DECREF(str_iter);
+        return PyErr_NoMemory();
+    }
+    max_hash = fracminhash_max_hash(scaled);
+
+    status = 0;
+    while ((str_item = PyIter_Next(str_iter))) {
+        if (get_sequence_chars(str_item, &seq, &l_seq) != 0) {
+            Py_DECREF(str_item);
+            status = -2;
+            break;
+        }
+        // str_item keeps seq alive while the GIL is released
+        Py_BEGIN_ALLOW_THREADS
+        status = fmh_count_sequence(counter, seq, (size_t)l_seq, max_hash, seed);
+        Py_END_ALLOW_THREADS
+        Py_DECREF(str_item);
+        if (status != 0) break;
+    }
+    Py_DECREF(str_iter);
+    if (status == 0 && PyErr_Occurred()) status = -2;  // the iterator itself raised
+    if (status != 0) {
+        fmh_counter_free(counter);
+        if (status == 1) PyErr_SetString(PyExc_ValueError, "sequence contains characters other than ACGTN");
+        if (status == -1) PyErr_NoMemory();
+        return NULL;
+    }
+
+    PyObject *ret = fmh_counter_to_python(counter);
+    fmh_counter_free(counter);
+    return ret;
+}
+
+static PyObject *kmers_fracminhash_count_batch(PyObject *self, PyObject *args) {
+    // MODULE FUNCTION: fracminhash_count_batch(seqs, k, scaled, seed, OPTIONAL n_threads = 0, return_kmers = False)
+    // -------------------------------------------------------------------------
+    // Same as fracminhash_count, but the sequences (a list, or anything that can be made into one) are
+    //  counted by 'n_threads' native threads (0 = one per core) with the GIL released. The list is split
+    //  into consecutive blocks with about the same number of bases, each thread counts one block into its
+    //  own table, and the tables are merged in block order, so the output is identical to
+    //  fracminhash_count(seqs, k, scaled, seed, return_kmers).
+    PyObject *seq_obj, *seq_list;
+    PyObject *ret = NULL;
+    int k, n_threads, return_kmers, status;
+    unsigned long long scaled, max_hash;
+    unsigned int seed;
+    Py_ssize_t n_seqs, i, l_seq;
+    const char *seq;
+    n_threads = 0; return_kmers = 0;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "OiKI|ip", &seq_obj, &k, &scaled, &seed, &n_threads, &return_kmers))
+        return NULL;
+    if (k < 1) {
+        PyErr_SetString(PyExc_ValueError, "k must be at least 1");
+        return NULL;
+    }
+
+    // The list holds a reference to every sequence, so the character buffers stay valid while the
+    //  threads run without the GIL.
+    seq_list = PySequence_Fast(seq_obj, "seqs must be iterable");
+    if (seq_list == NULL) return NULL;
+    n_seqs = PySequence_Fast_GET_SIZE(seq_list);
+    const char **seqs = (const char **) malloc((n_seqs > 0 ? n_seqs : 1) * sizeof(const char *));
+    size_t *lens = (size_t *) malloc((n_seqs > 0 ? n_seqs : 1) * sizeof(size_t));
+    if (seqs == NULL || lens == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i=0; i<n_seqs; i++) {
+        if (get_sequence_chars(PySequence_Fast_GET_ITEM(seq_list, i), &seq, &l_seq) != 0) goto done;
+        seqs[i] = seq;
+        lens[i] = (size_t)l_seq;
+    }
+
+    fmh_counter *counter = fmh_counter_new(k, return_kmers, 0);
+    if (counter == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    max_hash = fracminhash_max_hash(scaled);
+    Py_BEGIN_ALLOW_THREADS
+    status = fmh_count_sequences_threaded(counter, seqs, lens, (size_t)n_seqs, max_hash, seed, n_threads);
+    Py_END_ALLOW_THREADS
+    if (status == 1) PyErr_SetString(PyExc_ValueError, "sequence contains characters other than ACGTN");
+    if (status == -1) PyErr_NoMemory();
+    if (status == 0) ret = fmh_counter_to_python(counter);
+    fmh_counter_free(counter);
+
+done:
+    free(seqs);
+    free(lens);
+    Py_DECREF(seq_list);
+    return ret;
+}
+
+static PyObject *fmh_counter_to_python(fmh_counter *counter) {
+    // Helper: converts a finished counter to the tuple returned to python: (hashes, counts), followed by
+    //  the weights array if the counter kept weights and the list of k-mer strings if it kept k-mers.
+    npy_intp outdims[1];
+    size_t i;
+    Py_ssize_t n_out, pos;
+    outdims[0] = (npy_intp)counter->n_entries;
+    n_out = 2 + (counter->keep_weights ? 1 : 0) + (counter->keep_kmers ? 1 : 0);
+    PyObject *ret = PyTuple_New(n_out);
+    if (ret == NULL) return NULL;
+
+    PyObject *hashes = PyArray_SimpleNew(1, outdims, NPY_UINT64);
+    PyObject *counts = PyArray_SimpleNew(1, outdims, NPY_UINT64);
+    if (hashes == NULL || counts == NULL) {
+        Py_XDECREF(hashes); Py_XDECREF(counts); Py_DECREF(ret);
+        return NULL;
+    }
+    if (counter->n_entries > 0) {
+        memcpy(PyArray_DATA((PyArrayObject *)hashes), counter->hashes, counter->n_entries * sizeof(unsigned long long));
+        memcpy(PyArray_DATA((PyArrayObject *)counts), counter->counts, counter->n_entries * sizeof(unsigned long long));
+    }
+    PyTuple_SET_ITEM(ret, 0, hashes);
+    PyTuple_SET_ITEM(ret, 1, counts);
+    pos = 2;
+
+    if (counter->keep_weights) {
+        PyObject *weights = PyArray_SimpleNew(1, outdims, NPY_DOUBLE);
+        if (weights == NULL) {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        if (counter->n_entries > 0)
+            memcpy(PyArray_DATA((PyArrayObject *)weights), counter->weights, counter->n_entries * sizeof(double));
+        PyTuple_SET_ITEM(ret, pos, weights);
+        pos++;
+    }
+
+    if (counter->keep_kmers) {
+        PyObject *kmer_list = PyList_New((Py_ssize_t)counter->n_entries);
+        if (kmer_list == NULL) {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(ret, pos, kmer_list);
+        for (i=0; i<counter->n_entries; i++) {
+            PyObject *kmer_str = PyUnicode_FromStringAndSize(&counter->kmers[i * counter->k], counter->k);
+            if (kmer_str == NULL) {
+                Py_DECREF(ret);
+                return NULL;
+            }
+            PyList_SET_ITEM(kmer_list, (Py_ssize_t)i, kmer_str);
+        }
+    }
+    return ret;
+}
+
+static int get_sequence_chars(PyObject *item, const char **seq, Py_ssize_t *l_seq) {
+    // Helper: gets the characters out of a str or bytes sequence. Returns -1 (with an exception set) if
+    //  it is neither.
+    if (PyUnicode_Check(item)) {
+        *seq = PyUnicode_AsUTF8AndSize(item, l_seq);
+        return (*seq == NULL) ? -1 : 0;
+    }
+    if (PyBytes_Check(item)) {
+        *seq = PyBytes_AS_STRING(item);
+        *l_seq = PyBytes_GET_SIZE(item);
+        return 0;
+    }
+    PyErr_SetString(PyExc_TypeError, "sequences must be str or bytes");
+    return -1;
+}
+
 static PyObject *kmers_seqiter_depthiter_to_kmers_ull(PyObject *self, PyObject *args) {
+    // MODULE FUNCTION: seqiter_depthiter_to_kmers_ull(seq_iter, depth_iter, k, OPTIONAL scaled = 0, seed = 42)
+    // -------------------------------------------------------------------------
+    // Takes an iterator of contig sequences and a matching iterator of per-base coverage arrays (e.g. the
+    //  values from samtools_depth_to_numpy_dict in assembly_depth_to_kmers.py, same order as the sequences,
+    //  one value per base) and weights every k-mer by the mean coverage over its window.
+    //   - scaled = 0: returns (w_array, weights), where w_array holds every canonical (min-RC) k-mer in ULL
+    //     format, shape (n_kmers, stride), same as seqiter_to_kmer_ull_array, and weights is a float64
+    //     array with the mean window coverage of each row.
+    //   - scaled > 0: does the FracMinHash counting of fracminhash_count instead and returns
+    //     (hashes, counts, weights), where weights is the summed mean window coverage of each hash.
+    PyObject *seq_iter_obj, *depth_iter_obj, *seq_list, *depth_list;
+    PyObject *ret = NULL;
+    int k, stride, status;
+    unsigned long long scaled;
+    unsigned int seed;
+    Py_ssize_t n_seqs, i, l_seq;
+    size_t tot_w_len, w_pos;
+    const char *seq;
+    scaled = 0; seed = 42;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "OOi|KI", &seq_iter_obj, &depth_iter_obj, &k, &scaled, &seed))
+        return NULL;
+    if (k < 1) {
+        PyErr_SetString(PyExc_ValueError, "k must be at least 1");
+        return NULL;
+    }
+
+    // Both iterators are read into lists first, so the output can be sized in advance:
+    seq_list = PySequence_Fast(seq_iter_obj, "seq_iter must be iterable");
+    if (seq_list == NULL) return NULL;
+    depth_list = PySequence_Fast(depth_iter_obj, "depth_iter must be iterable");
+    if (depth_list == NULL) {
+        Py_DECREF(seq_list);
+        return NULL;
+    }
+    n_seqs = PySequence_Fast_GET_SIZE(seq_list);
+    if (PySequence_Fast_GET_SIZE(depth_list) != n_seqs) {
+        PyErr_SetString(PyExc_ValueError, "seq_iter and depth_iter must have the same number of items");
+        goto done;
+    }
 
+    // Get every coverage array as a contiguous float64 array and check it matches its sequence:
+    PyArrayObject **depth_arrays = (PyArrayObject **) calloc(n_seqs > 0 ? n_seqs : 1, sizeof(PyArrayObject *));
+    if (depth_arrays == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    tot_w_len = 0;
+    for (i=0; i<n_seqs; i++) {
+        if (get_sequence_chars(PySequence_Fast_GET_ITEM(seq_list, i), &seq, &l_seq) != 0) goto done_arrays;
+        depth_arrays[i] = (PyArrayObject *) PyArray_FROM_OTF(PySequence_Fast_GET_ITEM(depth_list, i), NPY_DOUBLE,
+                                                             NPY_ARRAY_IN_ARRAY);
+        if (depth_arrays[i] == NULL) goto done_arrays;
+        if (PyArray_SIZE(depth_arrays[i]) != l_seq) {
+            PyErr_Format(PyExc_ValueError, "coverage array %zd has %zd values but its sequence has length %zd",
+                         i, (Py_ssize_t)PyArray_SIZE(depth_arrays[i]), l_seq);
+            goto done_arrays;
+        }
+        if (l_seq >= k) tot_w_len += (size_t)(l_seq - k + 1);
+    }
+
+    if (scaled > 0) {
+        // FracMinHash counting, weighted:
+        fmh_counter *counter = fmh_counter_new(k, 0, 1);
+        if (counter == NULL) {
+            PyErr_NoMemory();
+            goto done_arrays;
+        }
+        unsigned long long max_hash = fracminhash_max_hash(scaled);
+        status = 0;
+        for (i=0; i<n_seqs && status==0; i++) {
+            get_sequence_chars(PySequence_Fast_GET_ITEM(seq_list, i), &seq, &l_seq);
+            Py_BEGIN_ALLOW_THREADS
+            status = fmh_count_sequence_with_depth(counter, seq, (size_t)l_seq,
+                                                   (const double *)PyArray_DATA(depth_arrays[i]), max_hash, seed);
+            Py_END_ALLOW_THREADS
+        }
+        if (status == 1) PyErr_SetString(PyExc_ValueError, "sequence contains characters other than ACGTN");
+        if (status == -1) PyErr_NoMemory();
+        if (status == 0) ret = fmh_counter_to_python(counter);
+        fmh_counter_free(counter);
+    } else {
+        // Every canonical k-mer in ULL format, plus its window's mean coverage:
+        stride = k_to_ull_stride(k);
+        npy_intp wdims[2], cdims[1];
+        wdims[0] = (npy_intp)tot_w_len; wdims[1] = stride;
+        cdims[0] = (npy_intp)tot_w_len;
+        PyObject *w = PyArray_ZEROS(2, wdims, NPY_UINT64, 0);
+        PyObject *weights = PyArray_SimpleNew(1, cdims, NPY_DOUBLE);
+        if (w == NULL || weights == NULL) {
+            Py_XDECREF(w); Py_XDECREF(weights);
+            goto done_arrays;
+        }
+        unsigned long long *w_ptr = (unsigned long long *) PyArray_DATA((PyArrayObject *)w);
+        double *weights_ptr = (double *) PyArray_DATA((PyArrayObject *)weights);
+        w_pos = 0;
+        for (i=0; i<n_seqs; i++) {
+            get_sequence_chars(PySequence_Fast_GET_ITEM(seq_list, i), &seq, &l_seq);
+            if (l_seq < k) continue;
+            Py_BEGIN_ALLOW_THREADS
+            dna_sequence_to_ull_array_list_provided((char *)seq, (size_t)l_seq, k, &w_ptr[w_pos*stride]);
+            window_mean_depth((const double *)PyArray_DATA(depth_arrays[i]), (size_t)l_seq, k, &weights_ptr[w_pos]);
+            Py_END_ALLOW_THREADS
+            w_pos += (size_t)(l_seq - k + 1);
+        }
+        Py_BEGIN_ALLOW_THREADS
+        ull_array_list_set_to_min_RC(w_ptr, k, tot_w_len);
+        Py_END_ALLOW_THREADS
+        ret = Py_BuildValue("NN", w, weights);
+    }
+
+done_arrays:
+    for (i=0; i<n_seqs; i++) Py_XDECREF(depth_arrays[i]);
+    free(depth_arrays);
+done:
+    Py_DECREF(seq_list);
+    Py_DECREF(depth_list);
+    return ret;
 }
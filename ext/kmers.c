@@ -6,7 +6,13 @@
 #include<string.h>
 #include<ctype.h>
 #include<math.h>
-#include<string.h>
+#include<limits.h>
+#ifdef _WIN32
+#include<windows.h>
+#else
+#include<pthread.h>
+#include<unistd.h>
+#endif
 #include "kmers.h"
 #include "myutils.h"
 
@@ -344,6 +350,483 @@ unsigned long ull_array_list_set_to_min_RC(unsigned long long *w, int k, size_t
 }
 
 
+// **********************************************************************
+// *            FRACMINHASH FUNCTIONS:
+// **********************************************************************
+
+#define FMH_MIN_SLOTS 1024
+
+static unsigned long long rotl64(unsigned long long x, int r) {
+    return (x << r) | (x >> (64 - r));
+}
+
+static unsigned long long fmix64(unsigned long long k) {
+    k ^= k >> 33;
+    k *= 0xff51afd7ed558ccdULL;
+    k ^= k >> 33;
+    k *= 0xc4ceb9fe1a85ec53ULL;
+    k ^= k >> 33;
+    return k;
+}
+
+/*
+ * Function: murmurhash3_x64_64
+ * ----------------------------
+ * MurmurHash3_x64_128 of the 'len' bytes at 'key', returning only the first 64 bits. This is the
+ * same value as mmh3.hash64(key, seed)[0] in python (as unsigned), which is what adapted_sourmash.py
+ * uses to hash the canonical k-mer strings.
+ * */
+unsigned long long murmurhash3_x64_64(const char *key, int len, unsigned int seed) {
+    const unsigned char *data = (const unsigned char *)key;
+    int n_blocks = len / 16;
+    int i;
+    unsigned long long h1 = seed, h2 = seed, k1, k2;
+    const unsigned long long c1 = 0x87c37b91114253d5ULL;
+    const unsigned long long c2 = 0x4cf5ad432745937fULL;
+
+    for (i=0; i<n_blocks; i++) {
+        memcpy(&k1, &data[i*16], 8);
+        memcpy(&k2, &data[i*16 + 8], 8);
+
+        k1 *= c1; k1 = rotl64(k1, 31); k1 *= c2; h1 ^= k1;
+        h1 = rotl64(h1, 27); h1 += h2; h1 = h1*5 + 0x52dce729;
+
+        k2 *= c2; k2 = rotl64(k2, 33); k2 *= c1; h2 ^= k2;
+        h2 = rotl64(h2, 31); h2 += h1; h2 = h2*5 + 0x38495ab5;
+    }
+
+    // tail (the 0-15 bytes that don't make up a full block):
+    const unsigned char *tail = &data[n_blocks*16];
+    k1 = 0; k2 = 0;
+    switch (len & 15) {
+        case 15: k2 ^= ((unsigned long long)tail[14]) << 48;
+        case 14: k2 ^= ((unsigned long long)tail[13]) << 40;
+        case 13: k2 ^= ((unsigned long long)tail[12]) << 32;
+        case 12: k2 ^= ((unsigned long long)tail[11]) << 24;
+        case 11: k2 ^= ((unsigned long long)tail[10]) << 16;
+        case 10: k2 ^= ((unsigned long long)tail[9]) << 8;
+        case  9: k2 ^= ((unsigned long long)tail[8]);
+                 k2 *= c2; k2 = rotl64(k2, 33); k2 *= c1; h2 ^= k2;
+        case  8: k1 ^= ((unsigned long long)tail[7]) << 56;
+        case  7: k1 ^= ((unsigned long long)tail[6]) << 48;
+        case  6: k1 ^= ((unsigned long long)tail[5]) << 40;
+        case  5: k1 ^= ((unsigned long long)tail[4]) << 32;
+        case  4: k1 ^= ((unsigned long long)tail[3]) << 24;
+        case  3: k1 ^= ((unsigned long long)tail[2]) << 16;
+        case  2: k1 ^= ((unsigned long long)tail[1]) << 8;
+        case  1: k1 ^= ((unsigned long long)tail[0]);
+                 k1 *= c1; k1 = rotl64(k1, 31); k1 *= c2; h1 ^= k1;
+    }
+
+    h1 ^= (unsigned long long)len; h2 ^= (unsigned long long)len;
+    h1 += h2; h2 += h1;
+    h1 = fmix64(h1); h2 = fmix64(h2);
+    h1 += h2;
+    return h1;
+}
+
+/*
+ * Function: fracminhash_max_hash
+ * ------------------------------
+ * adapted_sourmash.py keeps a k-mer when hash < 2**64/scaled (as a double). Since the hashes are
+ * integers that is the same as hash <= ceil(2**64/scaled) - 1, which is what this returns. For
+ * scaled <= 1 every hash is kept.
+ * */
+unsigned long long fracminhash_max_hash(unsigned long long scaled) {
+    if (scaled <= 1) return ULLONG_MAX;
+    return (unsigned long long)ceil(18446744073709551616.0 / (double)scaled) - 1;
+}
+
+/*
+ * Function: dna_complement_upper
+ * ------------------------------
+ * Complement of a nucleotide the way screed.rc does it: the input is upper-cased first and 'N' maps
+ * to itself. Returns 0 for anything else (screed raises an error on those).
+ * */
+char dna_complement_upper(char nuc) {
+    switch (UPPERCASE(nuc)) {
+        case 'A': return 'T';
+        case 'C': return 'G';
+        case 'G': return 'C';
+        case 'T': return 'A';
+        case 'N': return 'N';
+        default: return 0;
+    }
+}
+
+/*
+ * Function: fmh_counter_new / fmh_counter_free
+ * --------------------------------------------
+ * The counter is an open-addressing (linear probing) hash table keyed on the k-mer hash. The slots only
+ * hold an index into the entry arrays, and the entries are stored in the order they were first seen, so
+ * the results come out in the same order as the python dict in adapted_sourmash.py. If 'keep_kmers' is
+ * set, the canonical k-mer string of every entry is also kept (k bytes per entry), and if 'keep_weights'
+ * is set, each entry also gets a (double) sum of the weights it was added with.
+ * */
+fmh_counter *fmh_counter_new(int k, int keep_kmers, int keep_weights) {
+    fmh_counter *c = (fmh_counter *) calloc(1, sizeof(fmh_counter));
+    if (c == NULL) return NULL;
+    c->k = k;
+    c->keep_kmers = keep_kmers;
+    c->keep_weights = keep_weights;
+    c->n_slots = FMH_MIN_SLOTS;
+    c->entries_cap = FMH_MIN_SLOTS / 2;
+    c->slots = (long long *) malloc(c->n_slots * sizeof(long long));
+    c->hashes = (unsigned long long *) malloc(c->entries_cap * sizeof(unsigned long long));
+    c->counts = (unsigned long long *) malloc(c->entries_cap * sizeof(unsigned long long));
+    c->kmers = keep_kmers ? (char *) malloc(c->entries_cap * k) : NULL;
+    c->weights = keep_weights ? (double *) malloc(c->entries_cap * sizeof(double)) : NULL;
+    if (c->slots == NULL || c->hashes == NULL || c->counts == NULL || (keep_kmers && c->kmers == NULL)
+            || (keep_weights && c->weights == NULL)) {
+        fmh_counter_free(c);
+        return NULL;
+    }
+    memset(c->slots, 0xff, c->n_slots * sizeof(long long));  // all -1 = empty
+    return c;
+}
+
+void fmh_counter_free(fmh_counter *c) {
+    if (c == NULL) return;
+    free(c->slots);
+    free(c->hashes);
+    free(c->counts);
+    free(c->kmers);
+    free(c->weights);
+    free(c);
+}
+
+/*
+ * Function: fmh_counter_grow
+ * --------------------------
+ * Doubles the number of slots (and entry capacity) and re-inserts the existing entries. Keeps the table
+ * at most half full. Returns 0 on success and -1 if memory could not be allocated.
+ * */
+static int fmh_counter_grow(fmh_counter *c) {
+    size_t new_n_slots = c->n_slots * 2, mask = new_n_slots - 1, i, pos;
+    size_t new_cap = new_n_slots / 2;
+    long long *new_slots = (long long *) malloc(new_n_slots * sizeof(long long));
+    unsigned long long *new_hashes = (unsigned long long *) realloc(c->hashes, new_cap * sizeof(unsigned long long));
+    if (new_hashes != NULL) c->hashes = new_hashes;
+    unsigned long long *new_counts = (unsigned long long *) realloc(c->counts, new_cap * sizeof(unsigned long long));
+    if (new_counts != NULL) c->counts = new_counts;
+    char *new_kmers = c->keep_kmers ? (char *) realloc(c->kmers, new_cap * c->k) : NULL;
+    if (new_kmers != NULL) c->kmers = new_kmers;
+    double *new_weights = c->keep_weights ? (double *) realloc(c->weights, new_cap * sizeof(double)) : NULL;
+    if (new_weights != NULL) c->weights = new_weights;
+    if (new_slots == NULL || new_hashes == NULL || new_counts == NULL || (c->keep_kmers && new_kmers == NULL)
+            || (c->keep_weights && new_weights == NULL)) {
+        free(new_slots);
+        return -1;
+    }
+    memset(new_slots, 0xff, new_n_slots * sizeof(long long));
+    for (i=0; i<c->n_entries; i++) {
+        pos = (size_t)(c->hashes[i] & mask);
+        while (new_slots[pos] >= 0) pos = (pos + 1) & mask;
+        new_slots[pos] = (long long)i;
+    }
+    free(c->slots);
+    c->slots = new_slots;
+    c->n_slots = new_n_slots;
+    c->entries_cap = new_cap;
+    return 0;
+}
+
+/*
+ * Function: fmh_counter_add
+ * -------------------------
+ * Adds 1 to the count for 'hash' (and 'weight' to its weight, if the counter keeps weights), creating
+ * the entry (and storing 'kmer', if the counter keeps k-mers) the first time it is seen. Returns 0 on
+ * success, -1 if memory could not be allocated.
+ * */
+int fmh_counter_add(fmh_counter *c, unsigned long long hash, const char *kmer, double weight) {
+    return fmh_counter_add_count(c, hash, kmer, 1, weight);
+}
+
+/*
+ * Function: fmh_counter_add_count
+ * -------------------------------
+ * Same as fmh_counter_add, but adds 'count' instead of 1 (used when merging counters).
+ * */
+int fmh_counter_add_count(fmh_counter *c, unsigned long long hash, const char *kmer, unsigned long long count,
+                          double weight) {
+    size_t mask = c->n_slots - 1;
+    // the low bits of the hash are fine as a slot index since it's already well-mixed.
+    size_t pos = (size_t)(hash & mask);
+    long long e;
+    while ((e = c->slots[pos]) >= 0) {
+        if (c->hashes[e] == hash) {
+            c->counts[e] += count;
+            if (c->keep_weights) c->weights[e] += weight;
+            return 0;
+        }
+        pos = (pos + 1) & mask;
+    }
+    if (c->n_entries >= c->entries_cap) {
+        if (fmh_counter_grow(c) != 0) return -1;
+        return fmh_counter_add_count(c, hash, kmer, count, weight);
+    }
+    e = (long long)c->n_entries;
+    c->slots[pos] = e;
+    c->hashes[e] = hash;
+    c->counts[e] = count;
+    if (c->keep_weights) c->weights[e] = weight;
+    if (c->keep_kmers) memcpy(&c->kmers[e * c->k], kmer, c->k);
+    c->n_entries++;
+    return 0;
+}
+
+/*
+ * Function: fmh_counter_merge
+ * ---------------------------
+ * Adds every entry of 'src' to 'dst', in the order they were first seen in 'src'. So merging the
+ * counters of consecutive blocks of sequences, in block order, gives exactly the counter (and entry
+ * order) of counting all the sequences in one go. Both counters must have the same k and 'dst' can
+ * only keep k-mers/weights if 'src' does. Returns 0 on success, -1 if memory could not be allocated.
+ * */
+int fmh_counter_merge(fmh_counter *dst, const fmh_counter *src) {
+    size_t i;
+    for (i=0; i<src->n_entries; i++) {
+        if (fmh_counter_add_count(dst, src->hashes[i], src->keep_kmers ? &src->kmers[i * src->k] : NULL,
+                                  src->counts[i], src->keep_weights ? src->weights[i] : 0.0) != 0)
+            return -1;
+    }
+    return 0;
+}
+
+/*
+ * Function: fmh_count_sequence
+ * ----------------------------
+ * Goes through every k-mer of 'seq', picks the canonical one exactly the way hash_kmer() in
+ * adapted_sourmash.py does (compare the k-mer as-is to its upper-cased reverse complement, take
+ * the RC on ties), hashes it and adds it to the counter if hash <= max_hash.
+ *
+ * Returns 0 on success, 1 if the sequence contains a character other than ACGTN (upper or lower
+ * case), and -1 if memory could not be allocated.
+ * */
+int fmh_count_sequence(fmh_counter *c, const char *seq, size_t seqlen, unsigned long long max_hash,
+                       unsigned int seed) {
+    return fmh_count_sequence_with_depth(c, seq, seqlen, NULL, max_hash, seed);
+}
+
+/*
+ * Function: fmh_count_sequence_with_depth
+ * ---------------------------------------
+ * Same as fmh_count_sequence, but 'depth' (if not NULL) is the per-base coverage of 'seq' (seqlen
+ * values) and each retained k-mer is added with a weight equal to the mean coverage over its window.
+ * The window sums are kept as a running sum so this is still one pass over the sequence.
+ * */
+int fmh_count_sequence_with_depth(fmh_counter *c, const char *seq, size_t seqlen, const double *depth,
+                                  unsigned long long max_hash, unsigned int seed) {
+    int k = c->k, j, cmp;
+    size_t i, n_kmers;
+    unsigned long long h;
+    const char *canon;
+    char rc_char;
+    char *rc_buf;
+    char comp[256];
+    double window_sum = 0.0;
+
+    if (seqlen < (size_t)k) return 0;
+    // lookup table so the inner loops don't have to go through the switch:
+    for (j=0; j<256; j++) comp[j] = dna_complement_upper((char)j);
+    for (i=0; i<seqlen; i++) {
+        if (comp[(unsigned char)seq[i]] == 0) return 1;
+    }
+    rc_buf = (char *) malloc(k);
+    if (rc_buf == NULL) return -1;
+    if (depth != NULL) {
+        for (j=0; j<k-1; j++) window_sum += depth[j];
+    }
+
+    n_kmers = seqlen - k + 1;
+    for (i=0; i<n_kmers; i++) {
+        if (depth != NULL) {
+            window_sum += depth[i + k - 1];
+            if (i > 0) window_sum -= depth[i - 1];
+        }
+        // compare the forward k-mer to the RC one character at a time (almost always decided on the
+        //   first one) without building the RC unless we need it:
+        cmp = 0;
+        for (j=0; j<k; j++) {
+            rc_char = comp[(unsigned char)seq[i + k - 1 - j]];
+            if (seq[i + j] != rc_char) {
+                cmp = ((unsigned char)seq[i + j] < (unsigned char)rc_char) ? -1 : 1;
+                break;
+            }
+        }
+        if (cmp < 0) {
+            canon = &seq[i];
+        } else {
+            for (j=0; j<k; j++) rc_buf[j] = comp[(unsigned char)seq[i + k - 1 - j]];
+            canon = rc_buf;
+        }
+        h = murmurhash3_x64_64(canon, k, seed);
+        if (h <= max_hash) {
+            if (fmh_counter_add(c, h, canon, window_sum / k) != 0) {
+                free(rc_buf);
+                return -1;
+            }
+        }
+    }
+    free(rc_buf);
+    return 0;
+}
+
+/*
+ * Function: fmh_default_threads
+ * -----------------------------
+ * Number of cores available (at least 1), used when the caller asks for 0 threads.
+ * */
+int fmh_default_threads(void) {
+#ifdef _WIN32
+    SYSTEM_INFO info;
+    GetSystemInfo(&info);
+    return info.dwNumberOfProcessors > 0 ? (int)info.dwNumberOfProcessors : 1;
+#else
+    long n = sysconf(_SC_NPROCESSORS_ONLN);
+    return n > 0 ? (int)n : 1;
+#endif
+}
+
+// one block of consecutive sequences, counted by one thread into its own counter:
+typedef struct {
+    fmh_counter *counter;
+    const char **seqs;
+    const size_t *lens;
+    size_t n_seqs;
+    unsigned long long max_hash;
+    unsigned int seed;
+    int status;
+} fmh_block;
+
+static void fmh_count_block(fmh_block *b) {
+    size_t i;
+    b->status = 0;
+    for (i=0; i<b->n_seqs && b->status==0; i++)
+        b->status = fmh_count_sequence(b->counter, b->seqs[i], b->lens[i], b->max_hash, b->seed);
+}
+
+#ifdef _WIN32
+static DWORD WINAPI fmh_count_block_thread(LPVOID arg) {
+    fmh_count_block((fmh_block *)arg);
+    return 0;
+}
+#else
+static void *fmh_count_block_thread(void *arg) {
+    fmh_count_block((fmh_block *)arg);
+    return NULL;
+}
+#endif
+
+/*
+ * Function: fmh_count_sequences_threaded
+ * --------------------------------------
+ * Counts 'n_seqs' sequences into 'c' using 'n_threads' native threads (0 = one per core). The
+ * sequences are split into consecutive blocks with about the same number of bases, each block is
+ * counted into its own counter, and the block counters are merged into 'c' in order, so the result
+ * is the same as calling fmh_count_sequence on every sequence in turn. Does not touch any python
+ * objects, so it can be called without the GIL.
+ *
+ * Returns 0 on success, 1 if a sequence contains a character other than ACGTN, and -1 if memory
+ * could not be allocated (or a thread could not be started).
+ * */
+int fmh_count_sequences_threaded(fmh_counter *c, const char **seqs, const size_t *lens, size_t n_seqs,
+                                 unsigned long long max_hash, unsigned int seed, int n_threads) {
+    size_t i, t, start, total_bases, block_bases, target;
+    int status = 0;
+    if (n_threads <= 0) n_threads = fmh_default_threads();
+    if ((size_t)n_threads > n_seqs) n_threads = n_seqs > 0 ? (int)n_seqs : 1;
+    if (n_threads == 1) {
+        for (i=0; i<n_seqs && status==0; i++)
+            status = fmh_count_sequence(c, seqs[i], lens[i], max_hash, seed);
+        return status;
+    }
+
+    fmh_block *blocks = (fmh_block *) calloc(n_threads, sizeof(fmh_block));
+    if (blocks == NULL) return -1;
+    // split into blocks of consecutive sequences with ~total_bases/n_threads bases each:
+    total_bases = 0;
+    for (i=0; i<n_seqs; i++) total_bases += lens[i];
+    start = 0;
+    for (t=0; t<(size_t)n_threads; t++) {
+        blocks[t].seqs = &seqs[start];
+        blocks[t].lens = &lens[start];
+        blocks[t].max_hash = max_hash;
+        blocks[t].seed = seed;
+        target = (total_bases / n_threads) + 1;
+        block_bases = 0;
+        i = start;
+        while (i < n_seqs && (t == (size_t)n_threads - 1 || block_bases < target)) {
+            block_bases += lens[i];
+            i++;
+        }
+        blocks[t].n_seqs = i - start;
+        start = i;
+        blocks[t].counter = fmh_counter_new(c->k, c->keep_kmers, 0);
+        if (blocks[t].counter == NULL) status = -1;
+    }
+
+    if (status == 0) {
+#ifdef _WIN32
+        HANDLE *threads = (HANDLE *) calloc(n_threads, sizeof(HANDLE));
+        if (threads == NULL) status = -1;
+        for (t=0; status==0 && t<(size_t)n_threads; t++) {
+            threads[t] = CreateThread(NULL, 0, fmh_count_block_thread, &blocks[t], 0, NULL);
+            if (threads[t] == NULL) { fmh_count_block(&blocks[t]); }
+        }
+        for (t=0; status==0 && t<(size_t)n_threads; t++) {
+            if (threads[t] != NULL) {
+                WaitForSingleObject(threads[t], INFINITE);
+                CloseHandle(threads[t]);
+            }
+        }
+        free(threads);
+#else
+        pthread_t *threads = (pthread_t *) calloc(n_threads, sizeof(pthread_t));
+        int *started = (int *) calloc(n_threads, sizeof(int));
+        if (threads == NULL || started == NULL) status = -1;
+        for (t=0; status==0 && t<(size_t)n_threads; t++) {
+            started[t] = (pthread_create(&threads[t], NULL, fmh_count_block_thread, &blocks[t]) == 0);
+            if (!started[t]) fmh_count_block(&blocks[t]);  // couldn't start a thread, do it here instead
+        }
+        for (t=0; status==0 && t<(size_t)n_threads; t++) {
+            if (started[t]) pthread_join(threads[t], NULL);
+        }
+        free(threads);
+        free(started);
+#endif
+    }
+
+    // merge the block counters in order (the first error, in block order, wins):
+    for (t=0; t<(size_t)n_threads; t++) {
+        if (status == 0) status = blocks[t].status;
+        if (status == 0 && fmh_counter_merge(c, blocks[t].counter) != 0) status = -1;
+        fmh_counter_free(blocks[t].counter);
+    }
+    free(blocks);
+    return status;
+}
+
+/*
+ * Function: window_mean_depth
+ * ---------------------------
+ * Fills 'out' (seqlen-k+1 values) with the mean of 'depth' over each window of length k, using a
+ * running sum.
+ * */
+void window_mean_depth(const double *depth, size_t seqlen, int k, double *out) {
+    size_t i;
+    int j;
+    double window_sum = 0.0;
+    if (seqlen < (size_t)k) return;
+    for (j=0; j<k-1; j++) window_sum += depth[j];
+    for (i=0; i<seqlen-k+1; i++) {
+        window_sum += depth[i + k - 1];
+        if (i > 0) window_sum -= depth[i - 1];
+        out[i] = window_sum / k;
+    }
+}
+
+
 // **********************************************************************
 // *            DEBUGGING FUNCTIONS:
 // **********************************************************************
@@ -7,6 +7,20 @@
 
 
 // Struct definition:
+// Open-addressing table used to count FracMinHash-retained k-mers (see fmh_counter_new in kmers.c).
+typedef struct {
+    long long *slots;               // index into the entry arrays, -1 if empty
+    size_t n_slots;                 // always a power of 2
+    unsigned long long *hashes;     // entries, in the order they were first seen
+    unsigned long long *counts;
+    char *kmers;                    // k bytes per entry, only if keep_kmers
+    double *weights;                // only if keep_weights
+    size_t n_entries;
+    size_t entries_cap;
+    int k;
+    int keep_kmers;
+    int keep_weights;
+} fmh_counter;
 
 
 // Utility functions:
@@ -36,6 +50,25 @@ unsigned long long *dna_sequence_to_kmer_ull_array_list(char *seq, size_t seqlen
 void dna_sequence_to_ull_array_list_provided(char *seq, size_t seqlen, int k, unsigned long long *w);
 unsigned long ull_array_list_set_to_min_RC(unsigned long long *w, int k, size_t array_len);
 
+// FracMinHash functions:
+unsigned long long murmurhash3_x64_64(const char *key, int len, unsigned int seed);
+unsigned long long fracminhash_max_hash(unsigned long long scaled);
+char dna_complement_upper(char nuc);
+fmh_counter *fmh_counter_new(int k, int keep_kmers, int keep_weights);
+void fmh_counter_free(fmh_counter *c);
+int fmh_counter_add(fmh_counter *c, unsigned long long hash, const char *kmer, double weight);
+int fmh_counter_add_count(fmh_counter *c, unsigned long long hash, const char *kmer, unsigned long long count,
+                          double weight);
+int fmh_counter_merge(fmh_counter *dst, const fmh_counter *src);
+int fmh_count_sequence(fmh_counter *c, const char *seq, size_t seqlen, unsigned long long max_hash,
+                       unsigned int seed);
+int fmh_count_sequence_with_depth(fmh_counter *c, const char *seq, size_t seqlen, const double *depth,
+                                  unsigned long long max_hash, unsigned int seed);
+int fmh_default_threads(void);
+int fmh_count_sequences_threaded(fmh_counter *c, const char **seqs, const size_t *lens, size_t n_seqs,
+                                 unsigned long long max_hash, unsigned int seed, int n_threads);
+void window_mean_depth(const double *depth, size_t seqlen, int k, double *out);
+
 /*
  * DEBUGGING FUNCTIONS:
  * */
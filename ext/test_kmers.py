@@ -26,3 +26,26 @@ print(f's1: {s1}\ns2: {s2}')
 print(f's1 == s2: {s1==s2}  (should be True)')
 
 
+
+separate_tests()
+
+# fracminhash_count / fracminhash_count_batch against the python sketch in adapted_sourmash.py
+import os, sys, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'feature_matrix_scripts'))
+import adapted_sourmash
+
+records = [tseq, tseq[50:] + 'NNACGT' + tseq[:120], 'ACGTN' * 20, tseq[::-1]]
+with tempfile.NamedTemporaryFile('w', suffix='.fa', delete=False) as fa:
+    for i, seq in enumerate(records):
+        fa.write(f'>r{i}\n{seq}\n')
+for ksize, scaled in [(21, 1), (31, 2), (15, 3)]:
+    expected = adapted_sourmash.sketch_file(fa.name, ksize, scaled, 'streaming')
+    hashes, counts, canonical_kmers = kmers.fracminhash_count(iter(records), ksize, scaled, 42, True)
+    got = dict(zip(canonical_kmers, counts.tolist()))
+    print(f'k={ksize} scaled={scaled} fracminhash_count == sketch_file: {got == expected} '
+          f'(same order: {list(got) == list(expected)})  (should be True)')
+    for n_threads in (1, 2, 3):
+        hashes_b, counts_b, kmers_b = kmers.fracminhash_count_batch(records, ksize, scaled, 42, n_threads, True)
+        same = np.array_equal(hashes_b, hashes) and np.array_equal(counts_b, counts) and kmers_b == canonical_kmers
+        print(f'k={ksize} scaled={scaled} fracminhash_count_batch(n_threads={n_threads}) == fracminhash_count: {same}  (should be True)')
+os.remove(fa.name)
@@ -0,0 +1,353 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import scipy.sparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "feature_matrix_scripts"))
+import feature_matrix_io
+
+"""
+The autoencoder from autoencoder_final.ipynb as a script, for training without the notebook.
+
+The notebook loads the whole feature matrix, makes a normalized dense copy and puts all of it on
+the device. Here the matrix stays the way it is stored (the sparse .npz in memory, or the dense
+.fm memory mapped, see feature_matrix_io.py) and the DataLoader workers make one minibatch at a
+time: take the rows, normalize them by their max and make them dense. So memory goes with the
+batch size (times the batches the workers keep ready), not with the number of samples. The
+batches are pinned when training on a GPU so the copy to the device overlaps with the next batch.
+The workers share the loaded matrix with the main process (the DataLoader forks them).
+
+The model, loss (MSE), optimizer (Adam) and the 80/20 train/validation split are the same as in
+the notebook, and the saved .pth is the model's state_dict, so it loads in
+get_embeddings_from_autoencoder.ipynb (load_autoencoder() gets the layer sizes from the file).
+
+With --sparse_input the batches stay sparse (torch COO tensors of the nonzero counts) and the first
+encoder layer multiplies them with a sparse-dense matmul instead of a dense GEMM over every column,
+which is most of the encoder's work on CPU since almost all of each row is zero. The layer has
+the same parameters as nn.Linear, so the state_dict is the same either way and any .pth (e.g.
+autoencoder_15_1000.pth) loads with or without it. The decoder still reconstructs every column,
+so when training the batch is made dense for the loss.
+
+`embed` runs a matrix through the encoder of a saved model in large batches (no autograd, with
+torch.inference_mode) straight into a preallocated float32 array, and saves that either as an
+.npz (the embeddings plus the row names, load_embeddings() reads it) or as the csv
+get_embeddings_from_autoencoder.ipynb writes (header Dim_1, Dim_2, ..., no row names).
+
+Usage:
+python autoencoder.py train /path/to/feature_matrix_not_normalized.npz -o autoencoder.pth [--epochs 100] [--batch_size 64] [--workers 2]
+python autoencoder.py embed autoencoder_15_1000.pth /path/to/feature_matrix_not_normalized.npz -o embeddings.npz (or .csv) [--batch_size 1024] [--threads 8] [--sparse_input]
+"""
+
+FIRST_HIDDEN_LAYER_SIZE = 1500
+SECOND_HIDDEN_LAYER_SIZE = 300
+LATENT_SIZE = 100
+
+
+class SparseInputLinear(nn.Linear):
+    """nn.Linear (same parameters and state_dict) that also takes a sparse COO batch"""
+
+    def forward(self, x):
+        if x.is_sparse:
+            return torch.sparse.mm(x, self.weight.t()) + self.bias
+        return super().forward(x)
+
+
+# define the autoencoder (with more layers this time)
+class Autoencoder(nn.Module):
+    def __init__(self, input_size, first_hidden_layer_size, second_hidden_layer_size, latent_size, sparse_input=False):
+        super(Autoencoder, self).__init__()
+        first_layer = SparseInputLinear if sparse_input else nn.Linear
+        self.encoder = nn.Sequential(
+            first_layer(input_size, first_hidden_layer_size),
+            nn.ReLU(),
+            nn.Linear(first_hidden_layer_size, second_hidden_layer_size),
+            nn.ReLU(),
+            nn.Linear(second_hidden_layer_size, latent_size),
+            nn.ReLU()
+        )
+        self.decoder = nn.Sequential(
+            nn.Linear(latent_size, second_hidden_layer_size),
+            nn.ReLU(),
+            nn.Linear(second_hidden_layer_size, first_hidden_layer_size),
+            nn.ReLU(),
+            nn.Linear(first_hidden_layer_size, input_size),
+            nn.ReLU()
+        )
+
+    def forward(self, x):
+        x = self.encoder(x)
+        x = self.decoder(x)
+        return x
+
+
+def layer_sizes(state_dict):
+    """(input_size, first hidden, second hidden, latent) of a saved Autoencoder state_dict"""
+    first, input_size = state_dict["encoder.0.weight"].shape
+    return input_size, first, state_dict["encoder.2.weight"].shape[0], state_dict["encoder.4.weight"].shape[0]
+
+
+def load_autoencoder(path, map_location="cpu", sparse_input=False):
+    """an Autoencoder from a .pth state_dict, with the layer sizes it was saved with"""
+    state_dict = torch.load(path, map_location=map_location)
+    model = Autoencoder(*layer_sizes(state_dict), sparse_input=sparse_input)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def normalize_rows(rows, dtype=np.float32):
+    """
+    dense rows divided by their max, like the notebook (rows that are all zero stay zero instead of nan).
+    `rows` can be sparse or dense
+    """
+    rows = feature_matrix_io.dense(rows, dtype)
+    if not rows.flags.writeable or isinstance(rows, np.memmap):
+        rows = np.array(rows, dtype=dtype)
+    row_max = rows.max(axis=1, initial=0)
+    row_max[row_max == 0] = 1
+    rows /= row_max[:, None]
+    return rows
+
+
+def normalize_rows_sparse(rows, dtype=np.float32):
+    """csr rows divided by their max. `rows` can be sparse or dense"""
+    rows = scipy.sparse.csr_matrix(rows, dtype=dtype, copy=True)
+    rows.eliminate_zeros()
+    row_max = rows.max(axis=1).toarray().ravel()
+    row_max[row_max == 0] = 1
+    rows.data /= np.repeat(row_max, np.diff(rows.indptr))
+    return rows
+
+
+def sparse_tensor(rows):
+    """csr matrix -> torch sparse COO tensor (already coalesced: csr indices are sorted and unique)"""
+    rows = rows.tocsr()
+    rows.sort_indices()
+    row_idx = np.repeat(np.arange(rows.shape[0], dtype=np.int64), np.diff(rows.indptr))
+    indices = torch.from_numpy(np.vstack([row_idx, rows.indices.astype(np.int64)]))
+    return torch.sparse_coo_tensor(indices, torch.from_numpy(rows.data), rows.shape).coalesce()
+
+
+class RowBatches(Dataset):
+    """
+    the rows of a feature matrix as minibatches: indexed with a list of rows (from a BatchSampler),
+    gives those rows normalized as a float32 tensor (sparse COO if `sparse`)
+    """
+
+    def __init__(self, matrix, rows, sparse=False):
+        self.matrix = matrix
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.sparse = sparse
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, batch):
+        # sorted, so a memory mapped matrix is read front to back
+        rows = np.sort(self.rows[batch])
+        if self.sparse:
+            return sparse_tensor(normalize_rows_sparse(self.matrix[rows]))
+        return torch.from_numpy(normalize_rows(self.matrix[rows]))
+
+
+def make_dataloader(matrix, rows, batch_size, shuffle=False, workers=0, pin_memory=False, seed=0, sparse=False):
+    dataset = RowBatches(matrix, rows, sparse)
+    if shuffle:
+        sampler = RandomSampler(dataset, generator=torch.Generator().manual_seed(seed))
+    else:
+        sampler = SequentialSampler(dataset)
+    # batch_size=None: the dataset makes the whole batch, the DataLoader doesn't collate single rows
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None,
+                      num_workers=workers, pin_memory=pin_memory and not sparse, persistent_workers=workers > 0)
+
+
+def split_rows(n_rows, val_fraction=0.2, seed=0):
+    """shuffled (train rows, validation rows), the same 80/20 split as the notebook by default"""
+    order = torch.randperm(n_rows, generator=torch.Generator().manual_seed(seed)).numpy()
+    train_size = int((1 - val_fraction) * n_rows)
+    return order[:train_size], order[train_size:]
+
+
+def run_epoch(model, dataloader, loss_fn, device, optimizer=None):
+    """mean loss over the batches; trains if an optimizer is given"""
+    total_loss = 0.0
+    n_batches = 0
+    for batch_data in dataloader:
+        batch_data = batch_data.to(device, non_blocking=True)
+        outputs = model(batch_data)
+        loss = loss_fn(outputs, batch_data.to_dense() if batch_data.is_sparse else batch_data)
+        if optimizer is not None:
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        total_loss += loss.item()
+        n_batches += 1
+    return total_loss / max(n_batches, 1)
+
+
+def train(model, train_dataloader, val_dataloader, device, num_epochs=100, lr=0.001, report_every=10):
+    loss_fn = nn.MSELoss()
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    train_losses = []
+    val_losses = []
+    for epoch in range(num_epochs):
+        start = time.time()
+        model.train()
+        train_losses.append(run_epoch(model, train_dataloader, loss_fn, device, optimizer))
+        model.eval()
+        with torch.no_grad():
+            val_losses.append(run_epoch(model, val_dataloader, loss_fn, device))
+        if (epoch + 1) % report_every == 0 or epoch + 1 == num_epochs:
+            print(f'Epoch [{epoch + 1}/{num_epochs}] - Training Loss: {train_losses[-1]} - '
+                  f'Validation Loss: {val_losses[-1]} ({time.time() - start:.1f}s)', flush=True)
+    return train_losses, val_losses
+
+
+def embed(model, dataloader, n_rows, device):
+    """the encoder output of every row of a (not shuffled) dataloader as an (n_rows, latent size) float32 array"""
+    embeddings = np.empty((n_rows, model.encoder[-2].out_features), dtype=np.float32)
+    start = 0
+    model.eval()
+    with torch.inference_mode():
+        for batch_data in dataloader:
+            encoded = model.encoder(batch_data.to(device, non_blocking=True))
+            embeddings[start : start + len(encoded)] = encoded.cpu().numpy()
+            start += len(encoded)
+    return embeddings
+
+
+def write_csv_header(f, latent_size):
+    f.write(",".join(f"Dim_{i + 1}" for i in range(latent_size)) + "\n")
+
+
+def write_csv_rows(f, embeddings):
+    """rows of embeddings the way the notebook's pandas to_csv writes them"""
+    for row in embeddings.tolist():
+        f.write(",".join(map(repr, row)) + "\n")
+
+
+def write_embeddings(path, embeddings, row_names):
+    """.npz with the row names, or the notebook's csv"""
+    if path.endswith(".csv"):
+        with open(path, 'w') as f:
+            write_csv_header(f, embeddings.shape[1])
+            write_csv_rows(f, embeddings)
+    else:
+        np.savez(path, embeddings=embeddings, row_names=np.array(row_names, dtype=str))
+
+
+def load_embeddings(path):
+    """(embeddings, row names) from an .npz that write_embeddings() wrote"""
+    with np.load(path) as npz:
+        return npz["embeddings"], npz["row_names"].tolist()
+
+
+def losses_path(model_path):
+    return os.path.splitext(model_path)[0] + "_losses.tsv"
+
+
+def write_losses(path, train_losses, val_losses):
+    with open(path, 'w') as f:
+        f.write("epoch\ttrain_loss\tval_loss\n")
+        for epoch, (train_loss, val_loss) in enumerate(zip(train_losses, val_losses)):
+            f.write(f"{epoch + 1}\t{train_loss}\t{val_loss}\n")
+
+
+def get_device(name):
+    if name == "auto":
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(name)
+
+
+def add_device_args(parser):
+    parser.add_argument("--device", type=str, default="auto", help="cpu, cuda, ... (default: cuda if there is one)")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads (default: torch's default)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="train the autoencoder, or use a trained one")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="train on a feature matrix and save the model as a .pth")
+    train_parser.add_argument("matrix", type=str, help="unnormalized feature matrix (.npz, .fm or .csv)")
+    train_parser.add_argument("-o", "--output", type=str, required=True, help="where to save the model (.pth)")
+    train_parser.add_argument("--epochs", type=int, default=100)
+    train_parser.add_argument("--batch_size", type=int, default=64)
+    train_parser.add_argument("--lr", type=float, default=0.001)
+    train_parser.add_argument("--val_fraction", type=float, default=0.2, help="rows held out for the validation loss")
+    train_parser.add_argument("--first_hidden_layer_size", type=int, default=FIRST_HIDDEN_LAYER_SIZE)
+    train_parser.add_argument("--second_hidden_layer_size", type=int, default=SECOND_HIDDEN_LAYER_SIZE)
+    train_parser.add_argument("--latent_size", type=int, default=LATENT_SIZE)
+    train_parser.add_argument("--workers", type=int, default=2, help="DataLoader worker processes making the batches")
+    train_parser.add_argument("--sparse_input", action="store_true",
+                              help="keep the batches sparse and use a sparse matmul in the first encoder layer (faster on CPU)")
+    train_parser.add_argument("--seed", type=int, default=0, help="for the split, the shuffling and the initial weights")
+    train_parser.add_argument("--report_every", type=int, default=10, help="print the losses every N epochs")
+    add_device_args(train_parser)
+    embed_parser = subparsers.add_parser("embed", help="save the embeddings of a feature matrix from a trained model")
+    embed_parser.add_argument("model", type=str, help="saved model (.pth)")
+    embed_parser.add_argument("matrix", type=str, help="unnormalized feature matrix (.npz, .fm or .csv) in the model's columns")
+    embed_parser.add_argument("-o", "--output", type=str, required=True,
+                              help="embeddings: .npz (with the row names) or .csv (like the notebook)")
+    embed_parser.add_argument("--batch_size", type=int, default=1024)
+    embed_parser.add_argument("--workers", type=int, default=1, help="DataLoader worker processes making the batches")
+    embed_parser.add_argument("--sparse_input", action="store_true", help="sparse batches and first layer (faster on CPU)")
+    add_device_args(embed_parser)
+    return parser.parse_args()
+
+
+def main_train(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    matrix = feature_matrix_io.load_feature_matrix(args.matrix).matrix
+    n_rows, input_size = matrix.shape
+    train_rows, val_rows = split_rows(n_rows, args.val_fraction, args.seed)
+    pin_memory = device.type == "cuda"
+    train_dataloader = make_dataloader(matrix, train_rows, args.batch_size, shuffle=True, workers=args.workers,
+                                       pin_memory=pin_memory, seed=args.seed, sparse=args.sparse_input)
+    val_dataloader = make_dataloader(matrix, val_rows, args.batch_size, workers=args.workers, pin_memory=pin_memory,
+                                     sparse=args.sparse_input)
+    model = Autoencoder(input_size, args.first_hidden_layer_size, args.second_hidden_layer_size,
+                        args.latent_size, sparse_input=args.sparse_input).to(device)
+    print(f"training on {len(train_rows)} samples ({len(val_rows)} for validation), {input_size} columns, {device}")
+    train_losses, val_losses = train(model, train_dataloader, val_dataloader, device, args.epochs, args.lr,
+                                     args.report_every)
+    torch.save(model.state_dict(), args.output)
+    write_losses(losses_path(args.output), train_losses, val_losses)
+    print(f"saved the model: {args.output}")
+
+
+def main_embed(args):
+    device = get_device(args.device)
+    model = load_autoencoder(args.model, map_location=device, sparse_input=args.sparse_input).to(device)
+    fm = feature_matrix_io.load_feature_matrix(args.matrix)
+    n_rows, input_size = fm.matrix.shape
+    if input_size != model.encoder[0].in_features:
+        raise SystemExit(f"{args.matrix} has {input_size} columns, the model takes {model.encoder[0].in_features}")
+    dataloader = make_dataloader(fm.matrix, np.arange(n_rows), args.batch_size, workers=args.workers,
+                                 pin_memory=device.type == "cuda", sparse=args.sparse_input)
+    start = time.time()
+    embeddings = embed(model, dataloader, n_rows, device)
+    elapsed = time.time() - start
+    row_names = fm.row_names if fm.row_names is not None else [str(i) for i in range(n_rows)]
+    write_embeddings(args.output, embeddings, row_names)
+    print(f"embedded {n_rows} samples in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} samples/s): {args.output}")
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.command == "train":
+        main_train(args)
+    elif args.command == "embed":
+        main_embed(args)
+
+
+if __name__ == "__main__":
+    main()
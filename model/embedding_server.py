@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+import scipy.sparse
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "feature_matrix_scripts"))
+import column_index
+import prep_eval_feature_matrix
+
+import autoencoder
+import fasta_to_embeddings
+
+"""
+A local server that keeps a trained encoder loaded, so embedding a few samples doesn't pay for
+starting python, importing torch and reading the .pth every time.
+
+Requests come in over HTTP on localhost (or a unix socket with --unix_socket) and each request
+waits in a queue. One thread takes them off the queue and encodes them together: it starts a
+batch with the first request that is waiting, adds the requests that come in during the next
+--max_latency_ms (or until there are --max_batch_size samples), and runs the whole batch through
+the encoder at once (sparse first layer, see autoencoder.py). So under load many small requests
+share one matmul, and a lone request waits at most --max_latency_ms extra.
+
+    POST /embed   {"samples": [{"name": "s1", "cols": [...], "counts": [...]}, ...]}
+                      unnormalized counts in the training columns (column indices, as in the feature matrix)
+                  {"sketches": ["/path/to/sketch.npz", ...]}
+                      sketch files (txt or npz, see sketch_io.py) read by the server and put in the
+                      training columns, like prep_eval_feature_matrix.py --keep_singletons
+                  -> {"names": [...], "embeddings": [[...], ...]}
+    GET /stats    requests, samples, batches, mean batch size, samples/s, latency percentiles (ms)
+    GET /health   {"ok": true}
+
+Usage:
+python embedding_server.py autoencoder_15_1000.pth /path/to/training/column_kmers.txt [--port 8765 | --unix_socket /tmp/embed.sock] [--max_batch_size 256] [--max_latency_ms 5] [--threads 8]
+curl -s localhost:8765/embed -d '{"sketches": ["/path/to/sample.npz"]}'
+"""
+
+LATENCY_WINDOW = 10000
+
+
+class ServerStats:
+    """counters for /stats. latencies are of the last LATENCY_WINDOW requests, in seconds"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.samples = 0
+        self.batches = 0
+        self.batched_samples = 0
+        self.encode_seconds = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def add_request(self, n_samples, seconds, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.samples += n_samples
+            self.latencies.append(seconds)
+
+    def add_batch(self, n_samples, seconds):
+        with self.lock:
+            self.batches += 1
+            self.batched_samples += n_samples
+            self.encode_seconds += seconds
+
+    def snapshot(self, queue_size=0):
+        with self.lock:
+            uptime = time.time() - self.started
+            latencies_ms = np.array(self.latencies) * 1000
+            percentiles = np.percentile(latencies_ms, [50, 95, 99]).tolist() if len(latencies_ms) else [0, 0, 0]
+            return {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "samples": self.samples,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_samples / max(self.batches, 1),
+                "samples_per_s": self.samples / max(uptime, 1e-9),
+                "encode_seconds": self.encode_seconds,
+                "latency_ms": dict(zip(["p50", "p95", "p99"], percentiles)),
+                "queue_size": queue_size,
+            }
+
+
+class DynamicBatcher:
+    """
+    encodes the sparse rows of concurrent requests together in one thread. submit() returns a Future
+    with the embeddings of that request's rows
+    """
+
+    def __init__(self, model, n_columns, max_batch_size=256, max_latency_ms=5, stats=None):
+        self.model = model
+        self.n_columns = n_columns
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.stats = stats if stats is not None else ServerStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, matrix):
+        future = Future()
+        self.queue.put((matrix, future))
+        return future
+
+    def _next_batch(self):
+        """the first waiting request, plus whatever comes in within max_latency (up to max_batch_size rows)"""
+        batch = [self.queue.get()]
+        n_rows = batch[0][0].shape[0]
+        deadline = time.monotonic() + self.max_latency
+        while n_rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_rows += item[0].shape[0]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                matrix = scipy.sparse.vstack([m for m, _ in batch], format="csr")
+                start = time.time()
+                # a request bigger than max_batch_size on its own is still encoded in pieces of that size
+                embeddings = np.concatenate([
+                    fasta_to_embeddings.encode_rows(self.model, matrix[i : i + self.max_batch_size])
+                    for i in range(0, matrix.shape[0], self.max_batch_size)
+                ]) if matrix.shape[0] else np.zeros((0, self.model.encoder[-2].out_features), dtype=np.float32)
+                self.stats.add_batch(matrix.shape[0], time.time() - start)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for m, future in batch:
+                future.set_result(embeddings[offset : offset + m.shape[0]])
+                offset += m.shape[0]
+
+
+def samples_to_csr(samples, n_columns):
+    """[{"name", "cols", "counts"}, ...] -> (names, csr matrix)"""
+    names = []
+    rows = []
+    for i, sample in enumerate(samples):
+        cols = np.asarray(sample["cols"], dtype=np.int64)
+        counts = np.asarray(sample["counts"], dtype=np.float64)
+        if cols.shape != counts.shape:
+            raise ValueError(f"sample {i}: cols and counts have different lengths")
+        if len(cols) and (cols.min() < 0 or cols.max() >= n_columns):
+            raise ValueError(f"sample {i}: columns must be in [0, {n_columns})")
+        order = np.argsort(cols)
+        rows.append((cols[order], counts[order]))
+        names.append(str(sample.get("name", i)))
+    matrix = fasta_to_embeddings.rows_to_csr(rows, n_columns)
+    matrix.sum_duplicates()
+    return names, matrix
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    # set on the server: batcher, index, stats
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"ok": True})
+        elif self.path == "/stats":
+            self._send_json(200, self.server.stats.snapshot(self.server.batcher.queue.qsize()))
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/embed":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        start = time.time()
+        n_samples = 0
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if "sketches" in request:
+                paths = list(request["sketches"])
+                names = [os.path.basename(p) for p in paths]
+                matrix = prep_eval_feature_matrix.project_sketches(self.server.index, paths)
+            else:
+                names, matrix = samples_to_csr(request.get("samples", []), len(self.server.index))
+            n_samples = len(names)
+            embeddings = self.server.batcher.submit(matrix).result()
+        except Exception as e:
+            self.server.stats.add_request(n_samples, time.time() - start, error=True)
+            self._send_json(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.server.stats.add_request(n_samples, time.time() - start)
+        self._send_json(200, {"names": names, "embeddings": embeddings.tolist()})
+
+    def address_string(self):
+        # unix socket clients don't have an address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+# socketserver's default listen backlog of 5 resets connections when many clients send at once
+REQUEST_QUEUE_SIZE = 1024
+
+
+class EmbeddingHTTPServer(ThreadingHTTPServer):
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def make_server(model_path, training_kmers, host="127.0.0.1", port=8765, unix_socket=None, max_batch_size=256,
+                max_latency_ms=5, quiet=False):
+    training_kmers = column_index.find_column_index(training_kmers)
+    index = column_index.load_column_index(training_kmers)
+    model = autoencoder.load_autoencoder(model_path, sparse_input=True)
+    model.eval()
+    if model.encoder[0].in_features != len(index):
+        raise ValueError(f"{training_kmers} has {len(index)} columns, the model takes {model.encoder[0].in_features}")
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, EmbeddingHandler)
+    else:
+        server = EmbeddingHTTPServer((host, port), EmbeddingHandler)
+    server.index = index
+    server.stats = ServerStats()
+    server.batcher = DynamicBatcher(model, len(index), max_batch_size, max_latency_ms, server.stats)
+    server.quiet = quiet
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="keep a trained encoder loaded and embed samples sent to it")
+    parser.add_argument("model", type=str, help="saved model (.pth)")
+    parser.add_argument("training_kmers", type=str, help="column_kmers.txt of the training feature matrix (or its .kidx)")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix_socket", type=str, default=None, help="listen on this unix socket instead of --host/--port")
+    parser.add_argument("--max_batch_size", type=int, default=256, help="most samples encoded together")
+    parser.add_argument("--max_latency_ms", type=float, default=5,
+                        help="how long a batch waits for more requests after the first one")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads for the encoder")
+    parser.add_argument("--quiet", action="store_true", help="don't log every request")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    server = make_server(args.model, args.training_kmers, args.host, args.port, args.unix_socket, args.max_batch_size,
+                         args.max_latency_ms, args.quiet)
+    where = args.unix_socket if args.unix_socket is not None else f"http://{args.host}:{args.port}"
+    print(f"serving embeddings on {where} (max batch {args.max_batch_size}, max latency {args.max_latency_ms}ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
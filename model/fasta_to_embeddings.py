@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "feature_matrix_scripts"))
+import adapted_sourmash
+import column_index
+import kmer_hashing
+import prep_eval_feature_matrix
+import run_adapted_sourmash
+
+import autoencoder
+
+"""
+FASTA files -> embeddings in one command, instead of run_adapted_sourmash.py ->
+aggregate_adapted_sourmash_results.py -> prep_eval_feature_matrix.py -> the notebook, and
+without writing the sketches or the feature matrix.
+
+A pool of worker processes sketches the files (the same sketch as adapted_sourmash.py, --mode)
+and puts each sketch straight into the training columns (the column_index.py index of
+column_kmers.txt, like prep_eval_feature_matrix.py), so all that comes back from a worker is the
+sparse row of one sample. Meanwhile the main process takes the rows as they come, in input
+order, and every --batch_size of them normalizes them by their max and runs them through the
+encoder (with the sparse first layer, see autoencoder.py), and appends the embeddings to the
+output. So sketching the next files and embedding the finished ones overlap, and the output
+grows as the files finish.
+
+The embeddings are written as the csv get_embeddings_from_autoencoder.ipynb writes (Dim_1, ...)
+and the sample names (fasta name without the extension) go in <output>_row_fnames.txt, in the
+same order. Files that fail are reported at the end and left out.
+
+Kmers that are only in one of the samples are kept (like prep_eval_feature_matrix.py
+--keep_singletons), because that can't be known before the last file is done. --drop_singletons
+gives the prep_eval_feature_matrix.py default instead: the sparse rows are kept until all the
+files are sketched (still no dense matrix or intermediate files) and embedded at the end.
+
+Usage:
+python fasta_to_embeddings.py autoencoder_15_1000.pth /path/to/training/column_kmers.txt /path/to/fasta/files/directory [more fasta files/dirs ...] --scaled 1000 -o embeddings.csv [--workers N] [--batch_size 256]
+"""
+
+# the index is opened once per worker process (a .kidx is memory mapped, so that's cheap)
+_index = None
+
+
+def _init_worker(index_path):
+    global _index
+    _index = column_index.load_column_index(index_path)
+
+
+def sketch_kmer_array(keep, ksize, two_bit=True):
+    """
+    {canonical kmer: count} -> (2-bit kmers, counts), or the kmers as strings for columns that
+    aren't 2-bit (see column_index.py). kmers with other characters than ACGT can't be 2-bit columns
+    """
+    kmer_list = list(keep)
+    if not two_bit:
+        return kmer_list, np.fromiter(keep.values(), dtype=np.int64, count=len(kmer_list))
+    try:
+        kmers = kmer_hashing.strings_to_kmers(kmer_list, ksize)
+    except ValueError:
+        kmer_list = [kmer for kmer in kmer_list if not kmer.strip("ACGT")]
+        kmers = kmer_hashing.strings_to_kmers(kmer_list, ksize)
+    counts = np.fromiter((keep[kmer] for kmer in kmer_list), dtype=np.int64, count=len(kmer_list))
+    return kmers, counts
+
+
+# sketches one file and puts it in the training columns (runs in a worker process).
+# errors are returned rather than raised so one bad file doesn't stop the rest.
+def sketch_and_project(file_path, scaled, mode):
+    start = time.time()
+    try:
+        keep = adapted_sourmash.sketch_file(file_path, _index.ksize, scaled, mode)
+        kmers, counts = sketch_kmer_array(keep, _index.ksize, _index.two_bit)
+        cols = _index.lookup(kmers)
+        found = cols >= 0
+        order = np.argsort(cols[found])
+        return file_path, cols[found][order], counts[found][order], time.time() - start, None
+    except Exception as e:
+        return file_path, None, None, time.time() - start, f"{type(e).__name__}: {e}"
+
+
+def iter_projected(paths, index_path, scaled, mode, workers):
+    """(path, cols, counts, seconds, error) of each file, in input order, at most a few files ahead per worker"""
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index_path,)) as executor:
+        paths = iter(paths)
+        pending = deque(executor.submit(sketch_and_project, path, scaled, mode)
+                        for path in itertools.islice(paths, 4 * workers))
+        while pending:
+            result = pending.popleft().result()
+            path = next(paths, None)
+            if path is not None:
+                pending.append(executor.submit(sketch_and_project, path, scaled, mode))
+            yield result
+
+
+def rows_to_csr(rows, n_columns):
+    """[(cols, counts), ...] -> csr matrix"""
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(cols) for cols, _ in rows])
+    indices = np.concatenate([cols for cols, _ in rows]) if rows else np.zeros(0, dtype=np.int64)
+    data = np.concatenate([counts for _, counts in rows]) if rows else np.zeros(0, dtype=np.int64)
+    return scipy.sparse.csr_matrix((data.astype(np.float32), indices, indptr), shape=(len(rows), n_columns))
+
+
+def encode_rows(model, matrix):
+    """embeddings of the rows of an unnormalized csr matrix"""
+    with torch.inference_mode():
+        batch = autoencoder.sparse_tensor(autoencoder.normalize_rows_sparse(matrix))
+        return model.encoder(batch).numpy()
+
+
+class EmbeddingWriter:
+    """appends embeddings to the csv and their names to <output>_row_fnames.txt, one batch at a time"""
+
+    def __init__(self, path, latent_size):
+        self.csv = open(path, 'w')
+        self.row_fnames = open(prep_eval_feature_matrix.row_fnames_path(path), 'w')
+        autoencoder.write_csv_header(self.csv, latent_size)
+        self.rows = 0
+
+    def write(self, embeddings, names):
+        autoencoder.write_csv_rows(self.csv, embeddings)
+        for name in names:
+            self.row_fnames.write(name + "\n")
+        self.csv.flush()
+        self.row_fnames.flush()
+        self.rows += len(names)
+
+    def close(self):
+        self.csv.close()
+        self.row_fnames.close()
+
+
+def list_fasta_paths(inputs):
+    """fasta files, and the fasta files in directories, in order"""
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, f) for f in run_adapted_sourmash.list_fasta_files(path))
+        else:
+            paths.append(path)
+    return paths
+
+
+def fasta_to_embeddings(model_path, training_kmers, fasta_paths, out_path, scaled, mode="batch", workers=None,
+                        batch_size=256, drop_singletons=False):
+    workers = os.cpu_count() if workers is None else workers
+    training_kmers = column_index.find_column_index(training_kmers)
+    n_columns = len(column_index.load_column_index(training_kmers))
+    model = autoencoder.load_autoencoder(model_path, sparse_input=True)
+    model.eval()
+    if model.encoder[0].in_features != n_columns:
+        raise ValueError(f"{training_kmers} has {n_columns} columns, the model takes {model.encoder[0].in_features}")
+    writer = EmbeddingWriter(out_path, model.encoder[-2].out_features)
+    print(f"embedding {len(fasta_paths)} files with {workers} workers (scaled={scaled}, mode={mode})")
+
+    failed = []
+    rows = []
+    names = []
+    start = time.time()
+    try:
+        for n_done, (path, cols, counts, seconds, error) in enumerate(
+                iter_projected(fasta_paths, training_kmers, scaled, mode, workers), start=1):
+            if error is not None:
+                failed.append((path, error))
+                print(f"[{n_done}/{len(fasta_paths)}] FAILED: {path} -- {error}")
+                continue
+            rows.append((cols, counts))
+            names.append(run_adapted_sourmash.sample_name(os.path.basename(path)))
+            print(f"[{n_done}/{len(fasta_paths)}] sketched: {path} ({len(cols)} training kmers, {seconds:.1f}s)")
+            if not drop_singletons and len(rows) == batch_size:
+                writer.write(encode_rows(model, rows_to_csr(rows, n_columns)), names)
+                rows, names = [], []
+        if drop_singletons:
+            matrix = prep_eval_feature_matrix.drop_singletons(rows_to_csr(rows, n_columns))
+            for batch_start in range(0, matrix.shape[0], batch_size):
+                writer.write(encode_rows(model, matrix[batch_start : batch_start + batch_size]),
+                             names[batch_start : batch_start + batch_size])
+        elif rows:
+            writer.write(encode_rows(model, rows_to_csr(rows, n_columns)), names)
+    finally:
+        writer.close()
+    elapsed = time.time() - start
+
+    print(f"embedded {writer.rows} of {len(fasta_paths)} files in {elapsed:.1f}s "
+          f"({len(fasta_paths) / max(elapsed, 1e-9):.2f} files/s): {out_path}")
+    if failed:
+        print(f"{len(failed)} files failed:")
+        for path, error in failed:
+            print(f"  {path}: {error}")
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="sketch fasta files and embed them with a trained model in one pass")
+    parser.add_argument("model", type=str, help="saved model (.pth)")
+    parser.add_argument("training_kmers", type=str, help="column_kmers.txt of the training feature matrix (or its .kidx)")
+    parser.add_argument("fasta", nargs="+", help="fasta files, or directories of them")
+    parser.add_argument("--scaled", type=int, required=True, help="scaled the training sketches were made with")
+    parser.add_argument("-o", "--output", type=str, required=True, help="embeddings csv")
+    parser.add_argument("--mode", type=str, default="batch", choices=sorted(adapted_sourmash.SKETCH_MODES),
+                        help="how to sketch (see adapted_sourmash.py)")
+    parser.add_argument("--workers", type=int, default=None, help="sketching processes (default one per core)")
+    parser.add_argument("--batch_size", type=int, default=256, help="samples embedded at a time")
+    parser.add_argument("--drop_singletons", action="store_true",
+                        help="zero the kmers only one sample has, like prep_eval_feature_matrix.py (embeds at the end)")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads for the encoder")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    failed = fasta_to_embeddings(args.model, args.training_kmers, list_fasta_paths(args.fasta), args.output,
+                                 args.scaled, args.mode, args.workers, args.batch_size, args.drop_singletons)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,26 @@
+import os
 import mmh3
 import screed
 import argparse
+import numpy as np
+
+import kmer_hashing
+import sketch_io
+
+# the C extension in ext/ is optional (build it with `python setup2.py build_ext --inplace`
+# and put ext/ on the PYTHONPATH to use --mode ext)
+try:
+    import kmers
+except ImportError:
+    kmers = None
 
 """
 Usage:
-python /path/to/adapted_sourmash.py ksize scaled /path/to/input_file.fasta /path/to/output_file.txt
+python /path/to/adapted_sourmash.py ksize scaled /path/to/input_file.fasta /path/to/output_file.{txt,npz} [--mode {streaming,batch,ext,list}]
+python /path/to/adapted_sourmash.py 21,31 1000,2000 /path/to/input_file.fasta /path/to/output_file.txt --mode batch   (one pass, one file per ksize/scaled)
 """
 
-parser = argparse.ArgumentParser(description="apply FracMinHashing to a DNA sequence and retain the kmers")
-parser.add_argument("ksize", type=int, help="kmer length (an int)")
-parser.add_argument("scaled", type=int, help="sampling rate")
-parser.add_argument("file_path", type=str, help="path to fasta file")
-parser.add_argument("output_file_path", type=str, help="path to the output txt file")
-args = parser.parse_args()
-
-ksize = args.ksize # 31 default in sourmash
-scaled = args.scaled # 1000 default in sourmash
-
 MAX_HASH = 2**64
-keep_below = MAX_HASH / scaled
 
 """
 get all kmers - directly from sourmash
@@ -37,7 +39,7 @@ def build_kmers(sequence, ksize):
 """
 read in file - directly from sourmash
 """
-def read_kmers_from_file(filename):
+def read_kmers_from_file(filename, ksize):
     all_kmers = []
     for record in screed.open(filename):
         sequence = record.sequence
@@ -72,9 +74,11 @@ def hash_kmer(kmer):
 
 """
 filter the kmers - adapted from sourmash
+(pass in `keep` to keep adding to an existing set of counts)
 """
-def subsample_kmers(kmers):
-    keep = {}
+def subsample_kmers(kmers, keep_below, keep=None):
+    if keep is None:
+        keep = {}
     for kmer in kmers:
         canonical_kmer, hash_val = hash_kmer(kmer)
         if hash_val < keep_below:
@@ -85,8 +89,247 @@ def subsample_kmers(kmers):
     return keep
 
 
-kmers = read_kmers_from_file(args.file_path)
-keep = subsample_kmers(kmers)
-with open(args.output_file_path, "w") as output_file:
-    for key, value in keep.items():
-        output_file.write(f"{key} {value}\n")
\ No newline at end of file
+"""
+same windows as build_kmers, but yields them one at a time instead of
+storing the whole list
+"""
+def iter_kmers(sequence, ksize):
+    n_kmers = len(sequence) - ksize + 1
+
+    for i in range(n_kmers):
+        yield sequence[i : i + ksize]
+
+
+"""
+sketch a whole file in the original way: every kmer in the file is built
+into one list before anything is hashed
+"""
+def sketch_file_list(filename, ksize, scaled):
+    kmers = read_kmers_from_file(filename, ksize)
+    return subsample_kmers(kmers, MAX_HASH / scaled)
+
+
+"""
+sketch a whole file one record at a time, hashing each window as it comes off
+the sequence. only the kept kmers are stored, so memory depends on the size of
+the sketch (and the longest record) rather than the size of the file. the counts
+are added in the same order as sketch_file_list so the output is identical.
+"""
+def sketch_file_streaming(filename, ksize, scaled):
+    keep_below = MAX_HASH / scaled
+    keep = {}
+    for record in screed.open(filename):
+        subsample_kmers(iter_kmers(record.sequence, ksize), keep_below, keep)
+    return keep
+
+
+"""
+batch version of subsample_kmers for one sequence: every window in a chunk of
+the sequence is encoded, canonicalized and hashed with numpy (see kmer_hashing.py)
+and only the windows under the threshold come back to python. windows with
+characters other than uppercase ACGT go through hash_kmer so the result is the
+same as the streaming path, counts added in the same order.
+"""
+BATCH_CHUNK_SIZE = 2**20
+_RC_TABLE = str.maketrans("ACGT", "TGCA")
+
+# counts the kept kmers among the first n_windows windows of chunk (chunk_bytes/codes
+# are its ascii bytes and 2-bit encoding, passed in when they're shared between ksizes)
+def _subsample_chunk_batch(chunk, ksize, keep_below, keep, n_windows, chunk_bytes=None, codes=None):
+    threshold = kmer_hashing.keep_below_int(keep_below)
+    canonical, is_rc, hashes, valid = kmer_hashing.hash_sequence(
+        chunk if chunk_bytes is None else chunk_bytes, ksize, codes=codes)
+    valid = valid[:n_windows]
+    kept = valid & kmer_hashing.below_threshold(hashes[:n_windows], threshold)
+    check = np.flatnonzero(kept | ~valid)
+    for i in check:
+        kmer = chunk[i : i + ksize]
+        if valid[i]:
+            canonical_kmer = kmer.translate(_RC_TABLE)[::-1] if is_rc[i] else kmer
+        else:
+            canonical_kmer, hash_val = hash_kmer(kmer)
+            if not hash_val < keep_below:
+                continue
+        if canonical_kmer in keep:
+            keep[canonical_kmer] += 1
+        else:
+            keep[canonical_kmer] = 1
+
+
+def subsample_sequence_batch(sequence, ksize, keep_below, keep=None, chunk_size=BATCH_CHUNK_SIZE):
+    if keep is None:
+        keep = {}
+    n_kmers = len(sequence) - ksize + 1
+    for start in range(0, max(n_kmers, 0), chunk_size):
+        # chunks overlap by ksize-1 so that every window is seen exactly once
+        chunk = sequence[start : start + chunk_size + ksize - 1]
+        _subsample_chunk_batch(chunk, ksize, keep_below, keep, chunk_size)
+    return keep
+
+
+"""
+subsample_sequence_batch for several ksizes at once (keeps[i] gets the counts for
+ksizes[i]). each chunk of the sequence is encoded once and the encoding is shared
+by all the ksizes.
+"""
+def subsample_sequence_batch_multi(sequence, ksizes, keep_below, keeps, chunk_size=BATCH_CHUNK_SIZE):
+    max_ksize = max(ksizes)
+    n_kmers = len(sequence) - min(ksizes) + 1
+    for start in range(0, max(n_kmers, 0), chunk_size):
+        # long enough for the windows starting in [start, start + chunk_size) of every ksize
+        chunk = sequence[start : start + chunk_size + max_ksize - 1]
+        chunk_bytes = chunk.encode("ascii", errors="replace")
+        codes = kmer_hashing.encode_sequence(chunk_bytes)
+        for ksize, keep in zip(ksizes, keeps):
+            _subsample_chunk_batch(chunk, ksize, keep_below, keep, chunk_size, chunk_bytes, codes)
+    return keeps
+
+
+def sketch_file_batch(filename, ksize, scaled):
+    # kmers longer than 32 don't fit the 2-bit uint64 encoding, same sketch one kmer at a time
+    if ksize > kmer_hashing.MAX_KSIZE:
+        return sketch_file_streaming(filename, ksize, scaled)
+    keep_below = MAX_HASH / scaled
+    keep = {}
+    for record in screed.open(filename):
+        subsample_sequence_batch(record.sequence, ksize, keep_below, keep)
+    return keep
+
+
+"""
+same sketch, but the whole counting loop runs in the C extension
+(kmers.fracminhash_count). counts come back in first-seen order, same as the dict.
+with threads != 1 the records are all read first and counted by that many native
+threads (kmers.fracminhash_count_batch, 0 = one per core); the output is the same.
+"""
+def sketch_file_ext(filename, ksize, scaled, threads=1):
+    if kmers is None:
+        raise ImportError("--mode ext needs the kmers C extension (see ext/setup2.py)")
+    if threads == 1:
+        sequences = (record.sequence for record in screed.open(filename))
+        hashes, counts, canonical_kmers = kmers.fracminhash_count(sequences, ksize, scaled, 42, True)
+    else:
+        sequences = [record.sequence for record in screed.open(filename)]
+        hashes, counts, canonical_kmers = kmers.fracminhash_count_batch(sequences, ksize, scaled, 42, threads, True)
+    return dict(zip(canonical_kmers, counts.tolist()))
+
+
+"""
+sketches a file for every combination of ksizes and scaleds, reading it only once.
+each ksize is counted at the smallest scaled (the biggest sketch) and the sketches
+for the other scaleds are downsampled from it (FracMinHash sketches nest, so this is
+exact, and only the kept kmers get hashed again). returns {(ksize, scaled): counts},
+each the same as sketch_file(filename, ksize, scaled) would give.
+in batch mode ksizes over 32 are counted the streaming way.
+"""
+MULTI_SKETCH_MODES = {"streaming", "batch", "ext"}
+
+def sketch_file_multi(filename, ksizes, scaleds, mode="batch"):
+    if mode not in MULTI_SKETCH_MODES:
+        raise ValueError(f"mode must be one of {sorted(MULTI_SKETCH_MODES)} to sketch several ksizes/scaleds at once")
+    if mode == "ext" and kmers is None:
+        raise ImportError("--mode ext needs the kmers C extension (see ext/setup2.py)")
+    ksizes = sorted(set(ksizes))
+    scaleds = sorted(set(scaleds))
+    min_scaled = scaleds[0]
+    keep_below = MAX_HASH / min_scaled
+    keeps = {ksize: {} for ksize in ksizes}
+    batch_ksizes = [k for k in ksizes if mode == "batch" and k <= kmer_hashing.MAX_KSIZE]
+    other_ksizes = [k for k in ksizes if k not in batch_ksizes]
+
+    for record in screed.open(filename):
+        sequence = record.sequence
+        if batch_ksizes:
+            subsample_sequence_batch_multi(sequence, batch_ksizes, keep_below, [keeps[k] for k in batch_ksizes])
+        for ksize in other_ksizes:
+            keep = keeps[ksize]
+            if mode == "ext":
+                # one record at a time, so the counts still come in first-seen order
+                _, counts, canonical_kmers = kmers.fracminhash_count([sequence], ksize, min_scaled, 42, True)
+                for kmer, count in zip(canonical_kmers, counts.tolist()):
+                    keep[kmer] = keep.get(kmer, 0) + count
+            else:
+                subsample_kmers(iter_kmers(sequence, ksize), keep_below, keep)
+
+    sketches = {}
+    for ksize in ksizes:
+        for scaled in scaleds:
+            if scaled == min_scaled:
+                sketches[(ksize, scaled)] = keeps[ksize]
+            else:
+                sketches[(ksize, scaled)] = sketch_io.downsample_kmer_counts(keeps[ksize], MAX_HASH / scaled)
+    return sketches
+
+
+SKETCH_MODES = {
+    "streaming": sketch_file_streaming,
+    "list": sketch_file_list,
+    "batch": sketch_file_batch,
+    "ext": sketch_file_ext,
+}
+
+
+def sketch_file(filename, ksize, scaled, mode="streaming", threads=1):
+    if mode == "ext":
+        return sketch_file_ext(filename, ksize, scaled, threads)
+    return SKETCH_MODES[mode](filename, ksize, scaled)
+
+
+"""
+writes the counts as text ("kmer count" lines), or in the binary format from
+sketch_io.py if the output path ends in .npz
+"""
+def write_sketch(keep, output_file_path, ksize=None, scaled=None):
+    if output_file_path.endswith(sketch_io.BINARY_EXTENSION):
+        sketch_io.write_sketch_binary(sketch_io.sketch_from_kmer_counts(keep, scaled, ksize=ksize), output_file_path)
+        return
+    sketch_io.write_kmer_counts_text(keep, output_file_path)
+
+
+"""
+output path for one (ksize, scaled) sketch when several are written at once:
+out.txt -> out.k21.s1000.txt
+"""
+def multi_output_path(output_file_path, ksize, scaled):
+    root, ext = os.path.splitext(output_file_path)
+    return f"{root}.k{ksize}.s{scaled}{ext}"
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="apply FracMinHashing to a DNA sequence and retain the kmers")
+    parser.add_argument("ksize", type=int_list,
+                        help="kmer length (an int), or a comma separated list of them") # 31 default in sourmash
+    parser.add_argument("scaled", type=int_list,
+                        help="sampling rate, or a comma separated list of them") # 1000 default in sourmash
+    parser.add_argument("file_path", type=str, help="path to fasta file")
+    parser.add_argument("output_file_path", type=str,
+                        help="path to the output txt file (or .npz for the binary format). if several ksizes/scaleds "
+                             "are given, one file is written per combination, e.g. out.k21.s1000.txt")
+    parser.add_argument("--mode", type=str, choices=sorted(SKETCH_MODES), default="streaming",
+                        help="'streaming' hashes kmers as each record is read (memory depends on the sketch size). "
+                             "'batch' hashes whole sequences at once with numpy (much faster, ksize <= 32). "
+                             "'ext' runs the counting in the kmers C extension (fastest, needs ext/ built). "
+                             "'list' builds every kmer in the file first (the original behavior). "
+                             "all of them give the same output.")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="native threads for --mode ext (default 1, 0 = one per core)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if len(args.ksize) == 1 and len(args.scaled) == 1:
+        keep = sketch_file(args.file_path, args.ksize[0], args.scaled[0], args.mode, args.threads)
+        write_sketch(keep, args.output_file_path, args.ksize[0], args.scaled[0])
+        return
+    sketches = sketch_file_multi(args.file_path, args.ksize, args.scaled, args.mode)
+    for (ksize, scaled), keep in sketches.items():
+        write_sketch(keep, multi_output_path(args.output_file_path, ksize, scaled), ksize, scaled)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,417 @@
 import os
-import csv
 import sys
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-def make_feature_matrix(directory):
+import numpy as np
+import scipy.sparse
+
+import column_index
+import feature_matrix_io
+import kmer_hashing
+import kmer_vocabulary
+import sketch_io
+
+"""
+the matrix is built sparse: each sketch only adds (row, column, count) entries for the
+kmers it has, singleton columns are found from one count of the nonzeros per column, and
+the csv is written one row at a time.
+
+--out_of_core doesn't keep the sketches in memory at all. the first pass streams the
+sketch files into an on-disk kmer vocabulary with the number of samples each kmer is in
+(kmer_vocabulary.py, using at most about --memory_budget MB), and the second pass reads the
+sketches again and writes each row of the matrix against that vocabulary. kmers that can't be
+2-bit encoded (ones with an N, say) go in a string-keyed side vocabulary and their columns are
+put in between in alphabetical order, so the outputs are the same as the in-memory version
+(ksize <= 32).
+
+--workers N spreads the work over N processes by splitting the kmers into shards by their first
+4 bases (kmer_vocabulary.py partitions). each worker first splits its share of the sketch files
+into the shards, then each shard is a block of consecutive columns that one worker counts,
+filters and writes out on its own; the last step pastes the blocks together row by row. the
+shards are ranges of kmers, so the columns come out in the same sorted order. the few kmers
+that can't be 2-bit encoded come back from the workers as strings and make one more block,
+whose columns are moved in between the others (kmer_vocabulary.ColumnMap), so the outputs are
+the same as without --workers (ksize <= 32).
+
+--append adds new sketches to a matrix made with --out_of_core without going over the
+existing sketches again. the vocabulary keeps the document frequency of every kmer (and, for
+singletons, which row has it), so only the new sketches are read. the new samples become the
+last rows, and each append writes to its own <directory>/append_NNN/:
+    new_rows.csv          the new rows, in the updated column order (.npz/.fm with --format)
+    new_row_fnames.txt    their file names
+    column_changes.tsv    the columns that are new in this append (kmers that were singletons,
+                          or weren't there at all, and are now in more than one sample), with
+                          their index in the updated column order and the existing row that
+                          has a value for that kmer (-1 if none) and its count
+row_fnames.txt and column_kmers.txt are updated in place. the feature matrix file is left as
+it was; its rows are the old rows with zeros in the new columns, except for the cells listed
+in column_changes.tsv.
+
+--format picks how the matrix is written (feature_matrix_io.py): csv (the default, as before),
+npz (sparse, with the row names and column kmers inside) or dense (.fm, memory mappable).
+
+Usage:
+python aggregate_adapted_sourmash_results.py /path/to/adapted_sourmash_output_dir [--out_of_core [--memory_budget MB]] [--format npz]
+python aggregate_adapted_sourmash_results.py /path/to/adapted_sourmash_output_dir --workers 64
+python aggregate_adapted_sourmash_results.py /path/to/adapted_sourmash_output_dir --append /path/to/new/sketches [more sketches/dirs ...]
+"""
+
+def read_sketch_rows(directory):
     """
-    makes feature matrix from a directory
+    reads every sketch in a directory. returns (file_names, kmers, matrix) where kmers is the
+    list of kmers in column order (first seen) and matrix is a csr matrix with one row per file
     """
-    all_kmers = set() # will be columns of mat
-    file_data = []
     file_names = []
-    
+    vocab = {}  # kmer -> column
+    indptr = [0]
+    indices = []
+    data = []
+    for fname in sketch_io.list_sketch_files(directory):
+        fpath = os.path.join(directory, fname)
+        file_names.append(fname)
+        # {kmer: count}, from either the text or binary sketch format
+        file_content = sketch_io.load_kmer_counts(fpath)
+        cols = np.fromiter((vocab.setdefault(kmer, len(vocab)) for kmer in file_content),
+                           dtype=np.int64, count=len(file_content))
+        indices.append(cols)
+        data.append(np.fromiter(file_content.values(), dtype=np.int64, count=len(file_content)))
+        indptr.append(indptr[-1] + len(file_content))
+
+    kmers = list(vocab)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    data = np.concatenate(data) if data else np.zeros(0, dtype=np.int64)
+    matrix = scipy.sparse.csr_matrix((data, indices, np.array(indptr, dtype=np.int64)),
+                                     shape=(len(file_names), len(kmers)))
+    return file_names, kmers, matrix
+
+
+def sort_columns(kmers, matrix):
+    """puts the columns in alphabetical kmer order"""
+    order = sorted(range(len(kmers)), key=kmers.__getitem__)
+    return [kmers[j] for j in order], matrix[:, order]
+
+
+def drop_singleton_columns(kmers, matrix):
+    """removes the columns where only one row has a nonzero value"""
+    nonzero_per_column = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    keep = np.flatnonzero(nonzero_per_column != 1)
+    return [kmers[j] for j in keep], matrix[:, keep]
+
+
+def write_row_fnames(file_names, out_fnames):
+    with open(out_fnames, 'w') as row_fnames_file:
+        for fname in file_names:
+            row_fnames_file.write(fname + "\n")
+
+
+def write_column_kmers(kmers, out_columns):
+    with open(out_columns, 'w') as column_kmers_file:
+        for kmer in kmers:
+            column_kmers_file.write(kmer + "\n")
+    # and the binary index of them next to it, if they fit in 2-bit form
+    ksize = len(kmers[0]) if kmers else 0
+    try:
+        if ksize > kmer_hashing.MAX_KSIZE:
+            raise ValueError(f"ksize {ksize} doesn't fit in 2-bit form")
+        write_column_index(kmer_hashing.strings_to_kmers(kmers, ksize), ksize, out_columns)
+    except ValueError:
+        remove_column_index(out_columns)
+
+
+def write_vocabulary_columns(column_map, out_columns):
+    """column_kmers.txt of a kmer_vocabulary.ColumnMap (with the .kidx if the columns are all 2-bit)"""
+    with open(out_columns, 'w') as column_kmers_file:
+        for chunk in column_map.iter_column_bytes():
+            for kmer in chunk.tolist():
+                column_kmers_file.write(kmer.decode("ascii") + "\n")
+    if len(column_map.other_columns):
+        remove_column_index(out_columns)
+    else:
+        write_column_index(column_map.columns, column_map.ksize, out_columns)
+
+
+def write_column_index(columns, ksize, out_columns):
+    """column_kmers.kidx (column_index.py) for the columns written to out_columns"""
+    index = column_index.index_from_kmers(np.asarray(columns), ksize)
+    column_index.write_column_index(index, column_index.index_path(out_columns), out_columns)
+
+
+def remove_column_index(out_columns):
+    """a .kidx left from an earlier run wouldn't match the new columns"""
+    if os.path.exists(column_index.index_path(out_columns)):
+        os.remove(column_index.index_path(out_columns))
+
+
+def make_feature_matrix_out_of_core(directory, memory_budget_mb=kmer_vocabulary.DEFAULT_MEMORY_BUDGET_MB,
+                                    vocab_dir=None, out_format="csv"):
     """
-    go through each file and compile a list of kmers present across all of them.
-    at the same time, make the file contents faster to access (dict)
+    same as make_feature_matrix, in two passes over the sketch files with an on-disk vocabulary
+    (kept in vocab_dir, default <directory>/kmer_vocabulary)
     """
-    for fname in os.listdir(directory):
-        if fname.endswith(".txt"):
-            fpath = os.path.join(directory, fname)
-            file_names.append(fname)
-            file_content = {}
-            
-            with open(fpath, 'r') as f:
-                for line in f:
-                    """
-                    because each file is in the format
-                    kmer count
-                    kmer count
-                    kmer count
-                    ...
-                    """
-                    parts = line.split()
-                    if len(parts) == 2:
-                        kmer, count = parts
-                        count = int(count)
-                        file_content[kmer] = count
-                        all_kmers.add(kmer)
-            
-            file_data.append(file_content)
-    
+    vocab_dir = os.path.join(directory, "kmer_vocabulary") if vocab_dir is None else vocab_dir
+    file_names = sketch_io.list_sketch_files(directory)
+    paths = [os.path.join(directory, fname) for fname in file_names]
+
+    # pass 1: kmer vocabulary with document frequencies
+    vocab = kmer_vocabulary.build_vocabulary(paths, vocab_dir, memory_budget_mb)
+    column_map = kmer_vocabulary.ColumnMap(vocab.columns, vocab.other.columns, vocab.ksize)
+    print(f"finished kmer vocabulary: {len(vocab.kmers) + len(vocab.other.kmers)} kmers, "
+          f"{column_map.n_columns} in more than one sample")
+
+    # pass 2: one row per sketch, against the (memory mapped) columns
+    writer = feature_matrix_io.FeatureMatrixWriter(feature_matrix_io.matrix_path(directory, out_format),
+                                                   len(paths), column_map.n_columns)
+    for path in paths:
+        writer.write_row(*column_map.row(sketch_io.load_kmer_array(path)))
+    writer.close(file_names, [] if out_format == "csv" else column_map.column_bytes())
+    print("finished writing rows")
+
+    write_row_fnames(file_names, os.path.join(directory, "row_fnames.txt"))
+    write_vocabulary_columns(column_map, os.path.join(directory, "column_kmers.txt"))
+    print("finished making feature matrix (unnormalized)")
+
+
+def _partition_sketch_files(paths, first_row, shard_dir, max_buffered_bytes):
+    os.makedirs(shard_dir)
+    return kmer_vocabulary.partition_sketches(paths, shard_dir, max_buffered_bytes, first_row)
+
+
+def _write_column_block(shard_dirs, p, n_rows, out_path):
+    """
+    counts shard p and writes its non-singleton columns for every row to out_path (a csv, or a
+    scipy .npz to be stacked with the other blocks). returns the columns (sorted 2-bit kmers).
+    """
+    records = kmer_vocabulary.read_partition(shard_dirs, p)
+    kmers, inverse, df = np.unique(records["kmer"], return_inverse=True, return_counts=True)
+    keep = df >= kmer_vocabulary.MIN_COLUMN_DF
+    column = np.cumsum(keep) - 1
+    kept = keep[inverse]
+    block = scipy.sparse.csr_matrix((records["count"][kept], (records["row"][kept], column[inverse[kept]])),
+                                    shape=(n_rows, int(keep.sum())))
+    if block.shape[1] and out_path.endswith(feature_matrix_io.CSV_EXTENSION):
+        feature_matrix_io.write_feature_matrix(block, out_path, [], [])
+    elif block.shape[1]:
+        scipy.sparse.save_npz(out_path, block)
+    return kmers[keep]
+
+
+def _other_column_block(other_records, other_columns, n_rows, out_path):
+    """the block of the columns that aren't 2-bit, written like _write_column_block's"""
+    cols, found = kmer_vocabulary.column_indices(other_columns, other_records["kmer"])
+    block = scipy.sparse.csr_matrix((other_records["count"][found], (other_records["row"][found], cols[found])),
+                                    shape=(n_rows, len(other_columns)))
+    if out_path.endswith(feature_matrix_io.CSV_EXTENSION):
+        feature_matrix_io.write_feature_matrix(block, out_path, [], [])
+    else:
+        scipy.sparse.save_npz(out_path, block)
+
+
+def paste_csv_blocks(block_csvs, n_rows, output_csv, column_order=None):
+    """
+    joins the rows of several csv files (same number of rows) side by side. column_order, if
+    given, is the column of the joined rows that goes in each output column
+    """
+    blocks = [open(path, newline='') for path in block_csvs]
+    column_order = None if column_order is None else column_order.tolist()
+    try:
+        with open(output_csv, 'w', newline='') as csvfile:
+            for _ in range(n_rows):
+                line = ",".join(f.readline().rstrip("\r\n") for f in blocks)
+                if column_order is not None:
+                    values = line.split(",")
+                    line = ",".join([values[i] for i in column_order])
+                csvfile.write(line + "\r\n")
+    finally:
+        for f in blocks:
+            f.close()
+
+
+def make_feature_matrix_parallel(directory, workers=None, memory_budget_mb=kmer_vocabulary.DEFAULT_MEMORY_BUDGET_MB,
+                                 out_format="csv"):
+    """
+    same as make_feature_matrix, with the kmers split into shards (ranges of kmers) that are
+    counted, filtered and written by `workers` processes
+    """
+    workers = os.cpu_count() if workers is None else workers
+    file_names = sketch_io.list_sketch_files(directory)
+    paths = [os.path.join(directory, fname) for fname in file_names]
+    n_rows = len(paths)
+    max_buffered_bytes = kmer_vocabulary.budget_bytes(memory_budget_mb) // (2 * workers)
+
+    with tempfile.TemporaryDirectory(dir=directory) as work_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+        # 1. every worker splits a consecutive run of the sketch files into the shards
+        per_worker = -(-n_rows // workers) if n_rows else 1
+        starts = list(range(0, n_rows, per_worker))
+        shard_dirs = [os.path.join(work_dir, f"rows_{start}") for start in starts]
+        results = list(executor.map(_partition_sketch_files, [paths[start : start + per_worker] for start in starts],
+                                    starts, shard_dirs, [max_buffered_bytes] * len(starts)))
+        ksizes = {ksize for ksize, _, _, _ in results if ksize is not None}
+        if len(ksizes) > 1:
+            raise ValueError(f"the sketches in {directory} have different ksizes: {sorted(ksizes)}")
+        ksize = ksizes.pop() if ksizes else 0
+        other_records = [other for _, _, _, other in results if len(other)]
+        other_records = np.concatenate(other_records) if other_records \
+            else np.zeros(0, dtype=kmer_vocabulary.other_record_dtype(ksize))
+        other_kmers, other_df, _, _ = kmer_vocabulary.count_records(other_records)
+        other_columns = other_kmers[other_df >= kmer_vocabulary.MIN_COLUMN_DF]
+        sizes = sum(s for _, _, s, _ in results) if results else np.zeros(0, dtype=np.int64)
+        print(f"finished splitting {n_rows} sketches into shards")
+
+        # 2. one column block per shard, biggest shards first so the workers finish together
+        shards = sorted(np.flatnonzero(sizes).tolist(), key=lambda p: -sizes[p])
+        block_ext = ".csv" if out_format == "csv" else ".npz"
+        blocks = {p: os.path.join(work_dir, f"block_{p:03d}{block_ext}") for p in shards}
+        futures = {p: executor.submit(_write_column_block, shard_dirs, p, n_rows, blocks[p]) for p in shards}
+        columns = {p: futures[p].result() for p in shards}
+        print("finished column blocks")
+
+        # 3. blocks in shard (= kmer) order, then the block of the other kmers, whose columns go in between
+        order = [p for p in sorted(shards) if len(columns[p])]
+        all_columns = np.concatenate([columns[p] for p in order]) if order else np.zeros(0, dtype=np.uint64)
+        block_paths = [blocks[p] for p in order]
+        column_map = kmer_vocabulary.ColumnMap(all_columns, other_columns, ksize)
+        column_order = None
+        if len(other_columns):
+            block_paths.append(os.path.join(work_dir, f"block_other{block_ext}"))
+            _other_column_block(other_records, other_columns, n_rows, block_paths[-1])
+            positions = np.concatenate([column_map.positions(np.arange(len(all_columns))), column_map.other_positions])
+            column_order = np.argsort(positions)
+        out_path = feature_matrix_io.matrix_path(directory, out_format)
+        if out_format == "csv":
+            paste_csv_blocks(block_paths, n_rows, out_path, column_order)
+        else:
+            matrix = scipy.sparse.hstack([scipy.sparse.load_npz(path) for path in block_paths], format="csr") \
+                if block_paths else scipy.sparse.csr_matrix((n_rows, 0), dtype=np.int64)
+            if column_order is not None:
+                matrix = matrix[:, column_order]
+            feature_matrix_io.write_feature_matrix(matrix, out_path, file_names, column_map.column_bytes())
+
+    write_row_fnames(file_names, os.path.join(directory, "row_fnames.txt"))
+    write_vocabulary_columns(column_map, os.path.join(directory, "column_kmers.txt"))
+    print("finished making feature matrix (unnormalized)")
+
+
+def next_append_dir(directory):
+    n = 1
+    while os.path.exists(os.path.join(directory, f"append_{n:03d}")):
+        n += 1
+    return os.path.join(directory, f"append_{n:03d}")
+
+
+def write_column_changes(changes, other_changes, column_map, row_fnames, out_path):
+    """column_changes.tsv of the 2-bit and the other kmers that became columns, in column order"""
+    cols = column_map.kmer_columns(changes.kmers, other_changes.kmers)
+    kmers = kmer_hashing.kmers_to_strings(changes.kmers, column_map.ksize) + \
+        [kmer.decode("ascii") for kmer in other_changes.kmers.tolist()]
+    old_row = np.concatenate([changes.old_row, other_changes.old_row])
+    old_count = np.concatenate([changes.old_count, other_changes.old_count])
+    order = np.argsort(cols, kind="stable")
+    with open(out_path, 'w') as f:
+        f.write("column\tkmer\told_row\told_row_fname\tcount\n")
+        for i in order.tolist():
+            col, kmer, row, count = int(cols[i]), kmers[i], int(old_row[i]), int(old_count[i])
+            fname = row_fnames[row] if row >= 0 else ""
+            f.write(f"{col}\t{kmer}\t{row}\t{fname}\t{count}\n")
+
+
+def append_to_feature_matrix(directory, new_paths, memory_budget_mb=kmer_vocabulary.DEFAULT_MEMORY_BUDGET_MB,
+                             vocab_dir=None, out_format="csv"):
+    """
+    adds the sketches in new_paths to a feature matrix made by make_feature_matrix_out_of_core,
+    reading only the new sketches. returns the append_NNN directory the new rows went to.
+    """
+    vocab_dir = os.path.join(directory, "kmer_vocabulary") if vocab_dir is None else vocab_dir
+    with open(os.path.join(directory, "row_fnames.txt")) as f:
+        row_fnames = f.read().splitlines()
+    if kmer_vocabulary.read_meta(vocab_dir)["n_samples"] != len(row_fnames):
+        raise ValueError(f"{vocab_dir} doesn't match {os.path.join(directory, 'row_fnames.txt')}")
+    new_fnames = [os.path.basename(path) for path in new_paths]
+    duplicates = sorted((set(new_fnames) & set(row_fnames)) | {f for f in new_fnames if new_fnames.count(f) > 1})
+    if duplicates:
+        raise ValueError(f"already in the feature matrix (or given twice): {', '.join(duplicates)}")
+
+    vocab, changes, other_changes = kmer_vocabulary.append_to_vocabulary(vocab_dir, new_paths, memory_budget_mb)
+    column_map = kmer_vocabulary.ColumnMap(vocab.columns, vocab.other.columns, vocab.ksize)
+    print(f"updated kmer vocabulary: {len(vocab.kmers) + len(vocab.other.kmers)} kmers, "
+          f"{column_map.n_columns} in more than one sample ({len(changes.kmers) + len(other_changes.kmers)} new columns)")
+
+    out_dir = next_append_dir(directory)
+    os.makedirs(out_dir)
+    writer = feature_matrix_io.FeatureMatrixWriter(feature_matrix_io.matrix_path(out_dir, out_format, "new_rows"),
+                                                   len(new_paths), column_map.n_columns)
+    for path in new_paths:
+        writer.write_row(*column_map.row(sketch_io.load_kmer_array(path)))
+    writer.close(new_fnames, [] if out_format == "csv" else column_map.column_bytes())
+    write_row_fnames(new_fnames, os.path.join(out_dir, "new_row_fnames.txt"))
+    write_column_changes(changes, other_changes, column_map, row_fnames, os.path.join(out_dir, "column_changes.tsv"))
+
+    write_row_fnames(row_fnames + new_fnames, os.path.join(directory, "row_fnames.txt"))
+    write_vocabulary_columns(column_map, os.path.join(directory, "column_kmers.txt"))
+    print(f"finished appending {len(new_paths)} samples to the feature matrix: {out_dir}")
+    return out_dir
+
+
+def make_feature_matrix(directory, out_format="csv"):
+    """
+    makes feature matrix from a directory
+    """
+    file_names, all_kmers, matrix = read_sketch_rows(directory)
+
     # sort the kmers alphabetically
-    all_kmers = sorted(all_kmers)
-    
-    matrix = []
-    for file_content in file_data:
-        row = []
-        for kmer in all_kmers:
-            row.append(file_content.get(kmer, 0))  # defaults to 0 if the kmer isn't present
-        matrix.append(row)
+    all_kmers, matrix = sort_columns(all_kmers, matrix)
+    matrix = matrix.tocsr()
     print("finished making unfiltered matrix")
 
     # remove singletons (only one row has a nonzero value for that kmer)
-    cols_to_remove = set({})
-    for j in range(len(all_kmers)):
-        nonzero_count = sum(1 for i in range(len(matrix)) if matrix[i][j] > 0)
-        if nonzero_count == 1:
-            cols_to_remove.add(j)
-    print("finished finding columns to remove")
-
-    # remove the singleton columns from the matrix and update all_kmers
-    matrix_filtered = []
-    all_kmers_filtered = []
-    for i in range(len(matrix)):
-        new_row = [matrix[i][j] for j in range(len(all_kmers)) if j not in cols_to_remove]
-        matrix_filtered.append(new_row)
-
-    all_kmers_filtered = [all_kmers[j] for j in range(len(all_kmers)) if j not in cols_to_remove]
+    all_kmers_filtered, matrix_filtered = drop_singleton_columns(all_kmers, matrix)
     print("finished filtering")
-    
+
     # write files
-    output_csv = os.path.join(directory, "feature_matrix_not_normalized.csv")
-    with open(output_csv, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        for i, row in enumerate(matrix_filtered):
-            writer.writerow(row)
-    
-    out_fnames = os.path.join(directory, "row_fnames.txt")
-    with open(out_fnames, 'w') as row_fnames_file:
-        for fname in file_names:
-            row_fnames_file.write(fname + "\n")
-    
-    out_columns = os.path.join(directory, "column_kmers.txt")
-    with open(out_columns, 'w') as column_kmers_file:
-        for kmer in all_kmers_filtered:
-            column_kmers_file.write(kmer + "\n")
-    
+    feature_matrix_io.write_feature_matrix(matrix_filtered, feature_matrix_io.matrix_path(directory, out_format),
+                                           file_names, all_kmers_filtered)
+    write_row_fnames(file_names, os.path.join(directory, "row_fnames.txt"))
+    write_column_kmers(all_kmers_filtered, os.path.join(directory, "column_kmers.txt"))
+
     print("finished making feature matrix (unnormalized)")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="make the feature matrix from a directory of kmer sketches")
+    parser.add_argument("directory", type=str, help="directory with the adapted_sourmash output")
+    parser.add_argument("--out_of_core", action="store_true",
+                        help="two passes over the sketch files with an on-disk kmer vocabulary, for cohorts "
+                             "that don't fit in memory (ksize <= 32)")
+    parser.add_argument("--memory_budget", type=float, default=kmer_vocabulary.DEFAULT_MEMORY_BUDGET_MB,
+                        help="roughly how much memory (MB) --out_of_core can use for kmers "
+                             f"(default {kmer_vocabulary.DEFAULT_MEMORY_BUDGET_MB})")
+    parser.add_argument("--vocab_dir", type=str, default=None,
+                        help="where --out_of_core keeps the kmer vocabulary (default: <directory>/kmer_vocabulary)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="build the matrix in this many worker processes, each doing a range of the kmers "
+                             "(ksize <= 32)")
+    parser.add_argument("--format", dest="out_format", type=str, choices=sorted(feature_matrix_io.FORMATS),
+                        default="csv", help="feature matrix file format: csv (default), npz (sparse) or dense "
+                                            "(memory mappable .fm), see feature_matrix_io.py")
+    parser.add_argument("--append", nargs="+", default=None, metavar="SKETCH",
+                        help="new sketch files (or directories of them) to add to a matrix made with --out_of_core, "
+                             "without re-reading the existing sketches")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("usage: python script.py /path/to/adapted_sourmash_output_dir")
-        sys.exit(1)
-    
-    directory = sys.argv[1]
-    
+    args = parse_args()
+    directory = args.directory
+
     if not os.path.isdir(directory):
         print(f"director dne")
         sys.exit(1)
-    
-    make_feature_matrix(directory)
+
+    if args.append:
+        append_to_feature_matrix(directory, sketch_io.expand_sketch_paths(args.append), args.memory_budget,
+                                 args.vocab_dir, args.out_format)
+    elif args.out_of_core:
+        make_feature_matrix_out_of_core(directory, args.memory_budget, args.vocab_dir, args.out_format)
+    elif args.workers:
+        make_feature_matrix_parallel(directory, args.workers, args.memory_budget, args.out_format)
+    else:
+        make_feature_matrix(directory, args.out_format)
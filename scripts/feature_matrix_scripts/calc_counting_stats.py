@@ -1,39 +1,76 @@
 import os
 import sys
-from itertools import combinations
+import time
+import argparse
+
+import numpy as np
+import scipy.sparse
+
+import column_index
+import sketch_io
 
 """
-Usage: python calc_counting_stats.py path/to/kmer/counts/dir
+The pairwise statistics come from the samples x kmers presence matrix X (a sparse 0/1 matrix):
+the number of kmers two samples share is an entry of X.Xt, and the sum over all pairs is just
+sum(c * (c - 1) / 2) over the number of samples c each kmer is in, so the average pairwise
+intersection doesn't need any set intersections.
+
+--pairwise OUT_DIR also writes the full pairwise matrices (for sample QC / outliers), computed
+--block_rows rows of X.Xt at a time so only that many rows of the (dense) result are in memory:
+    pairwise_intersection.npy   number of kmers samples i and j share
+    pairwise_jaccard.npy        intersection / union
+    pairwise_containment.npy    intersection / number of kmers of sample i (row i in column j)
+    pairwise_row_fnames.txt     the samples, in row/column order
+the .npy files can be opened with np.load(path, mmap_mode="r").
+
+--streaming goes through the sketches one at a time without keeping them, so memory doesn't
+grow with the number of samples or the total number of kmers (ksize <= 32):
+    - the count statistics are running sums, and the histogram of the counts (how many kmers
+      have each count, over all samples) goes in count_histogram.txt
+    - the kmers all files have in common (and intersection_increments.txt) are exact: the core
+      is a subset of the first sketch, so it's a bitmap over a column_index.py index of the
+      first sketch's kmers that every following sketch is and-ed into (kmers that aren't plain
+      ACGT, e.g. with an N, can't be 2-bit encoded and are kept in a small set instead)
+    - the size of the union of all the kmer sets is estimated with a HyperLogLog (2**precision
+      registers, standard error about 1.04 / sqrt(2**precision), 0.8% at the default 14); the
+      kmers that aren't plain ACGT go in hashed as strings, like adapted_sourmash.py hashes them
+    - the average pairwise intersection needs every kmer's sample count, so it isn't computed
+Progress (sketch files/s, MB/s, kmers/s) is printed every --report_every files.
+
+Usage: python calc_counting_stats.py path/to/kmer/counts/dir [--pairwise path/to/out/dir [--block_rows N]]
+Usage: python calc_counting_stats.py path/to/kmer/counts/dir --streaming
 """
 
-def make_one_set(file_path):
-    kmers = set({})
-    counts = []
+DEFAULT_BLOCK_ROWS = 1024
+DEFAULT_HLL_PRECISION = 14
 
-    with open(file_path, 'r') as file:
-        for line in file:
-            columns = line.strip().split()
-            kmers.add(columns[0])
-            counts.append(int(columns[1]))
+def make_one_set(file_path):
+    # works on either the text or binary sketch format
+    kmer_counts = sketch_io.load_kmer_counts(file_path)
+    kmers = set(kmer_counts)
+    counts = list(kmer_counts.values())
 
     return kmers, counts
 
 
-def calc_stats(directory_path):
+def calc_stats(directory_path, pairwise_dir=None, block_rows=DEFAULT_BLOCK_ROWS):
     """
     find all kmer counting statistics
     """
     all_kmer_sets = []
     all_counts_list = []
-    for fname in os.listdir(directory_path):
-        if fname.endswith('.txt'):
-            fpath = os.path.join(directory_path, fname)
-            kmers, counts = make_one_set(fpath)
-            all_kmer_sets.append(kmers)
-            all_counts_list.append(counts)
+    file_names = sketch_io.list_sketch_files(directory_path)
+    for fname in file_names:
+        fpath = os.path.join(directory_path, fname)
+        kmers, counts = make_one_set(fpath)
+        all_kmer_sets.append(kmers)
+        all_counts_list.append(counts)
 
     calc_count_stats(all_counts_list)
-    calc_kmer_stats(all_kmer_sets)
+    presence = presence_matrix(all_kmer_sets)
+    calc_kmer_stats(all_kmer_sets, presence)
+    if pairwise_dir is not None:
+        write_pairwise_matrices(presence, file_names, pairwise_dir, block_rows)
 
 
 def calc_count_stats(all_counts_list):
@@ -49,27 +86,45 @@ def calc_count_stats(all_counts_list):
     print("average kmer count: ", overall_ave)
 
 
-def calc_kmer_stats(all_kmer_sets):
+def presence_matrix(all_kmer_sets):
+    """
+    csr matrix with a 1 where sample (row) has kmer (column). int32 so that products of it
+    count the shared kmers without overflowing.
+    """
+    vocab = {}  # kmer -> column
+    indptr = [0]
+    indices = []
+    for kmer_set in all_kmer_sets:
+        indices.append(np.fromiter((vocab.setdefault(kmer, len(vocab)) for kmer in kmer_set),
+                                   dtype=np.int64, count=len(kmer_set)))
+        indptr.append(indptr[-1] + len(kmer_set))
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    return scipy.sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, np.array(indptr, dtype=np.int64)),
+                                   shape=(len(all_kmer_sets), len(vocab)))
+
+
+def calc_kmer_stats(all_kmer_sets, presence=None):
     """
     find other kmer counting statistics
     """
-    # find the average pairwise intersection length
-    intersection_lens = []
-    
-    for kmer_set_1, kmer_set_2 in combinations(all_kmer_sets, 2):
-        intersection = kmer_set_1 & kmer_set_2
-        intersection_lens.append(len(intersection))
-    
-    avg_intersection_len = sum(intersection_lens) / len(intersection_lens)
+    if presence is None:
+        presence = presence_matrix(all_kmer_sets)
+
+    # find the average pairwise intersection length: every kmer that c samples have is in
+    # c * (c - 1) / 2 of the pairwise intersections
+    samples_per_kmer = np.bincount(presence.indices, minlength=presence.shape[1]).astype(np.int64)
+    n_pairs = len(all_kmer_sets) * (len(all_kmer_sets) - 1) // 2
+    avg_intersection_len = int((samples_per_kmer * (samples_per_kmer - 1) // 2).sum()) / n_pairs
     print("average pairwise intersection length: ", avg_intersection_len)
 
     # find the length of the intersection between all kmer sets
-    intersection = all_kmer_sets[0]
+    # (a copy, so the first sample's set is still whole for the average below)
+    intersection = set(all_kmer_sets[0])
     intersection_increments = []
     for kmer_set in all_kmer_sets[1:]:
         intersection &= kmer_set
         intersection_increments.append(len(intersection))
-    
+
     print("number of kmers all files have in common: ", len(intersection))
     with open('intersection_increments.txt', 'w') as f:
         for item in intersection_increments:
@@ -81,15 +136,176 @@ def calc_kmer_stats(all_kmer_sets):
 
     print("average number of kmers: ", ave_len)
 
-    unique_kmers = set().union(*all_kmer_sets)
-    print("number of feature matrix columns: ", len(unique_kmers))
-    
+    print("number of feature matrix columns: ", presence.shape[1])
+
+
+def pairwise_blocks(presence, block_rows=DEFAULT_BLOCK_ROWS):
+    """yields (start, rows start:start+block_rows of presence . presence.T as a dense array)"""
+    presence_t = presence.T.tocsc()
+    for start in range(0, presence.shape[0], block_rows):
+        yield start, (presence[start : start + block_rows] @ presence_t).toarray()
+
+
+def write_pairwise_matrices(presence, file_names, out_dir, block_rows=DEFAULT_BLOCK_ROWS):
+    """writes the pairwise intersection, jaccard and containment matrices of all the samples"""
+    os.makedirs(out_dir, exist_ok=True)
+    n = presence.shape[0]
+    sizes = np.diff(presence.indptr).astype(np.float64)
+    outputs = {
+        name: np.lib.format.open_memmap(os.path.join(out_dir, f"pairwise_{name}.npy"), mode="w+",
+                                        dtype=dtype, shape=(n, n))
+        for name, dtype in [("intersection", np.int32), ("jaccard", np.float32), ("containment", np.float32)]
+    }
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start, block in pairwise_blocks(presence, block_rows):
+            end = start + block.shape[0]
+            outputs["intersection"][start:end] = block
+            union = sizes[start:end, None] + sizes[None, :] - block
+            outputs["jaccard"][start:end] = np.where(union > 0, block / union, 0)
+            outputs["containment"][start:end] = np.where(sizes[start:end, None] > 0, block / sizes[start:end, None], 0)
+    for matrix in outputs.values():
+        matrix.flush()
+    with open(os.path.join(out_dir, "pairwise_row_fnames.txt"), 'w') as f:
+        for fname in file_names:
+            f.write(fname + "\n")
+    print(f"wrote the pairwise intersection/jaccard/containment matrices ({n} x {n}) to {out_dir}")
+
+
+def _mix64(x):
+    """splitmix64 finalizer: spreads 2-bit kmers (which aren't random at all) over all 64 bits"""
+    x = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(x):
+    """bit length of each uint64, exactly (frexp on each 32-bit half)"""
+    hi = (x >> np.uint64(32)).astype(np.float64)
+    lo = (x & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(hi > 0, 32 + np.frexp(hi)[1], np.frexp(lo)[1])
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality estimate of a stream of 64-bit hashes"""
+
+    def __init__(self, precision=DEFAULT_HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(2**precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        bucket = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest_bits = 64 - self.precision
+        rest = hashes & np.uint64(2**rest_bits - 1)
+        # position of the first 1 bit in the rest of the hash
+        rank = (rest_bits - _bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, bucket, rank)
+
+    def cardinality(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        n_zero = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and n_zero:
+            # small cardinalities: linear counting is more accurate
+            estimate = m * np.log(m / n_zero)
+        return estimate
+
+
+def calc_stats_streaming(directory_path, report_every=100, hll_precision=DEFAULT_HLL_PRECISION):
+    """
+    same statistics as calc_stats (except the average pairwise intersection), in one pass over
+    the sketches in bounded memory
+    """
+    file_names = sketch_io.list_sketch_files(directory_path)
+    sum_of_averages = 0.0
+    n_counted = 0
+    total_kmers = 0
+    histogram = np.zeros(0, dtype=np.int64)
+    union = HyperLogLog(hll_precision)
+    core_index = None
+    core = None
+    other_core = None
+    intersection_increments = []
+
+    start = time.time()
+    n_bytes = 0
+    for i, fname in enumerate(file_names, start=1):
+        fpath = os.path.join(directory_path, fname)
+        n_bytes += os.path.getsize(fpath)
+        kmers, counts, ksize, other_kmers, other_counts = sketch_io.load_kmer_array(fpath)
+        counts = np.concatenate([counts, other_counts]).astype(np.int64)
+        other_kmers = [kmer.decode("ascii") for kmer in other_kmers.tolist()]
+
+        if len(counts):
+            sum_of_averages += counts.mean()
+            n_counted += 1
+            file_histogram = np.bincount(counts)
+            if len(file_histogram) > len(histogram):
+                histogram = np.concatenate([histogram, np.zeros(len(file_histogram) - len(histogram), dtype=np.int64)])
+            histogram[: len(file_histogram)] += file_histogram
+        total_kmers += len(counts)
+        union.add_hashes(_mix64(kmers))
+        if other_kmers:
+            union.add_hashes(sketch_io.hash_kmer_strings(other_kmers, ksize)[0])
+
+        if core_index is None:
+            core_index = column_index.index_from_kmers(np.unique(kmers), ksize)
+            core = np.ones(len(core_index), dtype=bool)
+            other_core = set(other_kmers)
+        else:
+            in_file = np.zeros(len(core_index), dtype=bool)
+            cols = core_index.lookup(kmers)
+            in_file[cols[cols >= 0]] = True
+            core &= in_file
+            other_core &= set(other_kmers)
+            intersection_increments.append(int(core.sum()) + len(other_core))
+
+        if i % report_every == 0 or i == len(file_names):
+            elapsed = max(time.time() - start, 1e-9)
+            print(f"[{i}/{len(file_names)}] {i / elapsed:.1f} files/s, {n_bytes / 1e6 / elapsed:.1f} MB/s, "
+                  f"{total_kmers / elapsed:.0f} kmers/s")
+
+    print("average kmer count: ", sum_of_averages / n_counted)
+    print("number of kmers all files have in common: ", 0 if core is None else int(core.sum()) + len(other_core))
+    with open('intersection_increments.txt', 'w') as f:
+        for item in intersection_increments:
+            f.write(f"{item}\n")
+    with open('count_histogram.txt', 'w') as f:
+        f.write("count\tkmers\n")
+        for count in np.flatnonzero(histogram):
+            f.write(f"{count}\t{histogram[count]}\n")
+    print("average number of kmers: ", total_kmers / len(file_names))
+    print("number of feature matrix columns (HyperLogLog estimate): ", round(union.cardinality()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="kmer counting statistics of a directory of sketches")
+    parser.add_argument("directory", type=str, help="directory with the adapted_sourmash output")
+    parser.add_argument("--pairwise", type=str, default=None, metavar="OUT_DIR",
+                        help="also write the full pairwise intersection/jaccard/containment matrices to OUT_DIR")
+    parser.add_argument("--block_rows", type=int, default=DEFAULT_BLOCK_ROWS,
+                        help=f"rows of the pairwise matrices computed at a time (default {DEFAULT_BLOCK_ROWS})")
+    parser.add_argument("--streaming", action="store_true",
+                        help="one pass over the sketches in bounded memory, with the number of distinct kmers "
+                             "estimated (ksize <= 32)")
+    parser.add_argument("--report_every", type=int, default=100,
+                        help="with --streaming, print the throughput every this many files (default 100)")
+    parser.add_argument("--hll_precision", type=int, default=DEFAULT_HLL_PRECISION,
+                        help=f"with --streaming, HyperLogLog precision (default {DEFAULT_HLL_PRECISION})")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    dir_path = sys.argv[1]
+    args = parse_args()
+    dir_path = args.directory
 
     if not os.path.isdir(dir_path):
         print(f"not valid directory")
         sys.exit(1)
 
-    calc_stats(dir_path)
+    if args.streaming:
+        calc_stats_streaming(dir_path, args.report_every, args.hll_precision)
+    else:
+        calc_stats(dir_path, args.pairwise, args.block_rows)
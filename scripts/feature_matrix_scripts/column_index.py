@@ -0,0 +1,272 @@
+import os
+import struct
+import argparse
+
+import numpy as np
+
+import kmer_hashing
+import kmer_vocabulary
+
+"""
+Compact index of the feature matrix columns (column_kmers.txt), for looking kmers up without
+parsing the text file into a list/set of strings every time.
+
+The kmers are stored 2-bit encoded (uint64, see kmer_hashing.py) and sorted, so a lookup is a
+vectorized binary search (np.searchsorted). column_kmers.txt is normally already sorted (that's
+the column order aggregate_adapted_sourmash_results.py uses), and then the position in the
+sorted array is the column; if it isn't, the column of each sorted kmer is stored too.
+Columns that can't be 2-bit encoded (kmers longer than 32, or with other characters than ACGT)
+are looked up the same way as fixed width byte strings instead, read from the text file only
+(there's no .kidx for them).
+
+An index file (.kidx) is
+    64 byte header: magic, format version, ksize, number of columns, offsets of the two arrays,
+                    size and mtime (ns) of the column_kmers.txt it was built from (0 if none)
+    kmers           n_columns uint64, sorted
+    columns         n_columns int64, the column of each sorted kmer (only if the columns aren't sorted)
+and is opened with np.memmap, so loading it doesn't read anything until it's used.
+
+    index = column_index.load_column_index("column_kmers.kidx")   # or a column_kmers.txt
+    path = column_index.find_column_index("column_kmers.txt")    # its .kidx, if the text file hasn't changed since
+    cols = index.lookup(kmers)    # 2-bit uint64 kmers or strings -> column, -1 if not a column
+
+Usage:
+python column_index.py build column_kmers.txt [-o column_kmers.kidx]
+python column_index.py text column_kmers.kidx [-o column_kmers.txt]
+"""
+
+FORMAT_VERSION = 2
+INDEX_EXTENSION = ".kidx"
+INDEX_MAGIC = b"KMERIDX\x00"
+# magic, version, ksize, n_columns, kmers offset, columns offset, text file size, text file mtime_ns
+# (version 1 had 16 zero bytes where the text file's size and mtime are)
+INDEX_HEADER = struct.Struct("<8sQQQQQQq")
+INDEX_DATA_OFFSET = 64
+TEXT_CHUNK = 2**20
+
+
+class ColumnIndex:
+    """
+    the columns of a feature matrix. `kmers` are the sorted 2-bit kmers (or S<ksize> byte strings, see
+    two_bit), `columns` the column of each (None when that's just 0, 1, 2, ..., i.e. the columns are
+    in sorted order).
+    """
+
+    def __init__(self, kmers, columns, ksize):
+        self.kmers = kmers
+        self.columns = columns
+        self.ksize = ksize
+
+    def __len__(self):
+        return len(self.kmers)
+
+    @property
+    def two_bit(self):
+        """False if the kmers are byte strings"""
+        return self.kmers.dtype.kind != "S"
+
+    def _query(self, kmers):
+        """kmers in the form of self.kmers, and which of them can be columns at all"""
+        if isinstance(kmers, np.ndarray) and kmers.dtype == np.uint64:
+            if self.two_bit:
+                return kmers, np.ones(len(kmers), dtype=bool)
+            kmers = kmer_hashing.kmers_to_bytes(kmers, self.ksize)
+        if not self.two_bit:
+            kmers = np.asarray(kmers, dtype="S") if len(kmers) else np.zeros(0, dtype=self.kmers.dtype)
+            return kmers, np.ones(len(kmers), dtype=bool)
+        kmers = list(kmers)
+        try:
+            return kmer_hashing.strings_to_kmers(kmers, self.ksize), np.ones(len(kmers), dtype=bool)
+        except ValueError:
+            # kmers with other characters than ACGT (or of another length) can't be 2-bit columns
+            valid = np.array([len(kmer) == self.ksize and not kmer.strip("ACGT") for kmer in kmers], dtype=bool)
+            encoded = np.zeros(len(kmers), dtype=np.uint64)
+            encoded[valid] = kmer_hashing.strings_to_kmers([kmers[i] for i in np.flatnonzero(valid)], self.ksize)
+            return encoded, valid
+
+    def lookup(self, kmers):
+        """column of each kmer (2-bit uint64 array, or a list of strings), -1 for kmers that aren't columns"""
+        kmers, valid = self._query(kmers)
+        pos, found = kmer_vocabulary.column_indices(self.kmers, kmers)
+        found &= valid
+        cols = np.full(len(kmers), -1, dtype=np.int64)
+        cols[found] = pos[found] if self.columns is None else self.columns[pos[found]]
+        return cols
+
+    def column_kmers(self):
+        """the kmers in column order"""
+        if self.columns is None:
+            return self.kmers
+        in_order = np.empty(len(self.kmers), dtype=self.kmers.dtype)
+        in_order[self.columns] = self.kmers
+        return in_order
+
+    def column_bytes(self):
+        """the kmers in column order as fixed width byte strings (S<ksize>)"""
+        if not self.two_bit:
+            return np.asarray(self.column_kmers())
+        return kmer_hashing.kmers_to_bytes(np.asarray(self.column_kmers()), self.ksize)
+
+    def column_strings(self, start=0, stop=None):
+        """the kmers of columns start:stop as strings"""
+        if not self.two_bit:
+            return [kmer.decode("ascii") for kmer in np.asarray(self.column_kmers()[start:stop]).tolist()]
+        return kmer_hashing.kmers_to_strings(np.asarray(self.column_kmers()[start:stop]), self.ksize)
+
+
+def index_from_kmers(kmers, ksize):
+    """ColumnIndex from the kmers in column order (2-bit, or S<ksize> byte strings)"""
+    kmers = np.asarray(kmers)
+    if kmers.dtype.kind != "S":
+        kmers = kmers.astype(np.uint64, copy=False)
+    if np.all(kmers[1:] > kmers[:-1]):
+        return ColumnIndex(kmers, None, ksize)
+    order = np.argsort(kmers, kind="stable")
+    sorted_kmers = kmers[order]
+    if np.any(sorted_kmers[1:] == sorted_kmers[:-1]):
+        raise ValueError("the column kmers aren't unique")
+    return ColumnIndex(sorted_kmers, order, ksize)
+
+
+def read_column_kmers_text(path):
+    """
+    column_kmers.txt -> (kmers in column order, ksize), parsed a chunk of lines at a time. the kmers
+    are 2-bit encoded, or S<ksize> byte strings if any of them can't be (longer than 32 bases, or
+    other characters than ACGT)
+    """
+    chunks = []
+    ksize = None
+    two_bit = True
+    with open(path) as f:
+        while True:
+            lines = [line.strip() for line in f.readlines(TEXT_CHUNK)]
+            lines = [line for line in lines if line]
+            if not lines:
+                break
+            if ksize is None:
+                ksize = len(lines[0])
+                two_bit = ksize <= kmer_hashing.MAX_KSIZE
+            if two_bit:
+                try:
+                    chunks.append(kmer_hashing.strings_to_kmers(lines, ksize))
+                    continue
+                except ValueError:
+                    two_bit = False
+                    chunks = [kmer_hashing.kmers_to_bytes(chunk, ksize) for chunk in chunks]
+            if any(len(line) != ksize for line in lines):
+                raise ValueError(f"{path}: all kmers must have length {ksize}")
+            chunks.append(np.array(lines, dtype=f"S{ksize}"))
+    if not chunks:
+        return np.zeros(0, dtype=np.uint64), 0
+    return np.concatenate(chunks), ksize
+
+
+def write_column_index(index, out_path, text_path=None):
+    """
+    writes the .kidx of an index. text_path is the column_kmers.txt it was made from (already
+    written), whose size and mtime go in the header for find_column_index
+    """
+    if not index.two_bit:
+        raise ValueError("only 2-bit kmers (ksize <= 32, ACGT only) can go in a .kidx")
+    n = len(index)
+    kmers_offset = INDEX_DATA_OFFSET
+    columns_offset = 0 if index.columns is None else kmers_offset + 8 * n
+    text_stat = os.stat(text_path) if text_path is not None else None
+    text_size, text_mtime_ns = (text_stat.st_size, text_stat.st_mtime_ns) if text_stat else (0, 0)
+    with open(out_path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, FORMAT_VERSION, index.ksize, n, kmers_offset, columns_offset,
+                                  text_size, text_mtime_ns))
+        f.write(np.asarray(index.kmers, dtype="<u8").tobytes())
+        if index.columns is not None:
+            f.write(np.asarray(index.columns, dtype="<i8").tobytes())
+
+
+def _memmap(path, dtype, offset, n):
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(n,))
+
+
+def _read_header(path):
+    """
+    (version, ksize, number of columns, kmers offset, columns offset, text file size, text file
+    mtime_ns) of a .kidx file
+    """
+    with open(path, "rb") as f:
+        magic, *fields = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+    if magic != INDEX_MAGIC:
+        raise ValueError(f"{path} isn't a kmer column index")
+    if fields[0] > FORMAT_VERSION:
+        raise ValueError(f"{path} was written by a newer version of column_index.py")
+    return tuple(fields)
+
+
+def load_column_index(path):
+    """opens a .kidx file (memory mapped), or reads a column_kmers.txt"""
+    if not path.endswith(INDEX_EXTENSION):
+        return index_from_kmers(*read_column_kmers_text(path))
+    _, ksize, n, kmers_offset, columns_offset, _, _ = _read_header(path)
+    columns = _memmap(path, np.int64, columns_offset, n) if columns_offset else None
+    return ColumnIndex(_memmap(path, np.uint64, kmers_offset, n), columns, ksize)
+
+
+def write_column_kmers_text(index, out_path, chunk_size=TEXT_CHUNK):
+    with open(out_path, "w") as f:
+        for start in range(0, len(index), chunk_size):
+            for kmer in index.column_strings(start, start + chunk_size):
+                f.write(kmer + "\n")
+
+
+def index_path(text_path):
+    return os.path.splitext(text_path)[0] + INDEX_EXTENSION
+
+
+def find_column_index(path):
+    """
+    the path to load the columns of `path` from: the .kidx next to a column_kmers.txt if the text
+    file still has the size and mtime recorded in the index when it was built, otherwise `path`
+    itself (so a column_kmers.txt that was changed or replaced after its index was built is read
+    as text). only the two files' headers/metadata are read.
+    """
+    kidx = index_path(path)
+    if path.endswith(INDEX_EXTENSION) or not os.path.exists(kidx):
+        return path
+    version, _, _, _, _, text_size, text_mtime_ns = _read_header(kidx)
+    if version < 2:
+        print(f"not using {kidx}: it doesn't say which {os.path.basename(path)} it was built from "
+              f"(rebuild it with python column_index.py build {path})")
+        return path
+    text_stat = os.stat(path)
+    if (text_stat.st_size, text_stat.st_mtime_ns) != (text_size, text_mtime_ns):
+        print(f"not using {kidx}: {path} has changed since it was built")
+        return path
+    return kidx
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="convert between column_kmers.txt and the binary column index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="column_kmers.txt -> .kidx")
+    build.add_argument("text", type=str, help="column_kmers.txt")
+    build.add_argument("-o", "--output", type=str, default=None, help="output index (default: next to the input)")
+    text = subparsers.add_parser("text", help=".kidx -> column_kmers.txt")
+    text.add_argument("index", type=str, help=".kidx file")
+    text.add_argument("-o", "--output", type=str, default=None, help="output text file (default: next to the input)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "build":
+        out_path = index_path(args.text) if args.output is None else args.output
+        index = load_column_index(args.text)
+        write_column_index(index, out_path, args.text)
+        print(f"{args.text} -> {out_path} ({len(index)} columns, ksize {index.ksize})")
+    elif args.command == "text":
+        out_path = os.path.splitext(args.index)[0] + ".txt" if args.output is None else args.output
+        write_column_kmers_text(load_column_index(args.index), out_path)
+        print(f"{args.index} -> {out_path}")
+
+
+if __name__ == "__main__":
+    main()
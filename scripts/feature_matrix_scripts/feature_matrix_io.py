@@ -0,0 +1,272 @@
+import os
+import json
+import struct
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse
+
+"""
+Reading and writing the (unnormalized) feature matrix that aggregate_adapted_sourmash_results.py makes.
+
+There are three formats, picked by the file extension:
+    csv (.csv):    what aggregate_adapted_sourmash_results.py has always written, a headerless csv of
+                   ints, with the row names and column kmers in row_fnames.txt/column_kmers.txt next
+                   to it. np.loadtxt on it is slow and needs several times the size of the matrix.
+    sparse (.npz): numpy .npz of the CSR arrays (data uint32, indices, indptr) plus shape, row_names
+                   and column_kmers. the matrix is mostly zeros, so this is by far the smallest, but
+                   it has to be read whole (the rows are sliced after loading).
+    dense (.fm):   the dense matrix, row major, as raw uint32 at a fixed offset, so it can be opened
+                   with np.memmap: loading is zero-copy, and a row range only reads those rows.
+                   the layout is
+                        64 byte header: magic, format version, n_rows, n_columns, kmer width,
+                                        offsets of the column kmers and row names, dtype
+                        data            n_rows x n_columns, starting at byte 64
+                        column kmers    fixed width ascii (dtype S<kmer width>)
+                        row names       json list
+                   it's written one row at a time, so it never has to be in memory.
+
+load_feature_matrix() takes any of them and returns a FeatureMatrix; use `start`/`stop` to only get
+a range of rows, and dense() to get an ndarray out of either kind of matrix.
+
+Usage (convert an existing csv):
+python feature_matrix_io.py convert feature_matrix_not_normalized.csv -o feature_matrix_not_normalized.npz [--row_fnames row_fnames.txt] [--column_kmers column_kmers.txt]
+"""
+
+FORMAT_VERSION = 1
+CSV_EXTENSION = ".csv"
+SPARSE_EXTENSION = ".npz"
+DENSE_EXTENSION = ".fm"
+FORMATS = {"csv": CSV_EXTENSION, "npz": SPARSE_EXTENSION, "dense": DENSE_EXTENSION}
+
+DENSE_MAGIC = b"KMERFM\x00\x00"
+DENSE_HEADER = struct.Struct("<8sQQQQQQ8s")  # magic, version, n_rows, n_columns, kmer width, columns/names offset, dtype
+DENSE_DATA_OFFSET = 64
+COUNT_DTYPE = np.uint32
+
+FeatureMatrix = namedtuple("FeatureMatrix", ["matrix", "row_names", "column_kmers"])
+FeatureMatrix.__doc__ = """
+`matrix` is a scipy CSR matrix (.npz), a read-only np.memmap (.fm) or an ndarray (.csv).
+`row_names` and `column_kmers` are lists of str.
+"""
+
+
+def matrix_path(directory, out_format, name="feature_matrix_not_normalized"):
+    return os.path.join(directory, name + FORMATS[out_format])
+
+
+def write_csv_row(csvfile, zeros, cols, counts):
+    # same layout csv.writer gave the dense version: comma separated ints, \r\n line endings.
+    # the row starts as all "0"s and only the nonzero cells get formatted
+    row = zeros.copy()
+    for j, value in zip(cols.tolist(), counts.tolist()):
+        row[j] = str(value)
+    csvfile.write(",".join(row) + "\r\n")
+
+
+def _as_kmer_bytes(column_kmers):
+    """list of str (or an S array) -> fixed width S array"""
+    if isinstance(column_kmers, np.ndarray) and column_kmers.dtype.kind == "S":
+        return column_kmers
+    return np.array([kmer.encode("ascii") for kmer in column_kmers], dtype=bytes)
+
+
+class FeatureMatrixWriter:
+    """
+    writes a feature matrix one row at a time: write_row(cols, counts) for each row in order (the
+    nonzero columns and their counts), then close(row_names, column_kmers). column_kmers can be a
+    list of str or an S array (see kmer_hashing.kmers_to_bytes). for .csv the names aren't stored,
+    they go in row_fnames.txt/column_kmers.txt as before.
+    """
+
+    def __init__(self, path, n_rows, n_columns):
+        self.path = path
+        self.n_rows = n_rows
+        self.n_columns = n_columns
+        self.row = 0
+        if path.endswith(CSV_EXTENSION):
+            self.file = open(path, "w", newline="")
+            self.zeros = ["0"] * n_columns
+        elif path.endswith(SPARSE_EXTENSION):
+            self.indices = []
+            self.data = []
+        elif path.endswith(DENSE_EXTENSION):
+            self.file = open(path, "w+b")
+            self.file.truncate(DENSE_DATA_OFFSET + n_rows * n_columns * np.dtype(COUNT_DTYPE).itemsize)
+            self.data = None
+            if n_rows * n_columns:
+                self.data = np.memmap(self.file, dtype=COUNT_DTYPE, mode="r+", offset=DENSE_DATA_OFFSET,
+                                      shape=(n_rows, n_columns))
+        else:
+            raise ValueError(f"unknown feature matrix format: {path} (use {', '.join(FORMATS.values())})")
+
+    def write_row(self, cols, counts):
+        if self.path.endswith(CSV_EXTENSION):
+            write_csv_row(self.file, self.zeros, cols, counts)
+        elif self.path.endswith(SPARSE_EXTENSION):
+            self.indices.append(np.asarray(cols, dtype=np.int64))
+            self.data.append(np.asarray(counts, dtype=COUNT_DTYPE))
+        else:
+            self.data[self.row, cols] = counts
+        self.row += 1
+
+    def write_rows(self, matrix):
+        """writes every row of a scipy sparse matrix"""
+        matrix = matrix.tocsr()
+        for i in range(matrix.shape[0]):
+            start, end = matrix.indptr[i], matrix.indptr[i + 1]
+            self.write_row(matrix.indices[start:end], matrix.data[start:end])
+
+    def close(self, row_names, column_kmers):
+        if self.row != self.n_rows:
+            raise ValueError(f"{self.path}: {self.row} rows were written, expected {self.n_rows}")
+        if self.path.endswith(CSV_EXTENSION):
+            self.file.close()
+        elif self.path.endswith(SPARSE_EXTENSION):
+            indptr = np.zeros(self.n_rows + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum([len(cols) for cols in self.indices])
+            index_dtype = np.int32 if self.n_columns < 2**31 else np.int64
+            arrays = {
+                "data": np.concatenate(self.data) if self.data else np.zeros(0, dtype=COUNT_DTYPE),
+                "indices": (np.concatenate(self.indices) if self.indices else np.zeros(0)).astype(index_dtype),
+                "indptr": indptr,
+                "shape": np.array([self.n_rows, self.n_columns], dtype=np.int64),
+                "row_names": np.array(row_names, dtype=str),
+                "column_kmers": _as_kmer_bytes(column_kmers),
+                "format_version": np.int64(FORMAT_VERSION),
+            }
+            # np.savez adds .npz to the name if it isn't there, so write through a file handle instead
+            with open(self.path, "wb") as f:
+                np.savez_compressed(f, **arrays)
+        else:
+            if self.data is not None:
+                self.data.flush()
+                del self.data
+            kmers = _as_kmer_bytes(column_kmers)
+            columns_offset = DENSE_DATA_OFFSET + self.n_rows * self.n_columns * np.dtype(COUNT_DTYPE).itemsize
+            names = json.dumps(list(row_names)).encode("utf-8")
+            self.file.seek(columns_offset)
+            self.file.write(kmers.tobytes())
+            names_offset = self.file.tell()
+            self.file.write(names)
+            self.file.seek(0)
+            self.file.write(DENSE_HEADER.pack(DENSE_MAGIC, FORMAT_VERSION, self.n_rows, self.n_columns,
+                                              kmers.dtype.itemsize, columns_offset, names_offset,
+                                              np.dtype(COUNT_DTYPE).str.encode("ascii")))
+            self.file.close()
+
+
+def write_feature_matrix(matrix, path, row_names, column_kmers):
+    """writes a whole scipy sparse matrix in the format of `path`"""
+    writer = FeatureMatrixWriter(path, matrix.shape[0], matrix.shape[1])
+    writer.write_rows(matrix)
+    writer.close(row_names, column_kmers)
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def _read_dense_header(path):
+    with open(path, "rb") as f:
+        magic, version, n_rows, n_columns, width, columns_offset, names_offset, dtype = \
+            DENSE_HEADER.unpack(f.read(DENSE_HEADER.size))
+        if magic != DENSE_MAGIC:
+            raise ValueError(f"{path} isn't a dense feature matrix file")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"{path} was written by a newer version of feature_matrix_io.py")
+        f.seek(columns_offset)
+        kmers = np.frombuffer(f.read(n_columns * width), dtype=f"S{max(width, 1)}") if width else np.zeros(0, "S1")
+        f.seek(names_offset)
+        row_names = json.loads(f.read().decode("utf-8"))
+    return n_rows, n_columns, np.dtype(dtype.rstrip(b"\x00").decode("ascii")), row_names, kmers
+
+
+def load_feature_matrix(path, start=0, stop=None):
+    """
+    loads a feature matrix in any of the formats, only rows start:stop if given.
+    a .csv is read with its row_fnames.txt/column_kmers.txt if they're next to it (else the names are None).
+    """
+    if path.endswith(SPARSE_EXTENSION):
+        with np.load(path) as npz:
+            if int(npz["format_version"]) > FORMAT_VERSION:
+                raise ValueError(f"{path} was written by a newer version of feature_matrix_io.py")
+            matrix = scipy.sparse.csr_matrix((npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"]))
+            row_names = npz["row_names"].tolist()
+            column_kmers = [kmer.decode("ascii") for kmer in npz["column_kmers"].tolist()]
+        if start != 0 or stop is not None:
+            matrix = matrix[start:stop]
+        return FeatureMatrix(matrix, row_names[start:stop], column_kmers)
+    if path.endswith(DENSE_EXTENSION):
+        n_rows, n_columns, dtype, row_names, kmers = _read_dense_header(path)
+        if n_rows * n_columns:
+            matrix = np.memmap(path, dtype=dtype, mode="r", offset=DENSE_DATA_OFFSET, shape=(n_rows, n_columns))
+        else:
+            matrix = np.zeros((n_rows, n_columns), dtype=dtype)
+        return FeatureMatrix(matrix[start:stop], row_names[start:stop], [kmer.decode("ascii") for kmer in kmers.tolist()])
+    if path.endswith(CSV_EXTENSION):
+        directory = os.path.dirname(path)
+        row_fnames = os.path.join(directory, "row_fnames.txt")
+        column_kmers = os.path.join(directory, "column_kmers.txt")
+        row_names = _read_lines(row_fnames) if os.path.exists(row_fnames) else None
+        matrix = np.array([[int(x) for x in line.split(",")] if line.strip() else []
+                           for line in _read_lines(path)[start:stop]], dtype=COUNT_DTYPE)
+        return FeatureMatrix(matrix, None if row_names is None else row_names[start:stop],
+                             _read_lines(column_kmers) if os.path.exists(column_kmers) else None)
+    raise ValueError(f"unknown feature matrix format: {path} (use {', '.join(FORMATS.values())})")
+
+
+def dense(matrix, dtype=None):
+    """the matrix of a FeatureMatrix as an ndarray (a memmap stays a memmap unless dtype changes it)"""
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.toarray()
+    return matrix if dtype is None else np.asarray(matrix, dtype=dtype)
+
+
+def iter_row_chunks(path, chunk_rows=1024, dtype=np.float32):
+    """yields (row_names, dense rows) chunk by chunk. for a .fm file only one chunk is read at a time."""
+    fm = load_feature_matrix(path)
+    for start in range(0, fm.matrix.shape[0], chunk_rows):
+        yield fm.row_names[start : start + chunk_rows], dense(fm.matrix[start : start + chunk_rows], dtype)
+
+
+def convert_csv(csv_path, out_path, row_fnames=None, column_kmers=None):
+    """converts a feature matrix csv (with its row_fnames.txt and column_kmers.txt) one row at a time"""
+    directory = os.path.dirname(csv_path)
+    row_names = _read_lines(row_fnames or os.path.join(directory, "row_fnames.txt"))
+    kmers = _read_lines(column_kmers or os.path.join(directory, "column_kmers.txt"))
+    writer = FeatureMatrixWriter(out_path, len(row_names), len(kmers))
+    with open(csv_path) as f:
+        for line in f:
+            row = np.array(line.rstrip().split(","), dtype=np.int64) if len(kmers) else np.zeros(0, dtype=np.int64)
+            if len(row) != len(kmers):
+                raise ValueError(f"{csv_path} row {writer.row} has {len(row)} columns, expected {len(kmers)}")
+            cols = np.flatnonzero(row)
+            writer.write_row(cols, row[cols])
+    writer.close(row_names, kmers)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="feature matrix file utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="convert a feature matrix csv to .npz (sparse) or .fm (dense)")
+    convert.add_argument("csv", type=str, help="feature matrix csv")
+    convert.add_argument("-o", "--output", type=str, required=True, help="output file (.npz or .fm)")
+    convert.add_argument("--row_fnames", type=str, default=None,
+                         help="row names of the csv (default: row_fnames.txt next to it)")
+    convert.add_argument("--column_kmers", type=str, default=None,
+                         help="column kmers of the csv (default: column_kmers.txt next to it)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "convert":
+        convert_csv(args.csv, args.output, args.row_fnames, args.column_kmers)
+        print(f"{args.csv} -> {args.output} ({os.path.getsize(args.csv)} -> {os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import math
+
+import numpy as np
+
+"""
+Vectorized versions of the pieces of adapted_sourmash.hash_kmer, so that a whole
+sequence can be hashed with a handful of numpy operations instead of one python
+call per kmer:
+    1) 2-bit encoding of the sequence (A=0, C=1, G=2, T=3)
+    2) the forward and reverse-complement kmer of every window, and the canonical
+       (lesser) one of the two. With this encoding comparing the integers gives the
+       same answer as comparing the strings.
+    3) MurmurHash3 (x64, 128-bit, first 64 bits) of the canonical kmer's ascii
+       bytes, which is exactly what mmh3.hash64(canonical_kmer, seed)[0] computes.
+
+Only windows made up entirely of uppercase A/C/G/T are handled here (this is
+everything in a MEGAHIT assembly). Windows containing anything else are flagged
+as invalid so the caller can hash them the slow way, and ksize must be <= 32 so
+each kmer fits in a single uint64.
+"""
+
+MAX_KSIZE = 32
+DEFAULT_SEED = 42
+
+# ascii -> 2-bit code. anything that isn't an uppercase A/C/G/T gets INVALID_CODE
+INVALID_CODE = 4
+BASE_CODES = np.full(256, INVALID_CODE, dtype=np.uint8)
+for _i, _b in enumerate(b"ACGT"):
+    BASE_CODES[_b] = _i
+CODE_TO_ASCII = np.frombuffer(b"ACGT", dtype=np.uint8).astype(np.uint64)
+ASCII_COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _b, _c in zip(b"ACGT", b"TGCA"):
+    ASCII_COMPLEMENT[_b] = _c
+
+_C1 = np.uint64(0x87c37b91114253d5)
+_C2 = np.uint64(0x4cf5ad432745937f)
+_FMIX1 = np.uint64(0xff51afd7ed558ccd)
+_FMIX2 = np.uint64(0xc4ceb9fe1a85ec53)
+
+
+def keep_below_int(keep_below):
+    """
+    adapted_sourmash keeps a kmer when `hash < 2**64 / scaled`, where the right
+    side is a float. For integer hashes that is the same as `hash < ceil(...)`,
+    which lets us compare in uint64 without rounding surprises.
+    """
+    return math.ceil(keep_below)
+
+
+def below_threshold(hashes, keep_below):
+    """hashes < keep_below for a uint64 array, where keep_below may be 2**64 itself."""
+    if keep_below > 2**64 - 1:
+        return np.ones(hashes.shape, dtype=bool)
+    return hashes < np.uint64(keep_below)
+
+
+def encode_sequence(sequence):
+    """sequence (str or bytes) -> np.uint8 array of 2-bit codes (INVALID_CODE for non-ACGT)."""
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii", errors="replace")
+    return BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def _packed_windows(codes, ksize):
+    """
+    2-bit value of every window of length ksize in `codes` (codes must all be in 0..3).
+    Built up by doubling (windows of 1, 2, 4, 8... bases) so it takes about
+    2*log2(ksize) array operations instead of ksize of them.
+    """
+    n_kmers = codes.shape[0] - ksize + 1
+    result = np.zeros(n_kmers, dtype=np.uint64)
+    width = 1
+    windows = codes.astype(np.uint64)
+    offset = 0
+    while True:
+        # use `windows` (length `width`) for the next piece of ksize if its bit is set
+        if ksize & width:
+            result <<= np.uint64(2 * width)
+            result |= windows[offset : offset + n_kmers]
+            offset += width
+        if width * 2 > ksize:
+            break
+        n = windows.shape[0] - width
+        windows = (windows[:n] << np.uint64(2 * width)) | windows[width : width + n]
+        width *= 2
+    return result
+
+
+def window_kmers(codes, ksize):
+    """
+    Takes an array of 2-bit codes and returns (forward, reverse_complement, valid),
+    three arrays with one entry per window of length ksize. `valid` is False for any
+    window that touches an INVALID_CODE.
+    """
+    if ksize > MAX_KSIZE:
+        raise ValueError(f"ksize must be <= {MAX_KSIZE} for the 2-bit batch path (got {ksize})")
+    n_kmers = codes.shape[0] - ksize + 1
+    if n_kmers <= 0:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, empty.copy(), np.zeros(0, dtype=bool)
+
+    invalid = codes == INVALID_CODE
+    bases = np.where(invalid, 0, codes).astype(np.uint8)
+
+    fwd = _packed_windows(bases, ksize)
+    # the reverse complement of window i is window (n_kmers - 1 - i) of the
+    # reverse-complemented sequence
+    rc = _packed_windows((3 - bases)[::-1], ksize)[::-1]
+
+    # a window is valid if the running count of invalid bases doesn't change across it
+    n_invalid = np.concatenate(([0], np.cumsum(invalid, dtype=np.int64)))
+    valid = n_invalid[ksize:] == n_invalid[:n_kmers]
+    return fwd, rc, valid
+
+
+def kmers_to_bytes(kmers, ksize):
+    """2-bit uint64 kmers -> numpy array of fixed width ascii strings (dtype S<ksize>)."""
+    kmers = np.asarray(kmers, dtype=np.uint64)
+    if ksize == 0:
+        # an empty sketch doesn't know its ksize
+        return np.zeros(kmers.shape[0], dtype="S1")
+    chars = np.empty((kmers.shape[0], ksize), dtype=np.uint8)
+    for j in range(ksize):
+        chars[:, j] = CODE_TO_ASCII[(kmers >> np.uint64(2 * (ksize - 1 - j))) & np.uint64(3)]
+    return chars.view(f"S{ksize}").ravel()
+
+
+def kmers_to_strings(kmers, ksize):
+    """2-bit uint64 kmers -> list of python strings."""
+    return [kmer.decode("ascii") for kmer in kmers_to_bytes(kmers, ksize).tolist()]
+
+
+def strings_to_kmers(kmer_strings, ksize):
+    """list of ACGT strings (all of length ksize) -> 2-bit uint64 kmers. Raises ValueError on other characters."""
+    if len(kmer_strings) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    raw = np.frombuffer("".join(kmer_strings).encode("ascii"), dtype=np.uint8)
+    if raw.shape[0] != ksize * len(kmer_strings):
+        raise ValueError(f"all kmers must have length {ksize}")
+    codes = BASE_CODES[raw].reshape(-1, ksize)
+    if np.any(codes == INVALID_CODE):
+        raise ValueError("kmers can only contain uppercase A/C/G/T")
+    kmers = np.zeros(codes.shape[0], dtype=np.uint64)
+    for j in range(ksize):
+        kmers <<= np.uint64(2)
+        kmers |= codes[:, j].astype(np.uint64)
+    return kmers
+
+
+def _rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _fmix64(k):
+    k ^= k >> np.uint64(33)
+    k *= _FMIX1
+    k ^= k >> np.uint64(33)
+    k *= _FMIX2
+    k ^= k >> np.uint64(33)
+    return k
+
+
+def _ascii_words(kmers, ksize):
+    """
+    Packs the ascii bytes of each kmer into little-endian uint64 words, i.e. the
+    same 8-byte blocks MurmurHash3 reads out of the string. Word i holds bytes
+    [8*i, 8*i + 8), zero padded at the end.
+    """
+    n_words = (ksize + 7) // 8
+    words = [np.zeros(kmers.shape[0], dtype=np.uint64) for _ in range(n_words)]
+    for j in range(ksize):
+        code = (kmers >> np.uint64(2 * (ksize - 1 - j))) & np.uint64(3)
+        words[j // 8] |= CODE_TO_ASCII[code] << np.uint64(8 * (j % 8))
+    return words
+
+
+def _murmurhash3_words(words, ksize, seed):
+    """MurmurHash3_x64_128 (first 64 bits) of ksize-byte keys given as little-endian uint64 words."""
+    h1 = np.full(words[0].shape[0], seed, dtype=np.uint64)
+    h2 = h1.copy()
+
+    n_blocks = ksize // 16
+    for b in range(n_blocks):
+        k1 = words[2 * b] * _C1
+        k1 = _rotl64(k1, 31)
+        k1 *= _C2
+        h1 ^= k1
+        h1 = _rotl64(h1, 27)
+        h1 += h2
+        h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+
+        k2 = words[2 * b + 1] * _C2
+        k2 = _rotl64(k2, 33)
+        k2 *= _C1
+        h2 ^= k2
+        h2 = _rotl64(h2, 31)
+        h2 += h1
+        h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+    # the tail is just whatever words are left over (already zero padded)
+    tail_len = ksize % 16
+    if tail_len > 8:
+        k2 = words[2 * n_blocks + 1] * _C2
+        k2 = _rotl64(k2, 33)
+        k2 *= _C1
+        h2 ^= k2
+    if tail_len > 0:
+        k1 = words[2 * n_blocks] * _C1
+        k1 = _rotl64(k1, 31)
+        k1 *= _C2
+        h1 ^= k1
+
+    h1 ^= np.uint64(ksize)
+    h2 ^= np.uint64(ksize)
+    h1 += h2
+    h2 += h1
+    h1 = _fmix64(h1)
+    h2 = _fmix64(h2)
+    h1 += h2
+    return h1
+
+
+def murmurhash3_x64_64(kmers, ksize, seed=DEFAULT_SEED):
+    """
+    MurmurHash3_x64_128 of the ascii string of each 2-bit kmer, returning the first
+    64 bits as uint64. Equal to mmh3.hash64(kmer_string, seed)[0] % 2**64.
+    """
+    kmers = np.asarray(kmers, dtype=np.uint64)
+    if len(kmers) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return _murmurhash3_words(_ascii_words(kmers, ksize), ksize, seed)
+
+
+def _window_ascii_words(raw, ksize, is_rc):
+    """
+    Same words as _ascii_words, but read straight out of the sequence bytes: the
+    forward kmer of window i is raw[i : i + ksize] and its reverse complement is a
+    window of the reverse-complemented sequence, so each word is one unaligned
+    8-byte read per window (plus picking forward or rc) instead of ksize lookups.
+    Only correct for windows of uppercase ACGT, which is all we use it for.
+    """
+    n_kmers = raw.shape[0] - ksize + 1
+    n_words = (ksize + 7) // 8
+    pad = np.zeros(8 * n_words, dtype=np.uint8)
+    fwd_buf = np.concatenate((raw, pad))
+    rc_buf = np.concatenate((ASCII_COMPLEMENT[raw][::-1], pad))
+    words = []
+    for w in range(n_words):
+        fwd_w = np.ndarray((n_kmers,), dtype="<u8", buffer=fwd_buf, offset=8 * w, strides=(1,))
+        rc_w = np.ndarray((n_kmers,), dtype="<u8", buffer=rc_buf, offset=8 * w, strides=(1,))[::-1]
+        word = np.where(is_rc, rc_w, fwd_w)
+        n_bytes = min(8, ksize - 8 * w)
+        if n_bytes < 8:
+            word &= np.uint64((1 << (8 * n_bytes)) - 1)
+        words.append(word)
+    return words
+
+
+def hash_sequence(sequence, ksize, seed=DEFAULT_SEED, codes=None):
+    """
+    Hashes every window of `sequence` at once. Returns (canonical, is_rc, hashes, valid):
+        canonical (np.uint64):  canonical 2-bit kmer of each window
+        is_rc (bool):           True where the canonical kmer is the reverse complement
+        hashes (np.uint64):     murmurhash of the canonical kmer (0 where not valid)
+        valid (bool):           False for windows that need to be hashed the slow way
+    `codes` is encode_sequence(sequence), if the caller already has it (e.g. when
+    hashing the same sequence with several ksizes).
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii", errors="replace")
+    raw = np.frombuffer(sequence, dtype=np.uint8)
+    if codes is None:
+        codes = BASE_CODES[raw]
+    fwd, rc, valid = window_kmers(codes, ksize)
+    is_rc = ~(fwd < rc)
+    canonical = np.where(is_rc, rc, fwd)
+    if canonical.shape[0] == 0:
+        return canonical, is_rc, canonical.copy(), valid
+    hashes = _murmurhash3_words(_window_ascii_words(raw, ksize, is_rc), ksize, seed)
+    hashes[~valid] = 0
+    return canonical, is_rc, hashes, valid
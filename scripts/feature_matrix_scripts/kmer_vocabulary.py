@@ -0,0 +1,466 @@
+import os
+import json
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+import kmer_hashing
+import sketch_io
+
+"""
+On-disk kmer vocabulary for a directory of sketches: every kmer that appears in any sketch,
+2-bit encoded (uint64, see kmer_hashing.py) and sorted, with its document frequency (the
+number of sketches it appears in). For kmers of the same length the 2-bit order is the same
+as the alphabetical order of the strings, so the vocabulary is already in the column order
+aggregate_adapted_sourmash_results.py uses, and the columns of the feature matrix are the
+kmers with df >= 2 (a df of 1 is a singleton).
+
+A vocabulary directory holds:
+    kmers.u64       every kmer, sorted (raw uint64)
+    df.u32          the document frequency of each kmer (raw uint32)
+    first_row.u32   the row (sample index) each kmer was first seen in, and its count there.
+    first_count.u32 for a singleton that's the only sample that has it, which is what lets
+                    append_to_vocabulary say which existing row has a value for a column that
+                    stops being a singleton
+    columns.u64     the kmers with df >= MIN_COLUMN_DF, i.e. the feature matrix columns
+    other_kmers.npz the same (kmers, df, first_row, first_count) for the kmers that can't be 2-bit
+                    encoded (ones that aren't plain ACGT, e.g. with an N), as S<ksize> strings
+    meta.json       ksize, number of kmers/columns/samples
+The raw arrays are opened with np.memmap, so looking kmers up doesn't need them in memory. The
+other kmers are few, so they are counted in memory and kept as a Vocabulary of their own
+(Vocabulary.other). Their columns sort in between the 2-bit ones (an N comes after A, C and G),
+and ColumnMap gives the feature matrix column of both kinds.
+
+build_vocabulary makes one out of core: the kmers of the sketches are split by their first
+bases into partition files on disk, flushing whenever the buffered kmers reach the memory
+budget, and each partition (split further if it's still too big) is counted on its own.
+Partitions cover consecutive ranges of kmers, so writing them out in order gives a sorted
+vocabulary.
+
+append_to_vocabulary adds a batch of new sketches to an existing vocabulary: only the new
+sketches are read, and the vocabulary files are rewritten once, sequentially, with the new
+kmers merged in.
+"""
+
+VOCAB_FORMAT_VERSION = 2
+MIN_COLUMN_DF = 2
+PARTITION_BITS = 8  # each split of a partition goes 8 bits (4 bases) further into the kmer
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+# what goes in the partition files: one record per (sketch, kmer)
+RECORD_DTYPE = np.dtype([("kmer", "<u8"), ("row", "<u4"), ("count", "<u4")])
+# the per-kmer arrays of a vocabulary directory: (field, file name, dtype)
+VOCAB_ARRAYS = [
+    ("kmers", "kmers.u64", np.uint64),
+    ("df", "df.u32", np.uint32),
+    ("first_row", "first_row.u32", np.uint32),
+    ("first_count", "first_count.u32", np.uint32),
+]
+COLUMNS_FILE = "columns.u64"
+OTHER_FILE = "other_kmers.npz"
+
+# an opened vocabulary directory (the arrays are memory mapped). `other` is the in-memory
+# Vocabulary of the kmers that aren't 2-bit (S<ksize> kmers and columns, its own `other` is None)
+Vocabulary = namedtuple("Vocabulary", ["kmers", "df", "first_row", "first_count", "columns", "ksize", "n_samples",
+                                       "other"], defaults=(None,))
+
+# the kmers that became columns in an append (sorted), with the existing row that has each one
+# (-1 if none: there can be at most one, or it would have been a column already) and its count there
+ColumnChanges = namedtuple("ColumnChanges", ["kmers", "old_row", "old_count"])
+
+
+def _memmap(path, dtype, n):
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(n,))
+
+
+def read_meta(vocab_dir):
+    with open(os.path.join(vocab_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["format_version"] > VOCAB_FORMAT_VERSION:
+        raise ValueError(f"{vocab_dir} was written by a newer version of kmer_vocabulary.py")
+    return meta
+
+
+def write_meta(vocab_dir, ksize, n_kmers, n_columns, n_samples):
+    with open(os.path.join(vocab_dir, "meta.json"), "w") as f:
+        json.dump({"format_version": VOCAB_FORMAT_VERSION, "ksize": ksize, "n_kmers": int(n_kmers),
+                   "n_columns": int(n_columns), "n_samples": int(n_samples)}, f, indent=1)
+
+
+def other_record_dtype(ksize):
+    """RECORD_DTYPE for the kmers that aren't 2-bit"""
+    return np.dtype([("kmer", f"S{max(ksize, 1)}"), ("row", "<u4"), ("count", "<u4")])
+
+
+def write_other_vocabulary(vocab_dir, kmers, df, first_row, first_count):
+    arrays = dict(zip([field for field, _, _ in VOCAB_ARRAYS], (kmers, df, first_row, first_count)))
+    with open(os.path.join(vocab_dir, OTHER_FILE), "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_other_vocabulary(vocab_dir, ksize, n_samples):
+    path = os.path.join(vocab_dir, OTHER_FILE)
+    if os.path.exists(path):
+        with np.load(path) as npz:
+            arrays = {field: npz[field] for field, _, _ in VOCAB_ARRAYS}
+    else:
+        # written before other kmers were kept
+        arrays = {field: np.zeros(0, dtype=dtype) for field, _, dtype in VOCAB_ARRAYS}
+        arrays["kmers"] = np.zeros(0, dtype=other_record_dtype(ksize)["kmer"])
+    columns = arrays["kmers"][arrays["df"] >= MIN_COLUMN_DF]
+    return Vocabulary(columns=columns, ksize=ksize, n_samples=n_samples, **arrays)
+
+
+def load_vocabulary(vocab_dir):
+    """opens a vocabulary directory (the arrays are memory mapped)"""
+    meta = read_meta(vocab_dir)
+    arrays = {field: _memmap(os.path.join(vocab_dir, fname), dtype, meta["n_kmers"])
+              for field, fname, dtype in VOCAB_ARRAYS}
+    columns = _memmap(os.path.join(vocab_dir, COLUMNS_FILE), np.uint64, meta["n_columns"])
+    other = load_other_vocabulary(vocab_dir, meta["ksize"], meta["n_samples"])
+    return Vocabulary(columns=columns, ksize=meta["ksize"], n_samples=meta["n_samples"], other=other, **arrays)
+
+
+def column_indices(columns, kmers):
+    """
+    positions of `kmers` in the sorted `columns` array, and a mask of which kmers are columns at all
+    """
+    pos = np.searchsorted(columns, kmers)
+    found = pos < len(columns)
+    found[found] = columns[pos[found]] == kmers[found]
+    return pos, found
+
+
+def other_column_ranks(columns, other_columns, ksize):
+    """
+    for each of the sorted other_columns (kmers that aren't 2-bit), how many of the sorted 2-bit
+    columns come before it alphabetically. a 2-bit kmer sorts before a string whose first base
+    that isn't ACGT is at position i exactly when its 2-bit value is below that of the first i
+    bases followed by the number of ACGT bases smaller than that character, so it's a searchsorted
+    """
+    keys = []
+    for kmer in other_columns.tolist():
+        i = next((i for i, c in enumerate(kmer) if c not in b"ACGT"), len(kmer))
+        prefix = kmer_hashing.strings_to_kmers([kmer[:i].decode("ascii")], i)[0] if i else 0
+        n_smaller = sum(base < kmer[i] for base in b"ACGT") if i < len(kmer) else 0
+        keys.append(int(prefix) * 4 ** (ksize - i) + n_smaller * 4 ** max(ksize - i - 1, 0))
+    ranks = np.full(len(keys), len(columns), dtype=np.int64)
+    fits = np.array([key < 2**64 for key in keys], dtype=bool)
+    ranks[fits] = np.searchsorted(columns, np.array([key for key in keys if key < 2**64], dtype=np.uint64))
+    return ranks
+
+
+class ColumnMap:
+    """
+    the feature matrix columns of a Vocabulary: its 2-bit columns and the columns of its other
+    vocabulary (the sorted S<ksize> kmers that aren't 2-bit), merged in alphabetical order (the
+    same order as the in-memory aggregate_adapted_sourmash_results.py)
+    """
+
+    def __init__(self, columns, other_columns, ksize):
+        self.columns = columns
+        self.other_columns = other_columns
+        self.ksize = ksize
+        self.ranks = other_column_ranks(self.columns, self.other_columns, self.ksize)
+        # the matrix column of each other column
+        self.other_positions = self.ranks + np.arange(len(self.ranks))
+        self.n_columns = len(self.columns) + len(self.other_columns)
+
+    def positions(self, cols):
+        """the matrix columns of 2-bit columns `cols`"""
+        return cols + np.searchsorted(self.ranks, cols, side="right")
+
+    def kmer_columns(self, kmers, other_kmers):
+        """the matrix columns of 2-bit kmers and S<ksize> other kmers, which all have to be columns"""
+        cols, _ = column_indices(self.columns, kmers)
+        other_cols, _ = column_indices(self.other_columns, other_kmers)
+        return np.concatenate([self.positions(cols), self.other_positions[other_cols]])
+
+    def row(self, arrays):
+        """(matrix columns, counts) of a sketch_io.KmerArray, sorted by column"""
+        cols, found = column_indices(self.columns, arrays.kmers)
+        other_cols, other_found = column_indices(self.other_columns, arrays.other_kmers)
+        cols = np.concatenate([self.positions(cols[found]), self.other_positions[other_cols[other_found]]])
+        counts = np.concatenate([arrays.counts[found], arrays.other_counts[other_found]]).astype(np.uint64)
+        order = np.argsort(cols, kind="stable")
+        return cols[order], counts[order]
+
+    def iter_column_bytes(self, chunk_size=2**20):
+        """the column kmers in matrix column order, as S<ksize> arrays"""
+        n = len(self.columns)
+        for start in range(0, max(n, 1), chunk_size):
+            end = min(start + chunk_size, n)
+            chunk = kmer_hashing.kmers_to_bytes(np.asarray(self.columns[start:end]), self.ksize)
+            # the other columns that go before 2-bit columns start..end-1 (or after all of them)
+            lo, hi = np.searchsorted(self.ranks, [start, end if end < n else n + 1])
+            yield np.insert(chunk, self.ranks[lo:hi] - start, self.other_columns[lo:hi])
+
+    def column_bytes(self):
+        chunks = list(self.iter_column_bytes())
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype="S1")
+
+
+def budget_bytes(memory_budget_mb):
+    return int(memory_budget_mb * 2**20)
+
+
+def _records(kmers, counts, row, dtype):
+    records = np.empty(len(kmers), dtype=dtype)
+    records["kmer"] = kmers
+    records["row"] = row
+    records["count"] = counts
+    return records
+
+
+def sketch_records(path, row):
+    """the (kmer, row, count) records of one sketch file, the records of its kmers that aren't 2-bit, and its ksize"""
+    arrays = sketch_io.load_kmer_array(path)
+    return (_records(arrays.kmers, arrays.counts, row, RECORD_DTYPE),
+            _records(arrays.other_kmers, arrays.other_counts, row, other_record_dtype(arrays.ksize)), arrays.ksize)
+
+
+def count_records(records):
+    """
+    (kmers, df, first_row, first_count) of a set of records, kmers sorted. the records have to be
+    in row order for first_row to be the earliest row a kmer is in.
+    """
+    kmers, first, df = np.unique(records["kmer"], return_index=True, return_counts=True)
+    return kmers, df.astype(np.uint32), records["row"][first], records["count"][first]
+
+
+def partition_path(directory, p):
+    return os.path.join(directory, f"{p:03d}.rec")
+
+
+class _PartitionWriter:
+    """
+    buffers records by partition (the PARTITION_BITS bits of the kmer starting at bit `shift`) and
+    appends them to one file per partition whenever the buffer reaches max_buffered_bytes. within a
+    partition the records stay in the order they were added.
+    """
+
+    def __init__(self, directory, shift, max_buffered_bytes):
+        self.directory = directory
+        self.shift = shift
+        self.max_buffered_bytes = max_buffered_bytes
+        self.buffer = []
+        self.n_buffered = 0
+        self.sizes = np.zeros(2**PARTITION_BITS, dtype=np.int64)
+
+    def path(self, p):
+        return partition_path(self.directory, p)
+
+    def add(self, records):
+        self.buffer.append(records)
+        self.n_buffered += records.shape[0]
+        if self.n_buffered * RECORD_DTYPE.itemsize >= self.max_buffered_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        records = np.concatenate(self.buffer)
+        self.buffer = []
+        self.n_buffered = 0
+        parts = ((records["kmer"] >> np.uint64(self.shift)) & np.uint64(2**PARTITION_BITS - 1)).astype(np.int64)
+        order = np.argsort(parts, kind="stable")
+        records = records[order]
+        bounds = np.searchsorted(parts[order], np.arange(2**PARTITION_BITS + 1))
+        for p in np.flatnonzero(np.diff(bounds)):
+            with open(self.path(p), "ab") as f:
+                f.write(records[bounds[p] : bounds[p + 1]].tobytes())
+            self.sizes[p] += bounds[p + 1] - bounds[p]
+
+
+def partition_sketches(sketch_paths, out_dir, max_buffered_bytes, first_row=0):
+    """
+    splits the records of sketch_paths (rows first_row, first_row + 1, ...) into one file per
+    partition of their first PARTITION_BITS // 2 bases in out_dir, so that each partition is a
+    consecutive range of kmers. returns (ksize, shift, sizes, other records), ksize None if every
+    sketch is empty. the records of the kmers that aren't 2-bit are kept in memory (in row order).
+    """
+    ksize = None
+    writer = None
+    other = []
+    for row, path in enumerate(sketch_paths, start=first_row):
+        records, other_records, file_ksize = sketch_records(path, row)
+        if len(records) == 0 and len(other_records) == 0:
+            continue
+        if ksize is None:
+            ksize = file_ksize
+            writer = _PartitionWriter(out_dir, max(2 * ksize - PARTITION_BITS, 0), max_buffered_bytes)
+        elif file_ksize != ksize:
+            raise ValueError(f"{path} has ksize {file_ksize}, the other sketches have {ksize}")
+        writer.add(records)
+        if len(other_records):
+            other.append(other_records)
+    other = np.concatenate(other) if other else np.zeros(0, dtype=other_record_dtype(ksize or 0))
+    if writer is None:
+        return None, 0, np.zeros(2**PARTITION_BITS, dtype=np.int64), other
+    writer.flush()
+    return ksize, writer.shift, writer.sizes, other
+
+
+def read_partition(directories, p):
+    """the records of partition p from several partition_sketches directories, in that order"""
+    paths = [partition_path(d, p) for d in directories if os.path.exists(partition_path(d, p))]
+    if not paths:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate([np.fromfile(path, dtype=RECORD_DTYPE) for path in paths])
+
+
+class _VocabularyWriter:
+    """writes sorted chunks of (kmers, df, first_row, first_count) to the files of a vocabulary directory"""
+
+    def __init__(self, vocab_dir, suffix=""):
+        self.paths = [os.path.join(vocab_dir, fname + suffix) for _, fname, _ in VOCAB_ARRAYS]
+        self.paths.append(os.path.join(vocab_dir, COLUMNS_FILE + suffix))
+        self.files = [open(path, "wb") for path in self.paths]
+        self.n_kmers = 0
+        self.n_columns = 0
+
+    def write(self, kmers, df, first_row, first_count):
+        for f, values, (_, _, dtype) in zip(self.files, (kmers, df, first_row, first_count), VOCAB_ARRAYS):
+            f.write(np.asarray(values, dtype=dtype).tobytes())
+        columns = kmers[df >= MIN_COLUMN_DF]
+        self.files[-1].write(columns.tobytes())
+        self.n_kmers += len(kmers)
+        self.n_columns += len(columns)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def _count_partition(path, n, shift, max_bytes, tmp_dir, vocab_writer):
+    """
+    counts the records in one partition file and writes the kmers to the vocabulary in sorted order.
+    a partition that doesn't fit in max_bytes is split by the next PARTITION_BITS bits and done in pieces.
+    """
+    # np.unique needs a few copies of the array
+    if n * RECORD_DTYPE.itemsize * 4 > max_bytes and shift > 0:
+        sub_shift = max(shift - PARTITION_BITS, 0)
+        sub_dir = tempfile.mkdtemp(dir=tmp_dir)
+        writer = _PartitionWriter(sub_dir, sub_shift, max_bytes // 4)
+        chunk = max(max_bytes // (4 * RECORD_DTYPE.itemsize), 1)
+        data = np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(n,))
+        for start in range(0, n, chunk):
+            writer.add(np.array(data[start : start + chunk]))
+        writer.flush()
+        del data
+        os.remove(path)
+        for p in np.flatnonzero(writer.sizes):
+            _count_partition(writer.path(p), int(writer.sizes[p]), sub_shift, max_bytes, sub_dir, vocab_writer)
+        os.rmdir(sub_dir)
+        return
+    vocab_writer.write(*count_records(np.fromfile(path, dtype=RECORD_DTYPE)))
+    os.remove(path)
+
+
+def build_vocabulary(sketch_paths, vocab_dir, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, tmp_dir=None):
+    """
+    Builds the vocabulary of a list of sketch files (either format, ksize <= 32) in vocab_dir,
+    reading one sketch at a time and keeping roughly at most memory_budget_mb of kmers in memory.
+    Row i is sketch_paths[i]. Returns the Vocabulary.
+    """
+    os.makedirs(vocab_dir, exist_ok=True)
+    max_bytes = budget_bytes(memory_budget_mb)
+    with tempfile.TemporaryDirectory(dir=vocab_dir if tmp_dir is None else tmp_dir) as work_dir:
+        ksize, shift, sizes, other_records = partition_sketches(sketch_paths, work_dir, max_bytes // 2)
+        vocab_writer = _VocabularyWriter(vocab_dir)
+        try:
+            for p in np.flatnonzero(sizes):
+                _count_partition(partition_path(work_dir, p), int(sizes[p]), shift, max_bytes, work_dir, vocab_writer)
+        finally:
+            vocab_writer.close()
+    write_other_vocabulary(vocab_dir, *count_records(other_records))
+    write_meta(vocab_dir, ksize or 0, vocab_writer.n_kmers, vocab_writer.n_columns, len(sketch_paths))
+    return load_vocabulary(vocab_dir)
+
+
+def append_to_vocabulary(vocab_dir, sketch_paths, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Adds sketch_paths to an existing vocabulary as rows n_samples, n_samples + 1, ...
+    The new sketches are counted in memory (they're meant to be a batch, not a cohort), and the
+    vocabulary files are rewritten with them merged in, in chunks that fit the memory budget.
+    Returns (Vocabulary, ColumnChanges, ColumnChanges of the kmers that aren't 2-bit). Document
+    frequencies only go up, so an append only ever adds columns.
+    """
+    old = load_vocabulary(vocab_dir)
+    ksize = old.ksize or None
+    new_records = []
+    new_other_records = []
+    for i, path in enumerate(sketch_paths):
+        records, other_records, file_ksize = sketch_records(path, old.n_samples + i)
+        if len(records) == 0 and len(other_records) == 0:
+            continue
+        if ksize is None:
+            ksize = file_ksize
+        elif file_ksize != ksize:
+            raise ValueError(f"{path} has ksize {file_ksize}, the vocabulary has {ksize}")
+        new_records.append(records)
+        new_other_records.append(other_records)
+    new_records = np.concatenate(new_records) if new_records else np.zeros(0, dtype=RECORD_DTYPE)
+    new_kmers, new_df, new_first_row, new_first_count = count_records(new_records)
+    del new_records
+
+    pos, exists, changes = _append_changes(old, new_kmers, new_df)
+    other_counts = count_records(np.concatenate(new_other_records) if new_other_records
+                                 else np.zeros(0, dtype=other_record_dtype(ksize or 0)))
+    other_pos, other_exists, other_changes = _append_changes(old.other, other_counts[0], other_counts[1])
+
+    # merge in one pass: kmers already there get their df bumped, the rest are inserted in order
+    update_pos, update_df = pos[exists], new_df[exists]
+    insert_pos = pos[~exists]
+    inserts = [new_kmers[~exists], new_df[~exists], new_first_row[~exists], new_first_count[~exists]]
+    chunk = max(budget_bytes(memory_budget_mb) // (4 * 20), 1)  # 20 bytes per kmer across the arrays
+    vocab_writer = _VocabularyWriter(vocab_dir, suffix=".tmp")
+    try:
+        for start in range(0, len(old.kmers) + 1, chunk):
+            end = min(start + chunk, len(old.kmers))
+            arrays = [np.array(getattr(old, field)[start:end]) for field, _, _ in VOCAB_ARRAYS]
+            u0, u1 = np.searchsorted(update_pos, [start, end])
+            arrays[1][update_pos[u0:u1] - start] += update_df[u0:u1]
+            # kmers that sort after everything already there go in with the last chunk
+            i0, i1 = np.searchsorted(insert_pos, [start, end if end < len(old.kmers) else end + 1])
+            arrays = [np.insert(a, insert_pos[i0:i1] - start, values[i0:i1]) for a, values in zip(arrays, inserts)]
+            vocab_writer.write(*arrays)
+            if end == len(old.kmers):
+                break
+    finally:
+        vocab_writer.close()
+    # the other vocabulary is small, merged in memory
+    other_df = old.other.df.copy()
+    other_df[other_pos[other_exists]] += other_counts[1][other_exists]
+    other_kmers = old.other.kmers.astype(other_record_dtype(ksize or 0)["kmer"])  # S1 if it was empty
+    other_arrays = [other_kmers, other_df, old.other.first_row, old.other.first_count]
+    other_arrays = [np.insert(a, other_pos[~other_exists], values[~other_exists])
+                    for a, values in zip(other_arrays, other_counts)]
+    n_samples = old.n_samples + len(sketch_paths)
+    del old
+    for path in vocab_writer.paths:
+        os.replace(path, path[: -len(".tmp")])
+    write_other_vocabulary(vocab_dir, *other_arrays)
+    write_meta(vocab_dir, ksize or 0, vocab_writer.n_kmers, vocab_writer.n_columns, n_samples)
+    return load_vocabulary(vocab_dir), changes, other_changes
+
+
+def _append_changes(old, new_kmers, new_df):
+    """where the (sorted) new kmers are in vocabulary `old`, whether they're there, and the ColumnChanges"""
+    pos = np.searchsorted(old.kmers, new_kmers)
+    exists = pos < len(old.kmers)
+    exists[exists] = old.kmers[pos[exists]] == new_kmers[exists]
+    old_df = np.zeros(len(new_kmers), dtype=np.uint32)
+    old_df[exists] = old.df[pos[exists]]
+
+    # new columns: existing singletons seen again, and new kmers in at least two of the new sketches
+    promoted = (old_df < MIN_COLUMN_DF) & (old_df + new_df >= MIN_COLUMN_DF)
+    old_row = np.full(len(new_kmers), -1, dtype=np.int64)
+    old_count = np.zeros(len(new_kmers), dtype=np.int64)
+    singleton = exists & (old_df == 1)
+    old_row[singleton] = old.first_row[pos[singleton]]
+    old_count[singleton] = old.first_count[pos[singleton]]
+    return pos, exists, ColumnChanges(new_kmers[promoted], old_row[promoted], old_count[promoted])
@@ -1,46 +1,153 @@
-import pandas as pd
+import os
+import argparse
 
-eval_data_kmers = "path_to_diabimmune_column_kmers.txt"
-training_data_kmers = "path_to_training_data_column_kmers.txt"
-eval_data_fm = "path_to_diabimmune_feature_matrix.csv"
+import numpy as np
+import scipy.sparse
 
-# get the diabimmune kmers
-with open(eval_data_kmers, 'r') as f:
-    column_names = [line.strip() for line in f]
+import column_index
+import feature_matrix_io
+import sketch_io
 
-# read in the diabimmune feature matrix
-df = pd.read_csv(eval_data_fm, header=None)
-df.columns = column_names
+"""
+Makes the feature matrix of evaluation data with the training columns: the kmers in the
+training column_kmers.txt, in that order. Evaluation kmers that weren't training columns are
+dropped and training kmers the evaluation data doesn't have are zero.
 
-# print(df.head())
+Each evaluation sketch is mapped straight into the training columns: the training kmers are
+loaded as a column_index.py index (the .kidx next to column_kmers.txt if it's up to date with
+it, or the text file), and every sketch's kmers are looked up in that with a binary search (of
+the 2-bit kmers, or of the kmers as strings if they are longer than 32 bases), so nothing wider
+than the training columns is ever built and only the nonzero counts are kept in memory. By
+default an evaluation kmer that is in only one of the evaluation sketches counts as zero, the
+same as making the evaluation feature matrix with aggregate_adapted_sourmash_results.py first
+(which drops singletons) and then aligning it; --keep_singletons keeps them.
 
-# get the training kmers
-with open(training_data_kmers, 'r') as f:
-    training_kmers = [line.strip() for line in f]
+An evaluation feature matrix that was already made (csv + its column_kmers.txt) can be
+aligned too, one row at a time.
 
-df_adjusted = df.copy()
-df_adjusted_colset = set(df_adjusted.columns)
-training_kmers_set = set(training_kmers)
+The output format goes by the extension of -o (.csv, .npz or .fm, see feature_matrix_io.py).
+With sketches as input the row names are also written to <output>_row_fnames.txt.
 
-# add missing columns to the diabimmune feature matrix 
-# (kmers that are present in training_kmers but not in df)
-# so that the feature matrix maintains the same order as in training
-missing_cols = [kmer for kmer in training_kmers_set if kmer not in df_adjusted_colset]
-if missing_cols:
-    zeros_df = pd.DataFrame(0, index=df_adjusted.index, columns=missing_cols)
-    df_adjusted = pd.concat([df_adjusted, zeros_df], axis=1)
+Usage:
+python prep_eval_feature_matrix.py /path/to/training_column_kmers.txt(or .kidx) /path/to/eval/sketches [more sketches/dirs ...] -o eval_feature_matrix.csv
+python prep_eval_feature_matrix.py /path/to/training_column_kmers.txt --eval_csv eval_feature_matrix.csv --eval_kmers eval_column_kmers.txt -o eval_feature_matrix_aligned.csv
+"""
 
-df_adjusted_colset = set(df_adjusted.columns)
+def read_column_kmers(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
 
-# drop extra columns 
-# (kmers that are present in df but not in training_kmers)
-# because the model did not learn anything about these so they'll be
-# meaningless and also mess up the kmer order
-extra_cols = [col for col in df_adjusted_colset if col not in training_kmers_set]
-df_adjusted.drop(columns=extra_cols, inplace=True)
 
-# reorder the columns to match training_kmers
-df_adjusted = df_adjusted[training_kmers]
+def column_kmer_names(index):
+    """the column kmers as the fixed width strings the binary matrix formats store"""
+    if len(index) == 0:
+        return []
+    return index.column_bytes()
 
 
-df_adjusted.to_csv('diabimmune_feature_matrix_output_path.csv', index=False, header=False) #TODO: replace path
\ No newline at end of file
+def project_sketches(index, sketch_paths):
+    """csr matrix of the sketches (rows) in the training columns"""
+    indptr = [0]
+    indices = []
+    data = []
+    for path in sketch_paths:
+        if index.two_bit:
+            # kmers that aren't plain ACGT can't be 2-bit columns, so the other kmers are left out
+            kmers, counts, ksize, _, _ = sketch_io.load_kmer_array(path)
+        else:
+            # columns that can't be 2-bit encoded are looked up as strings
+            kmer_counts = sketch_io.load_kmer_counts(path)
+            kmers = list(kmer_counts)
+            counts = np.fromiter(kmer_counts.values(), dtype=np.uint64, count=len(kmers))
+            ksize = len(kmers[0]) if kmers else 0
+        if len(kmers) and ksize != index.ksize:
+            raise ValueError(f"{path} has ksize {ksize}, the training columns have {index.ksize}")
+        cols = index.lookup(kmers)
+        found = cols >= 0
+        cols = cols[found]
+        order = np.argsort(cols)
+        indices.append(cols[order])
+        data.append(counts[found][order].astype(feature_matrix_io.COUNT_DTYPE))
+        indptr.append(indptr[-1] + len(cols))
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    data = np.concatenate(data) if data else np.zeros(0, dtype=feature_matrix_io.COUNT_DTYPE)
+    return scipy.sparse.csr_matrix((data, indices, np.array(indptr, dtype=np.int64)),
+                                   shape=(len(sketch_paths), len(index)))
+
+
+def drop_singletons(matrix):
+    """
+    zeroes the columns only one row has. within the training columns that's the same as dropping
+    the evaluation kmers that are only in one sketch before aligning
+    """
+    nonzero_per_column = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    matrix.data[nonzero_per_column[matrix.indices] == 1] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def align_eval_csv(index, eval_csv, eval_kmers, out_path):
+    """aligns an evaluation feature matrix csv (columns eval_kmers) to the training columns, one row at a time"""
+    train_col = index.lookup(eval_kmers)
+    with open(eval_csv) as f:
+        n_rows = sum(1 for _ in f)
+    writer = feature_matrix_io.FeatureMatrixWriter(out_path, n_rows, len(index))
+    with open(eval_csv) as f:
+        for line in f:
+            row = np.array(line.rstrip().split(","), dtype=np.int64) if eval_kmers else np.zeros(0, dtype=np.int64)
+            if len(row) != len(eval_kmers):
+                raise ValueError(f"{eval_csv} row {writer.row} has {len(row)} columns, expected {len(eval_kmers)}")
+            nonzero = np.flatnonzero((row != 0) & (train_col >= 0))
+            order = np.argsort(train_col[nonzero])
+            writer.write_row(train_col[nonzero][order], row[nonzero][order])
+    # the row names of the evaluation matrix, if its row_fnames.txt is next to it
+    eval_row_fnames = os.path.join(os.path.dirname(eval_csv), "row_fnames.txt")
+    row_names = read_column_kmers(eval_row_fnames) if os.path.exists(eval_row_fnames) else []
+    writer.close(row_names if len(row_names) == n_rows else [str(i) for i in range(n_rows)], column_kmer_names(index))
+
+
+def row_fnames_path(out_path):
+    return os.path.splitext(out_path)[0] + "_row_fnames.txt"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="make the feature matrix of evaluation data with the training columns")
+    parser.add_argument("training_kmers", type=str,
+                        help="column_kmers.txt of the training feature matrix, or its column_index.py .kidx")
+    parser.add_argument("eval_sketches", nargs="*", help="evaluation sketch files, or directories of them")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="output feature matrix (.csv, .npz or .fm)")
+    parser.add_argument("--keep_singletons", action="store_true",
+                        help="keep the counts of kmers that are only in one of the evaluation sketches")
+    parser.add_argument("--eval_csv", type=str, default=None,
+                        help="align an evaluation feature matrix csv instead of going from the sketches")
+    parser.add_argument("--eval_kmers", type=str, default=None, help="column_kmers.txt of --eval_csv")
+    args = parser.parse_args()
+    if (args.eval_csv is None) == (not args.eval_sketches):
+        parser.error("give either evaluation sketches or --eval_csv")
+    if args.eval_csv is not None and args.eval_kmers is None:
+        parser.error("--eval_csv needs --eval_kmers")
+    return args
+
+
+def main():
+    args = parse_args()
+    index = column_index.load_column_index(column_index.find_column_index(args.training_kmers))
+    if args.eval_csv is not None:
+        align_eval_csv(index, args.eval_csv, read_column_kmers(args.eval_kmers), args.output)
+        print(f"finished aligning {args.eval_csv} to {len(index)} training columns: {args.output}")
+        return
+    paths = sketch_io.expand_sketch_paths(args.eval_sketches)
+    matrix = project_sketches(index, paths)
+    if not args.keep_singletons:
+        matrix = drop_singletons(matrix)
+    row_names = [os.path.basename(p) for p in paths]
+    feature_matrix_io.write_feature_matrix(matrix, args.output, row_names, column_kmer_names(index))
+    with open(row_fnames_path(args.output), 'w') as f:
+        for fname in row_names:
+            f.write(fname + "\n")
+    print(f"finished {len(paths)} evaluation samples in {len(index)} training columns: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
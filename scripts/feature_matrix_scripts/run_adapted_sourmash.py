@@ -1,33 +1,152 @@
 import os
-import subprocess
+import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import adapted_sourmash
 
 """
 Usage:
-python /path/to/run_adapted_sourmash.py /path/to/fasta/files/directory ksize scaled
+python /path/to/run_adapted_sourmash.py /path/to/fasta/files/directory ksize scaled [--workers N] [--mode batch] [--format npz]
+python /path/to/run_adapted_sourmash.py /path/to/fasta/files/directory 21,31 1000,2000 -o /path/to/out   (writes out/k21_s1000/, out/k21_s2000/, ...)
 """
 
-# runs kmer counting on a whole directory
-def run_adapted_sourmash(ksize, scaled, file_path, output_file_path):
-    command = ["python", "adapted_sourmash.py", str(ksize), str(scaled), file_path, output_file_path] # you need to put the two files in the same directory
-    subprocess.run(command, check=True)
+FASTA_EXTENSIONS = (".fa", ".fasta", ".fna", ".fa.gz", ".fasta.gz", ".fna.gz")
+
+
+def sample_name(filename):
+    """file name without the fasta (and .gz) extension"""
+    for ext in sorted(FASTA_EXTENSIONS, key=len, reverse=True):
+        if filename.endswith(ext):
+            return filename[: -len(ext)]
+    return os.path.splitext(filename)[0]
+
+
+def list_fasta_files(input_dir):
+    return sorted(f for f in os.listdir(input_dir) if f.endswith(FASTA_EXTENSIONS))
+
+
+def check_sample_names(filenames):
+    """raises ValueError if two files would write the same sketch (x.fa and x.fna.gz, say)"""
+    by_name = {}
+    for filename in filenames:
+        by_name.setdefault(sample_name(filename), []).append(filename)
+    clashes = [", ".join(names) for names in by_name.values() if len(names) > 1]
+    if clashes:
+        raise ValueError("these files have the same sample name, so their sketches would overwrite each other: "
+                         + "; ".join(clashes))
+
+
+# sketches one file (runs in a worker process). errors are returned rather than
+# raised so that one bad file doesn't take down the whole batch.
+# with several ksizes/scaleds, output_file_path is {(ksize, scaled): path} and the
+# file is read once for all of them.
+def sketch_one(file_path, output_file_path, ksize, scaled, mode):
+    start = time.time()
+    try:
+        if isinstance(output_file_path, dict):
+            sketches = adapted_sourmash.sketch_file_multi(file_path, ksize, scaled, mode)
+            for (k, s), keep in sketches.items():
+                adapted_sourmash.write_sketch(keep, output_file_path[(k, s)], k, s)
+        else:
+            keep = adapted_sourmash.sketch_file(file_path, ksize, scaled, mode)
+            adapted_sourmash.write_sketch(keep, output_file_path, ksize, scaled)
+    except Exception as e:
+        return file_path, output_file_path, time.time() - start, f"{type(e).__name__}: {e}"
+    return file_path, output_file_path, time.time() - start, None
+
+
+# where the sketches for one (ksize, scaled) go when several are made at once
+def combination_dir(output_dir, ksize, scaled):
+    return os.path.join(output_dir, f"k{ksize}_s{scaled}")
+
+
+# runs kmer counting on a whole directory, `workers` files at a time.
+# ksize and scaled can be lists, in which case every file is read once and the
+# sketches for each combination go in their own subdirectory of output_dir.
+def run_adapted_sourmash(input_dir, ksize, scaled, output_dir=None, workers=None, mode="batch", out_format="txt"):
+    output_dir = input_dir if output_dir is None else output_dir
+    workers = os.cpu_count() if workers is None else workers
+    filenames = list_fasta_files(input_dir)
+    check_sample_names(filenames)
+    combinations = None
+    if isinstance(ksize, (list, tuple)) or isinstance(scaled, (list, tuple)):
+        ksize = sorted(set(ksize)) if isinstance(ksize, (list, tuple)) else [ksize]
+        scaled = sorted(set(scaled)) if isinstance(scaled, (list, tuple)) else [scaled]
+        combinations = [(k, s) for k in ksize for s in scaled]
+        if mode not in adapted_sourmash.MULTI_SKETCH_MODES:
+            raise ValueError(f"--mode {mode} can't make several sketches in one pass")
+        for k, s in combinations:
+            os.makedirs(combination_dir(output_dir, k, s), exist_ok=True)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+
+    jobs = []
+    for filename in filenames:
+        fpath = os.path.join(input_dir, filename)
+        out_name = f"{sample_name(filename)}.{out_format}"
+        if combinations is None:
+            out_fpath = os.path.join(output_dir, out_name)
+        else:
+            out_fpath = {(k, s): os.path.join(combination_dir(output_dir, k, s), out_name) for k, s in combinations}
+        jobs.append((fpath, out_fpath))
+    total_bytes = sum(os.path.getsize(fpath) for fpath, _ in jobs)
+    print(f"sketching {len(jobs)} files with {workers} workers (ksize={ksize}, scaled={scaled}, mode={mode})")
+
+    failed = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(sketch_one, fpath, out_fpath, ksize, scaled, mode): fpath for fpath, out_fpath in jobs}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            try:
+                fpath, out_fpath, seconds, error = future.result()
+            except BrokenProcessPool as e:
+                # a worker process died (killed for running out of memory, say), which fails every
+                # file that hadn't finished yet
+                fpath, out_fpath, seconds, error = futures[future], None, 0.0, f"{type(e).__name__}: {e}"
+            if error is None:
+                print(f"[{n_done}/{len(jobs)}] finished signature for: {fpath if combinations else out_fpath} ({seconds:.1f}s)")
+            else:
+                failed.append((fpath, error))
+                print(f"[{n_done}/{len(jobs)}] FAILED: {fpath} -- {error}")
+    elapsed = time.time() - start
+
+    n_ok = len(jobs) - len(failed)
+    print(f"finished {n_ok} of {len(jobs)} files in {elapsed:.1f}s "
+          f"({len(jobs) / max(elapsed, 1e-9):.2f} files/s, {total_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s of input)")
+    if failed:
+        print(f"{len(failed)} files failed:")
+        for fpath, error in failed:
+            print(f"  {fpath}: {error}")
+    return failed
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="run adapted_sourmash on all fasta files in a directory.")
-    parser.add_argument("input_dir", type=str, help="directory containing the .fasta files.")
-    parser.add_argument("ksize", type=int, help="kmer length (an int)")
-    parser.add_argument("scaled", type=int, help="sampling rate")
+    parser.add_argument("input_dir", type=str, help="directory containing the fasta files (.fa/.fasta/.fna, optionally .gz).")
+    parser.add_argument("ksize", type=adapted_sourmash.int_list,
+                        help="kmer length (an int), or a comma separated list to make several sketches in one pass")
+    parser.add_argument("scaled", type=adapted_sourmash.int_list,
+                        help="sampling rate, or a comma separated list")
+    parser.add_argument("-o", "--output_dir", type=str, default=None,
+                        help="where to write the kmer counts (default: input_dir)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument("--mode", type=str, choices=sorted(adapted_sourmash.SKETCH_MODES), default="batch",
+                        help="sketching mode passed to adapted_sourmash (default: batch). all modes give the same output.")
+    parser.add_argument("--format", dest="out_format", type=str, choices=["txt", "npz"], default="txt",
+                        help="'txt' for the text kmer counts, 'npz' for the binary format in sketch_io.py")
     return parser.parse_args()
 
 def main():
     args = parse_args()
-    for filename in os.listdir(args.input_dir):
-        if filename.endswith(".fa"):
-            fpath = os.path.join(args.input_dir, filename)
-            out_fpath = os.path.join(args.input_dir, f"{os.path.splitext(filename)[0]}.txt")
-
-            run_adapted_sourmash(args.ksize, args.scaled, fpath, out_fpath)
-            print(f"finished signature for: {out_fpath}")
+    ksize = args.ksize[0] if len(args.ksize) == 1 else args.ksize
+    scaled = args.scaled[0] if len(args.scaled) == 1 else args.scaled
+    failed = run_adapted_sourmash(args.input_dir, ksize, scaled, args.output_dir, args.workers, args.mode,
+                                  args.out_format)
+    if failed:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,193 @@
+import os
+import json
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse
+
+import column_index
+import feature_matrix_io
+import kmer_hashing
+
+"""
+Picks which columns of a feature matrix go into training, so the first layer of the autoencoder
+only sees the columns that carry information.
+
+The per-column statistics are computed in one pass over the matrix (a chunk of rows at a time,
+with numpy/scipy on the whole chunk): the number of samples with a nonzero value, the total
+count, and the mean and variance. By default the mean/variance are of the rows normalized by
+their max, which is what the model is trained on (--raw_counts uses the counts). Then the filters
+are applied in this order:
+    --min_samples N         in at least N samples (2 is what the singleton filter already does)
+    --max_prevalence F      in at most a fraction F of the samples (drops kmers almost every sample has)
+    --min_total_count N     total count over all samples at least N
+    --top_n N               keep the N columns with the highest --rank_by: variance, or
+                            dispersion (variance / mean)
+
+The output directory looks like the output of aggregate_adapted_sourmash_results.py, for the
+selected columns only, so everything downstream works on it unchanged:
+    column_kmers.txt (+ column_kmers.kidx)  the selected kmers, in the original column order
+    selected_columns.txt                    their column in the input matrix
+    row_fnames.txt                          the rows (unchanged)
+    feature_matrix_not_normalized.<format>  the matrix with only the selected columns
+    feature_selection.json                  the settings and how many columns each filter kept
+
+Evaluation data can then be put in the selected columns with
+prep_eval_feature_matrix.py <out dir>/column_kmers.txt ...
+
+Usage:
+python select_features.py /path/to/feature_matrix_not_normalized.npz -o /path/to/out/dir [--min_samples 5] [--max_prevalence 0.95] [--min_total_count 10] [--top_n 50000 [--rank_by dispersion]]
+"""
+
+RANK_BY = ("variance", "dispersion")
+DEFAULT_CHUNK_ROWS = 1024
+
+ColumnStats = namedtuple("ColumnStats", ["n_rows", "n_samples", "total", "mean", "variance"])
+ColumnStats.__doc__ = "per column: samples with a nonzero value, total count, mean and variance (over n_rows rows)"
+
+
+def iter_chunks(matrix, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """(start, rows) of a FeatureMatrix.matrix, sparse matrices stay sparse"""
+    for start in range(0, matrix.shape[0], chunk_rows):
+        chunk = matrix[start : start + chunk_rows]
+        yield start, (chunk.tocsr() if scipy.sparse.issparse(chunk) else np.asarray(chunk))
+
+
+def _row_normalized(chunk):
+    """rows divided by their max (rows that are all zero stay zero)"""
+    if scipy.sparse.issparse(chunk):
+        row_max = chunk.max(axis=1).toarray().ravel().astype(np.float64)
+        row_max[row_max == 0] = 1
+        return scipy.sparse.diags(1 / row_max) @ chunk.astype(np.float64)
+    row_max = chunk.max(axis=1, initial=0).astype(np.float64)
+    row_max[row_max == 0] = 1
+    return chunk / row_max[:, None]
+
+
+def column_stats(matrix, raw_counts=False, chunk_rows=DEFAULT_CHUNK_ROWS):
+    n_rows, n_columns = matrix.shape
+    n_samples = np.zeros(n_columns, dtype=np.int64)
+    total = np.zeros(n_columns, dtype=np.float64)
+    values_sum = np.zeros(n_columns, dtype=np.float64)
+    values_sum_sq = np.zeros(n_columns, dtype=np.float64)
+    for _, chunk in iter_chunks(matrix, chunk_rows):
+        values = chunk if raw_counts else _row_normalized(chunk)
+        if scipy.sparse.issparse(chunk):
+            n_samples += np.bincount(chunk.indices[chunk.data != 0], minlength=n_columns)
+            total += np.asarray(chunk.sum(axis=0), dtype=np.float64).ravel()
+            values_sum += np.asarray(values.sum(axis=0), dtype=np.float64).ravel()
+            values_sum_sq += np.asarray(values.multiply(values).sum(axis=0), dtype=np.float64).ravel()
+        else:
+            n_samples += np.count_nonzero(chunk, axis=0)
+            total += chunk.sum(axis=0, dtype=np.float64)
+            values = np.asarray(values, dtype=np.float64)
+            values_sum += values.sum(axis=0)
+            values_sum_sq += np.square(values).sum(axis=0)
+    n = max(n_rows, 1)
+    mean = values_sum / n
+    # one division at the end, so on counts (exact sums) equal variances come out exactly equal
+    variance = np.maximum(n * values_sum_sq - values_sum**2, 0) / n**2
+    return ColumnStats(n_rows, n_samples, total, mean, variance)
+
+
+def select_columns(stats, min_samples=1, max_prevalence=1.0, min_total_count=0, top_n=None, rank_by="variance"):
+    """
+    the columns that pass the filters (sorted), and {filter: columns left after it}
+    """
+    keep = np.ones(len(stats.n_samples), dtype=bool)
+    kept_after = {"input": int(keep.sum())}
+    keep &= stats.n_samples >= min_samples
+    kept_after["min_samples"] = int(keep.sum())
+    keep &= stats.n_samples <= max_prevalence * stats.n_rows
+    kept_after["max_prevalence"] = int(keep.sum())
+    keep &= stats.total >= min_total_count
+    kept_after["min_total_count"] = int(keep.sum())
+    selected = np.flatnonzero(keep)
+    if top_n is not None and len(selected) > top_n:
+        if rank_by == "variance":
+            score = stats.variance[selected]
+        elif rank_by == "dispersion":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                score = np.where(stats.mean[selected] > 0, stats.variance[selected] / stats.mean[selected], 0)
+        else:
+            raise ValueError(f"rank_by must be one of {', '.join(RANK_BY)}")
+        # highest score first, ties broken by column so the selection doesn't depend on the sort
+        best = np.lexsort((selected, -score))[:top_n]
+        selected = np.sort(selected[best])
+    kept_after["top_n"] = len(selected)
+    return selected, kept_after
+
+
+def write_selected_matrix(matrix, selected, out_path, row_names, column_kmers, chunk_rows=DEFAULT_CHUNK_ROWS):
+    writer = feature_matrix_io.FeatureMatrixWriter(out_path, matrix.shape[0], len(selected))
+    for _, chunk in iter_chunks(matrix, chunk_rows):
+        writer.write_rows(scipy.sparse.csr_matrix(chunk[:, selected]))
+    writer.close(row_names, column_kmers)
+
+
+def write_selection(fm, selected, out_dir, out_format="npz", settings=None, kept_after=None,
+                    chunk_rows=DEFAULT_CHUNK_ROWS):
+    os.makedirs(out_dir, exist_ok=True)
+    kmers = [fm.column_kmers[j] for j in selected]
+    column_kmers_path = os.path.join(out_dir, "column_kmers.txt")
+    with open(column_kmers_path, 'w') as f:
+        for kmer in kmers:
+            f.write(kmer + "\n")
+    # and the .kidx next to it, if the kmers fit in 2-bit form
+    ksize = len(kmers[0]) if kmers else 0
+    try:
+        if ksize <= kmer_hashing.MAX_KSIZE:
+            index = column_index.index_from_kmers(kmer_hashing.strings_to_kmers(kmers, ksize), ksize)
+            column_index.write_column_index(index, column_index.index_path(column_kmers_path), column_kmers_path)
+    except ValueError:
+        pass
+    with open(os.path.join(out_dir, "selected_columns.txt"), 'w') as f:
+        for j in selected.tolist():
+            f.write(f"{j}\n")
+    with open(os.path.join(out_dir, "row_fnames.txt"), 'w') as f:
+        for fname in fm.row_names:
+            f.write(fname + "\n")
+    write_selected_matrix(fm.matrix, selected, feature_matrix_io.matrix_path(out_dir, out_format), fm.row_names,
+                          kmers, chunk_rows)
+    with open(os.path.join(out_dir, "feature_selection.json"), 'w') as f:
+        json.dump({"settings": settings or {}, "columns_kept_after": kept_after or {}}, f, indent=1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="pick the feature matrix columns to train on")
+    parser.add_argument("matrix", type=str, help="feature matrix (.npz, .fm, or .csv with its row_fnames.txt/column_kmers.txt)")
+    parser.add_argument("-o", "--out_dir", type=str, required=True, help="where to write the selection")
+    parser.add_argument("--min_samples", type=int, default=1, help="keep columns nonzero in at least this many samples")
+    parser.add_argument("--max_prevalence", type=float, default=1.0,
+                        help="keep columns nonzero in at most this fraction of the samples (default 1: no limit)")
+    parser.add_argument("--min_total_count", type=float, default=0, help="keep columns with at least this total count")
+    parser.add_argument("--top_n", type=int, default=None, help="then keep the N columns with the highest --rank_by")
+    parser.add_argument("--rank_by", type=str, choices=RANK_BY, default="variance",
+                        help="variance, or dispersion (variance / mean), for --top_n")
+    parser.add_argument("--raw_counts", action="store_true",
+                        help="compute the mean/variance on the counts instead of the rows normalized by their max")
+    parser.add_argument("--format", dest="out_format", type=str, choices=sorted(feature_matrix_io.FORMATS),
+                        default="npz", help="format of the selected feature matrix (default npz)")
+    parser.add_argument("--chunk_rows", type=int, default=DEFAULT_CHUNK_ROWS, help="rows processed at a time")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    fm = feature_matrix_io.load_feature_matrix(args.matrix)
+    if fm.row_names is None or fm.column_kmers is None:
+        raise SystemExit(f"{args.matrix} needs row_fnames.txt and column_kmers.txt next to it")
+    stats = column_stats(fm.matrix, args.raw_counts, args.chunk_rows)
+    selected, kept_after = select_columns(stats, args.min_samples, args.max_prevalence, args.min_total_count,
+                                          args.top_n, args.rank_by)
+    settings = {name: getattr(args, name) for name in
+                ["matrix", "min_samples", "max_prevalence", "min_total_count", "top_n", "rank_by", "raw_counts"]}
+    write_selection(fm, selected, args.out_dir, args.out_format, settings, kept_after, args.chunk_rows)
+    for name, n in kept_after.items():
+        print(f"{name}: {n} columns")
+    print(f"selected {len(selected)} of {fm.matrix.shape[1]} columns: {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+import os
+import time
+import zipfile
+import argparse
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import kmer_hashing
+
+"""
+Reading and writing kmer sketches.
+
+There are two sketch file formats:
+    legacy (.txt):  what adapted_sourmash.py writes by default, one "<kmer> <count>" line per
+                    kmer, in the order they were first seen.
+    binary (.npz):  compressed numpy .npz with the sketch sorted by hash:
+                        kmers       uint64 2-bit canonical kmers (A=0 C=1 G=2 T=3), sorted by hash
+                        counts      uint32, same order
+                        ksize, scaled, seed, format_version   (scalars)
+                    the hashes are a function of the kmers, so they aren't stored; they are
+                    recomputed with kmer_hashing.murmurhash3_x64_64 when the file is loaded
+                    (a few ms for 100k kmers). kmers that can't be 2-bit encoded (ksize > 32,
+                    or a kmer that isn't plain ACGT, e.g. has an N) are stored as fixed width
+                    ascii strings next to that:
+                        other_kmers     S<ksize>, sorted by hash
+                        other_counts    uint32
+                        other_hashes    uint64
+                    (format version 2; files without other kmers are still written as version 1).
+                    either way this is several times smaller than the text file and loads
+                    without any string parsing. (files from before other_kmers existed may have
+                    a sorted uint64 'hashes' array instead of any kmers; they still load.)
+
+Everything downstream should go through load_sketch(), which takes either format and returns
+a Sketch. A directory can hold both formats of a sample (`convert` without --out_dir writes
+<sample>.npz next to <sample>.txt); list_sketch_files() then only lists the .npz, so no sample is
+read twice. It goes by what's in the files (is_sketch_file), not their names, so the other
+outputs written into a sketch directory are never read as samples. Legacy files don't record scaled/seed, so those come back as whatever is passed in
+(or None). The hashes of a legacy file are recomputed from the kmers (seed 42, same as
+adapted_sourmash.py).
+
+FracMinHash sketches nest: the sketch for a bigger scaled is exactly the kmers of the smaller
+scaled sketch with hash < 2**64/scaled, so a directory of sketches can be downsampled to a
+coarser scaled without going back to the fasta files (`downsample`). Legacy text files are
+hashed again for this, and keep their order.
+
+Usage (convert legacy text sketches to binary):
+python sketch_io.py convert /path/to/sketch/dir_or_files ... --scaled 1000 [--out_dir /path/to/out]
+Usage (downsample sketches to a bigger scaled):
+python sketch_io.py downsample /path/to/sketch/dir_or_files ... --scaled 5000 --out_dir /path/to/out [--workers N] [--format npz]
+"""
+
+FORMAT_VERSION = 2
+DEFAULT_SEED = 42
+
+TEXT_EXTENSION = ".txt"
+BINARY_EXTENSION = ".npz"
+SKETCH_EXTENSIONS = (TEXT_EXTENSION, BINARY_EXTENSION)
+
+Sketch = namedtuple("Sketch", ["hashes", "counts", "kmers", "ksize", "scaled", "seed"])
+Sketch.__doc__ = """
+A kmer sketch sorted by hash. `kmers` is the 2-bit canonical kmer of each hash, or None if
+the sketch doesn't have them. `scaled` and `seed` can be None for legacy files.
+"""
+
+KmerArray = namedtuple("KmerArray", ["kmers", "counts", "ksize", "other_kmers", "other_counts"])
+KmerArray.__doc__ = """
+The kmers of a sketch without the hashes (see load_kmer_array): `kmers` 2-bit encoded (uint64)
+with their `counts`, and the kmers that can't be 2-bit encoded (not plain ACGT, e.g. with an N)
+as fixed width ascii strings (S<ksize>) in `other_kmers`, with `other_counts`.
+"""
+
+
+def is_sketch_file(file_path):
+    """
+    whether a file is a sketch, by what's in it rather than its name, so the other .txt/.npz files
+    the scripts write next to the sketches (row_fnames.txt, column_kmers.txt, the feature matrix,
+    ...) aren't read as samples: a .npz has to store a ksize and counts, and the first line of a
+    .txt has to be "<kmer> <count>" (an empty .txt is an empty sketch). a .npz that can't be opened
+    is kept, so reading it fails instead of the sample going missing.
+    """
+    if not os.path.isfile(file_path):
+        return False
+    if file_path.endswith(BINARY_EXTENSION):
+        try:
+            with np.load(file_path) as npz:
+                return "ksize" in npz.files and "counts" in npz.files
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return True
+    if not file_path.endswith(TEXT_EXTENSION):
+        return False
+    with open(file_path, "r") as f:
+        parts = f.readline(1024).split()
+    return not parts or (len(parts) == 2 and parts[0].isalpha() and parts[1].isdigit())
+
+
+def list_sketch_files(directory):
+    """
+    sorted list of the sketch files (either format) in a directory. a .txt with a .npz of the same
+    sample next to it (what `convert` leaves behind) is skipped, so each sample is listed once
+    """
+    fnames = [f for f in os.listdir(directory)
+              if f.endswith(SKETCH_EXTENSIONS) and is_sketch_file(os.path.join(directory, f))]
+    binary = {sample_name(f) for f in fnames if f.endswith(BINARY_EXTENSION)}
+    return sorted(f for f in fnames if f.endswith(BINARY_EXTENSION) or sample_name(f) not in binary)
+
+
+def sample_name(fname):
+    """sketch file name without the extension"""
+    for ext in SKETCH_EXTENSIONS:
+        if fname.endswith(ext):
+            return fname[: -len(ext)]
+    return fname
+
+
+def kmer_strings(sketch):
+    """the kmers of a sketch as python strings (same order as the hashes)"""
+    if sketch.kmers is None:
+        raise ValueError("this sketch doesn't store its kmers")
+    if sketch.kmers.dtype.kind == "S":
+        return [kmer.decode("ascii") for kmer in sketch.kmers.tolist()]
+    return kmer_hashing.kmers_to_strings(sketch.kmers, sketch.ksize)
+
+
+def hash_kmer_strings(kmer_list, ksize=None, seed=DEFAULT_SEED):
+    """
+    Hashes a list of (already canonical) kmer strings, the same way adapted_sourmash.hash_kmer
+    does. Returns (hashes, kmers), where kmers is the 2-bit encoding of the list, or the kmers
+    as a fixed width ascii (S<ksize>) array if they can't all be encoded (ksize > 32 or a kmer
+    that isn't plain ACGT; those lists are hashed one at a time with mmh3).
+    """
+    if ksize is None:
+        ksize = len(kmer_list[0]) if kmer_list else 0
+    kmers = None
+    if ksize <= kmer_hashing.MAX_KSIZE:
+        try:
+            kmers = kmer_hashing.strings_to_kmers(kmer_list, ksize)
+        except ValueError:
+            pass
+    if kmers is not None:
+        return kmer_hashing.murmurhash3_x64_64(kmers, ksize, seed), kmers
+    import mmh3
+    hashes = np.array([mmh3.hash64(k, seed)[0] % 2**64 for k in kmer_list], dtype=np.uint64)
+    return hashes, np.array([k.encode("ascii") for k in kmer_list], dtype=f"S{max(ksize, 1)}")
+
+
+def sketch_from_kmer_counts(kmer_counts, scaled=None, seed=DEFAULT_SEED, ksize=None):
+    """
+    Builds a Sketch from a {canonical_kmer: count} dict (what adapted_sourmash.sketch_file returns,
+    or what a legacy text file holds). The kmers are hashed again here.
+    """
+    kmer_list = list(kmer_counts.keys())
+    counts = np.fromiter(kmer_counts.values(), dtype=np.uint64, count=len(kmer_list))
+    if ksize is None:
+        ksize = len(kmer_list[0]) if kmer_list else 0
+    hashes, kmers = hash_kmer_strings(kmer_list, ksize, seed)
+    return make_sketch(hashes, counts, ksize, scaled, seed, kmers)
+
+
+def make_sketch(hashes, counts, ksize, scaled, seed=DEFAULT_SEED, kmers=None):
+    """puts parallel hash/count(/kmer) arrays into a Sketch, sorted by hash"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    counts = np.asarray(counts)
+    if counts.size and counts.max() > np.iinfo(np.uint32).max:
+        raise ValueError("counts don't fit in uint32")
+    counts = counts[order].astype(np.uint32)
+    if kmers is not None:
+        kmers = np.asarray(kmers)
+        kmers = (kmers if kmers.dtype.kind == "S" else kmers.astype(np.uint64))[order]
+    return Sketch(hashes[order], counts, kmers, ksize, scaled, seed)
+
+
+def _split_other_kmers(sketch):
+    """(2-bit kmers, mask of them) and the rest of a sketch whose kmers are strings"""
+    if sketch.ksize > kmer_hashing.MAX_KSIZE:
+        return np.zeros(0, dtype=np.uint64), np.zeros(len(sketch.kmers), dtype=bool)
+    codes = kmer_hashing.BASE_CODES[sketch.kmers.view(np.uint8).reshape(len(sketch.kmers), sketch.kmers.dtype.itemsize)]
+    encodable = ~np.any(codes == kmer_hashing.INVALID_CODE, axis=1)
+    kmers = kmer_hashing.strings_to_kmers([k.decode("ascii") for k in sketch.kmers[encodable].tolist()], sketch.ksize)
+    return kmers, encodable
+
+
+def write_sketch_binary(sketch, output_file_path):
+    arrays = {
+        "counts": sketch.counts,
+        "ksize": np.int64(sketch.ksize),
+        "scaled": np.int64(-1 if sketch.scaled is None else sketch.scaled),
+        "seed": np.int64(sketch.seed),
+        "format_version": np.int64(1),
+    }
+    if sketch.kmers is None:
+        arrays["hashes"] = sketch.hashes
+    elif sketch.kmers.dtype.kind != "S":
+        arrays["kmers"] = sketch.kmers
+    else:
+        # the kmers that can be 2-bit encoded as usual, the others as strings next to them
+        kmers, encodable = _split_other_kmers(sketch)
+        other = ~encodable
+        arrays["counts"] = sketch.counts[encodable]
+        arrays["kmers"] = kmers
+        arrays["other_kmers"] = sketch.kmers[other]
+        arrays["other_counts"] = sketch.counts[other]
+        arrays["other_hashes"] = sketch.hashes[other]
+        arrays["format_version"] = np.int64(FORMAT_VERSION)
+    # np.savez adds .npz to the name if it isn't there, so write through a file handle instead
+    with open(output_file_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_sketch_binary(file_path):
+    with np.load(file_path) as npz:
+        if int(npz["format_version"]) > FORMAT_VERSION:
+            raise ValueError(f"{file_path} was written by a newer version of sketch_io.py")
+        ksize = int(npz["ksize"])
+        scaled = int(npz["scaled"])
+        seed = int(npz["seed"])
+        counts = npz["counts"]
+        if "other_kmers" in npz.files:
+            kmers = npz["kmers"]
+            hashes = kmer_hashing.murmurhash3_x64_64(kmers, ksize, seed)
+            # all the kmers as strings, merged back into hash order
+            return make_sketch(np.concatenate([hashes, npz["other_hashes"]]),
+                               np.concatenate([counts, npz["other_counts"]]), ksize,
+                               None if scaled < 0 else scaled, seed,
+                               np.concatenate([kmer_hashing.kmers_to_bytes(kmers, ksize), npz["other_kmers"]]))
+        if "kmers" in npz.files:
+            kmers = npz["kmers"]
+            hashes = kmer_hashing.murmurhash3_x64_64(kmers, ksize, seed)
+        else:
+            kmers = None
+            hashes = npz["hashes"]
+    return Sketch(hashes, counts, kmers, ksize, None if scaled < 0 else scaled, seed)
+
+
+def read_kmer_counts_text(file_path):
+    """legacy text sketch -> {kmer: count}, in file order"""
+    kmer_counts = {}
+    with open(file_path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                kmer_counts[parts[0]] = int(parts[1])
+    return kmer_counts
+
+
+def write_kmer_counts_text(kmer_counts, output_file_path):
+    """{kmer: count} -> legacy text sketch"""
+    with open(output_file_path, "w") as output_file:
+        for key, value in kmer_counts.items():
+            output_file.write(f"{key} {value}\n")
+
+
+def load_sketch_text(file_path, scaled=None, seed=DEFAULT_SEED):
+    return sketch_from_kmer_counts(read_kmer_counts_text(file_path), scaled, seed)
+
+
+def load_sketch(file_path, scaled=None, seed=DEFAULT_SEED):
+    """
+    Loads a sketch in either format. `scaled` and `seed` are only used for legacy text files,
+    which don't record them.
+    """
+    if file_path.endswith(BINARY_EXTENSION):
+        return load_sketch_binary(file_path)
+    return load_sketch_text(file_path, scaled, seed)
+
+
+def load_kmer_counts(file_path):
+    """
+    Loads a sketch in either format as a {kmer: count} dict, for code that works on kmer strings.
+    (legacy files come back in file order, binary ones in hash order)
+    """
+    if file_path.endswith(BINARY_EXTENSION):
+        sketch = load_sketch_binary(file_path)
+        return dict(zip(kmer_strings(sketch), sketch.counts.tolist()))
+    return read_kmer_counts_text(file_path)
+
+
+def load_kmer_array(file_path):
+    """
+    Loads a sketch in either format as a KmerArray, with the kmers 2-bit encoded (uint64) and
+    without hashing anything. Kmers that aren't plain ACGT (e.g. have an N) can't be 2-bit
+    encoded and come back separately as strings (other_kmers); it's up to the caller what to do
+    with them. Raises ValueError if ksize > 32.
+    """
+    if file_path.endswith(BINARY_EXTENSION):
+        with np.load(file_path) as npz:
+            ksize = int(npz["ksize"])
+            if ksize > kmer_hashing.MAX_KSIZE:
+                raise ValueError(f"{file_path}: ksize {ksize} is too big for 2-bit kmers")
+            if "kmers" not in npz.files:
+                raise ValueError(f"{file_path} doesn't store its kmers")
+            if "other_kmers" in npz.files:
+                return KmerArray(npz["kmers"], npz["counts"], ksize, npz["other_kmers"], npz["other_counts"])
+            return KmerArray(npz["kmers"], npz["counts"], ksize, np.zeros(0, dtype=f"S{max(ksize, 1)}"),
+                             np.zeros(0, dtype=np.uint32))
+    kmer_counts = read_kmer_counts_text(file_path)
+    kmer_list = list(kmer_counts)
+    ksize = len(kmer_list[0]) if kmer_list else 0
+    if ksize > kmer_hashing.MAX_KSIZE:
+        raise ValueError(f"{file_path}: ksize {ksize} is too big for 2-bit kmers")
+    other_list = []
+    try:
+        kmers = kmer_hashing.strings_to_kmers(kmer_list, ksize)
+    except ValueError:
+        other_list = [kmer for kmer in kmer_list if kmer.strip("ACGT")]
+        kmer_list = [kmer for kmer in kmer_list if not kmer.strip("ACGT")]
+        kmers = kmer_hashing.strings_to_kmers(kmer_list, ksize)
+    counts = np.fromiter((kmer_counts[kmer] for kmer in kmer_list), dtype=np.uint64, count=len(kmer_list))
+    other_kmers = np.array([kmer.encode("ascii") for kmer in other_list], dtype=f"S{max(ksize, 1)}")
+    other_counts = np.fromiter((kmer_counts[kmer] for kmer in other_list), dtype=np.uint64, count=len(other_list))
+    return KmerArray(kmers, counts, ksize, other_kmers, other_counts)
+
+
+def convert_text_to_binary(file_path, output_file_path, scaled, seed=DEFAULT_SEED):
+    sketch = load_sketch_text(file_path, scaled, seed)
+    write_sketch_binary(sketch, output_file_path)
+    return sketch
+
+
+def keep_below_hash(scaled):
+    """smallest hash that is *not* kept at this scaled (same cutoff as adapted_sourmash.py)"""
+    return kmer_hashing.keep_below_int(2**64 / scaled)
+
+
+def downsample_sketch(sketch, scaled):
+    """the sketch for a bigger scaled, from the hashes of this one"""
+    if sketch.scaled is not None and scaled < sketch.scaled:
+        raise ValueError(f"can't downsample a scaled={sketch.scaled} sketch to the smaller scaled={scaled}")
+    keep = kmer_hashing.below_threshold(sketch.hashes, keep_below_hash(scaled))
+    kmers = None if sketch.kmers is None else sketch.kmers[keep]
+    return Sketch(sketch.hashes[keep], sketch.counts[keep], kmers, sketch.ksize, scaled, sketch.seed)
+
+
+def downsample_kmer_counts(kmer_counts, keep_below, seed=DEFAULT_SEED):
+    """
+    Drops the kmers of a {kmer: count} dict with hash >= keep_below, keeping the order of
+    the rest (so a downsampled legacy file is the same as sketching the fasta again).
+    """
+    kmer_list = list(kmer_counts)
+    hashes, _ = hash_kmer_strings(kmer_list, seed=seed)
+    keep = kmer_hashing.below_threshold(hashes, kmer_hashing.keep_below_int(keep_below))
+    return {kmer: kmer_counts[kmer] for kmer in itertools.compress(kmer_list, keep.tolist())}
+
+
+# downsamples one sketch file (runs in a worker process). text -> text keeps the legacy
+# layout, anything else is written in the binary format. errors are returned rather than
+# raised so one bad file doesn't stop the rest.
+def downsample_file(file_path, output_file_path, scaled, from_scaled=None, seed=DEFAULT_SEED):
+    start = time.time()
+    try:
+        if from_scaled is not None and scaled < from_scaled:
+            raise ValueError(f"can't downsample a scaled={from_scaled} sketch to the smaller scaled={scaled}")
+        if not file_path.endswith(BINARY_EXTENSION) and output_file_path.endswith(TEXT_EXTENSION):
+            kmer_counts = downsample_kmer_counts(read_kmer_counts_text(file_path), 2**64 / scaled, seed)
+            write_kmer_counts_text(kmer_counts, output_file_path)
+        else:
+            sketch = load_sketch(file_path, from_scaled, seed)
+            write_sketch_binary(downsample_sketch(sketch, scaled), output_file_path)
+    except Exception as e:
+        return file_path, output_file_path, time.time() - start, f"{type(e).__name__}: {e}"
+    return file_path, output_file_path, time.time() - start, None
+
+
+def downsample_files(paths, out_dir, scaled, from_scaled=None, seed=DEFAULT_SEED, workers=None, out_format=None):
+    """
+    Downsamples sketch files into out_dir (same file names, or out_format's extension),
+    `workers` files at a time. Returns the [(path, error)] of the files that failed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    workers = os.cpu_count() if workers is None else workers
+    jobs = []
+    for p in paths:
+        fname = os.path.basename(p)
+        if out_format is not None:
+            fname = f"{sample_name(fname)}.{out_format}"
+        out_path = os.path.join(out_dir, fname)
+        if os.path.abspath(out_path) == os.path.abspath(p):
+            raise ValueError(f"downsampling {p} would overwrite it; use a different --out_dir")
+        jobs.append((p, out_path))
+
+    failed = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(downsample_file, p, out_path, scaled, from_scaled, seed) for p, out_path in jobs]
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            p, out_path, seconds, error = future.result()
+            if error is None:
+                print(f"[{n_done}/{len(jobs)}] {p} -> {out_path} ({seconds:.2f}s)")
+            else:
+                failed.append((p, error))
+                print(f"[{n_done}/{len(jobs)}] FAILED: {p} -- {error}")
+    print(f"downsampled {len(jobs) - len(failed)} of {len(jobs)} sketches to scaled={scaled} in {time.time() - start:.1f}s")
+    return failed
+
+
+def expand_sketch_paths(inputs, extensions=SKETCH_EXTENSIONS):
+    """files, or directories of sketch files -> list of sketch file paths"""
+    paths = []
+    for p in inputs:
+        if os.path.isdir(p):
+            paths += [os.path.join(p, f) for f in list_sketch_files(p) if f.endswith(extensions)]
+        else:
+            paths.append(p)
+    return paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="kmer sketch file utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="convert legacy .txt sketches to the binary .npz format")
+    convert.add_argument("inputs", nargs="+", help=".txt sketch files, or directories of them")
+    convert.add_argument("--scaled", type=int, required=True,
+                         help="scaled value the sketches were made with (text files don't record it)")
+    convert.add_argument("--seed", type=int, default=DEFAULT_SEED, help="hash seed (default 42)")
+    convert.add_argument("--out_dir", type=str, default=None,
+                         help="where to write the .npz files (default: next to each input)")
+
+    downsample = subparsers.add_parser("downsample", help="downsample sketches to a bigger scaled value")
+    downsample.add_argument("inputs", nargs="+", help="sketch files (.txt or .npz), or directories of them")
+    downsample.add_argument("--scaled", type=int, required=True, help="the new (bigger) scaled value")
+    downsample.add_argument("--out_dir", type=str, required=True, help="where to write the downsampled sketches")
+    downsample.add_argument("--from_scaled", type=int, default=None,
+                            help="scaled the text sketches were made with, to record it and check it "
+                                 "(.npz files record their own)")
+    downsample.add_argument("--seed", type=int, default=DEFAULT_SEED, help="hash seed of the text sketches (default 42)")
+    downsample.add_argument("-w", "--workers", type=int, default=None,
+                            help="number of worker processes (default: number of cores)")
+    downsample.add_argument("--format", dest="out_format", type=str, choices=["txt", "npz"], default=None,
+                            help="output format (default: the same as each input). .npz inputs can only be written as npz.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "convert":
+        paths = expand_sketch_paths(args.inputs, TEXT_EXTENSION)
+        if args.out_dir is not None:
+            os.makedirs(args.out_dir, exist_ok=True)
+        for p in paths:
+            out_dir = os.path.dirname(p) if args.out_dir is None else args.out_dir
+            out_path = os.path.join(out_dir, sample_name(os.path.basename(p)) + BINARY_EXTENSION)
+            convert_text_to_binary(p, out_path, args.scaled, args.seed)
+            print(f"{p} -> {out_path} ({os.path.getsize(p)} -> {os.path.getsize(out_path)} bytes)")
+    elif args.command == "downsample":
+        paths = expand_sketch_paths(args.inputs)
+        if args.out_format == "txt" and any(p.endswith(BINARY_EXTENSION) for p in paths):
+            raise SystemExit(".npz sketches can't be downsampled to text, leave out --format txt")
+        failed = downsample_files(paths, args.out_dir, args.scaled, args.from_scaled, args.seed, args.workers,
+                                  args.out_format)
+        if failed:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import io
+import os
+import gzip
+import time
+import queue
+import argparse
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import kmer_hashing
+import sketch_io
+
+"""
+Sketches raw (e.g. post-bbduk) paired reads directly, without assembling them first.
+
+The reads are streamed out of the _1/_2 fastq(.gz) files of a sample in batches, so memory
+depends on the number of distinct kept kmers rather than the size of the files. Each batch
+of reads is joined into one sequence (with a separator that no window can cross) and hashed
+with numpy, the same hashes as adapted_sourmash.py. Kmers are kept by hash < 2**64/scaled
+and counted; at the end any kmer seen fewer than --min_abundance times is dropped, which
+gets rid of most of the kmers that only exist because of sequencing errors.
+
+Differences from sketching an assembly:
+    - ksize <= 32 (numpy 2-bit path only)
+    - windows with anything other than A/C/G/T (e.g. N no-calls) are skipped rather than hashed
+    - counts are kmer abundances across the reads, and the sketch is written in hash order
+
+Decompression runs in --reader_threads background threads (one file per thread at a time;
+zlib releases the GIL, so with two threads both mates are decompressed in parallel with
+the hashing).
+
+Usage:
+python sketch_reads.py ksize scaled /path/to/SRRxxx_1.fastq.gz /path/to/SRRxxx_2.fastq.gz -o SRRxxx.txt [--min_abundance 2]
+python sketch_reads.py ksize scaled /path/to/reads/directory -o /path/to/output/dir [--workers N] [--format npz]
+"""
+
+FASTQ_EXTENSIONS = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+SEPARATOR = b"$"  # not A/C/G/T, so any window that spans two reads is skipped
+BATCH_BASES = 2**22
+MERGE_EVERY = 2**22
+
+
+def is_fastq(fname):
+    return fname.endswith(FASTQ_EXTENSIONS)
+
+
+def find_read_files(directory):
+    """
+    {accession: [read files]} for a directory of fastq files, grouping the _1/_2 mates the way
+    take_file_inventory in main.py does (accession = everything before the first '_').
+    """
+    samples = {}
+    for fname in sorted(os.listdir(directory)):
+        if is_fastq(fname):
+            accn = fname.split("_")[0]
+            if accn == fname:
+                accn = fname.split(".")[0]
+            samples.setdefault(accn, []).append(os.path.join(directory, fname))
+    return samples
+
+
+def open_fastq(file_path):
+    if file_path.endswith(".gz"):
+        # GzipFile.readline is slow; a BufferedReader on top of it iterates lines much faster
+        return io.BufferedReader(gzip.open(file_path, "rb"), buffer_size=2**20)
+    return open(file_path, "rb")
+
+
+def iter_read_batches(file_path, batch_bases=BATCH_BASES):
+    """
+    yields the reads of a (4 line) fastq file as joined batches of about batch_bases bases:
+    b"read1$read2$..."
+    """
+    with open_fastq(file_path) as f:
+        first = f.readline()
+        if not first:
+            return
+        if not first.startswith(b"@"):
+            raise ValueError(f"{file_path} doesn't look like a fastq file")
+        sequences = itertools.chain([f.readline()], itertools.islice(f, 3, None, 4))
+        batch = []
+        n_bases = 0
+        for line in sequences:
+            line = line.rstrip()
+            batch.append(line)
+            n_bases += len(line) + 1
+            if n_bases >= batch_bases:
+                yield SEPARATOR.join(batch)
+                batch = []
+                n_bases = 0
+        if batch:
+            yield SEPARATOR.join(batch)
+
+
+_DONE = object()
+
+def _put(batch_queue, item, stop):
+    """batch_queue.put that gives up (returns False) once stop is set, so a full queue can't block forever"""
+    while not stop.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read_files_into_queue(file_paths, batch_queue, batch_bases, stop):
+    try:
+        for file_path in file_paths:
+            batches = iter_read_batches(file_path, batch_bases)
+            try:
+                for batch in batches:
+                    if not _put(batch_queue, batch, stop):
+                        return
+            finally:
+                batches.close()  # closes the file now if we stopped halfway
+    except Exception as e:
+        _put(batch_queue, e, stop)
+    _put(batch_queue, _DONE, stop)
+
+
+def read_batches(file_paths, batch_bases=BATCH_BASES, reader_threads=1, max_queued=8):
+    """
+    batches from all of file_paths. with reader_threads > 0 the files are read and decompressed
+    in that many background threads (the files are split between them), with at most
+    max_queued batches waiting, so memory stays bounded if hashing is the slower side.
+    batches from different threads come out interleaved.
+    """
+    if reader_threads <= 0:
+        for file_path in file_paths:
+            yield from iter_read_batches(file_path, batch_bases)
+        return
+    n_threads = min(reader_threads, len(file_paths))
+    batch_queue = queue.Queue(maxsize=max_queued)
+    stop = threading.Event()
+    threads = [threading.Thread(target=_read_files_into_queue,
+                                args=(file_paths[i::n_threads], batch_queue, batch_bases, stop), daemon=True)
+               for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    n_running = n_threads
+    try:
+        while n_running:
+            item = batch_queue.get()
+            if item is _DONE:
+                n_running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # if a batch failed or the caller stopped early, the readers would otherwise wait on a
+        # full queue forever with their files open
+        stop.set()
+        while any(t.is_alive() for t in threads):
+            try:
+                batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for t in threads:
+            t.join()
+
+
+def _merge_counts(kmers, counts, new_kmers, new_counts):
+    all_kmers = np.concatenate([kmers, new_kmers])
+    all_counts = np.concatenate([counts, new_counts])
+    kmers, inverse = np.unique(all_kmers, return_inverse=True)
+    return kmers, np.bincount(inverse.ravel(), weights=all_counts, minlength=len(kmers)).astype(np.uint64)
+
+
+def sketch_reads(file_paths, ksize, scaled, min_abundance=2, reader_threads=1,
+                 batch_bases=BATCH_BASES, merge_every=MERGE_EVERY, seed=kmer_hashing.DEFAULT_SEED):
+    """
+    Sketches all the reads in file_paths together (e.g. the two mates of one sample).
+    Returns a sketch_io.Sketch of the kmers seen at least min_abundance times.
+    """
+    if ksize > kmer_hashing.MAX_KSIZE:
+        raise ValueError(f"read sketching needs ksize <= {kmer_hashing.MAX_KSIZE} (got {ksize})")
+    threshold = sketch_io.keep_below_hash(scaled)
+    kmers = np.zeros(0, dtype=np.uint64)
+    counts = np.zeros(0, dtype=np.uint64)
+    pending = []
+    n_pending = 0
+    for batch in read_batches(file_paths, batch_bases, reader_threads):
+        canonical, _, hashes, valid = kmer_hashing.hash_sequence(batch, ksize, seed)
+        pending.append(canonical[valid & kmer_hashing.below_threshold(hashes, threshold)])
+        n_pending += pending[-1].shape[0]
+        # fold the kept kmers into (kmers, counts) every so often so memory stays proportional
+        # to the number of distinct kmers
+        if n_pending >= merge_every:
+            new = np.concatenate(pending)
+            kmers, counts = _merge_counts(kmers, counts, new, np.ones(new.shape[0], dtype=np.uint64))
+            pending = []
+            n_pending = 0
+    if pending:
+        new = np.concatenate(pending)
+        kmers, counts = _merge_counts(kmers, counts, new, np.ones(new.shape[0], dtype=np.uint64))
+
+    abundant = counts >= min_abundance
+    kmers = kmers[abundant]
+    hashes = kmer_hashing.murmurhash3_x64_64(kmers, ksize, seed)
+    return sketch_io.make_sketch(hashes, counts[abundant], ksize, scaled, seed, kmers)
+
+
+def write_read_sketch(sketch, output_file_path):
+    if output_file_path.endswith(sketch_io.BINARY_EXTENSION):
+        sketch_io.write_sketch_binary(sketch, output_file_path)
+    else:
+        sketch_io.write_kmer_counts_text(dict(zip(sketch_io.kmer_strings(sketch), sketch.counts.tolist())),
+                                         output_file_path)
+
+
+# sketches one sample (runs in a worker process). errors are returned rather than raised
+# so that one bad sample doesn't take down the whole batch.
+def sketch_one_sample(file_paths, output_file_path, ksize, scaled, min_abundance, reader_threads):
+    start = time.time()
+    try:
+        sketch = sketch_reads(file_paths, ksize, scaled, min_abundance, reader_threads)
+        write_read_sketch(sketch, output_file_path)
+    except Exception as e:
+        return file_paths, output_file_path, time.time() - start, f"{type(e).__name__}: {e}"
+    return file_paths, output_file_path, time.time() - start, None
+
+
+def sketch_read_directory(input_dir, output_dir, ksize, scaled, min_abundance=2, reader_threads=1,
+                          workers=None, out_format="txt"):
+    os.makedirs(output_dir, exist_ok=True)
+    workers = os.cpu_count() if workers is None else workers
+    samples = find_read_files(input_dir)
+    total_bytes = sum(os.path.getsize(p) for paths in samples.values() for p in paths)
+    print(f"sketching {len(samples)} samples with {workers} workers "
+          f"(ksize={ksize}, scaled={scaled}, min_abundance={min_abundance})")
+
+    failed = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(sketch_one_sample, paths, os.path.join(output_dir, f"{accn}.{out_format}"),
+                                   ksize, scaled, min_abundance, reader_threads)
+                   for accn, paths in samples.items()]
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            paths, out_fpath, seconds, error = future.result()
+            if error is None:
+                print(f"[{n_done}/{len(samples)}] finished signature for: {out_fpath} ({seconds:.1f}s)")
+            else:
+                failed.append((paths, error))
+                print(f"[{n_done}/{len(samples)}] FAILED: {', '.join(paths)} -- {error}")
+    elapsed = time.time() - start
+    print(f"finished {len(samples) - len(failed)} of {len(samples)} samples in {elapsed:.1f}s "
+          f"({total_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s of compressed input)")
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="apply FracMinHashing to raw paired reads and retain the kmers")
+    parser.add_argument("ksize", type=int, help="kmer length (an int, <= 32)")
+    parser.add_argument("scaled", type=int, help="sampling rate")
+    parser.add_argument("inputs", nargs="+",
+                        help="the fastq(.gz) files of one sample (e.g. its _1 and _2 files), or a directory of them "
+                             "(one sketch per accession)")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="output sketch file (.txt or .npz), or output directory if the input is a directory")
+    parser.add_argument("-m", "--min_abundance", type=int, default=2,
+                        help="drop kmers seen fewer than this many times (default 2; 1 keeps everything)")
+    parser.add_argument("-t", "--reader_threads", type=int, default=2,
+                        help="threads reading/decompressing the fastq files (default 2, one per mate; "
+                             "0 reads in the main thread)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="samples sketched at once when the input is a directory (default: number of cores)")
+    parser.add_argument("--format", dest="out_format", type=str, choices=["txt", "npz"], default="txt",
+                        help="output format when the input is a directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if len(args.inputs) == 1 and os.path.isdir(args.inputs[0]):
+        failed = sketch_read_directory(args.inputs[0], args.output, args.ksize, args.scaled, args.min_abundance,
+                                       args.reader_threads, args.workers, args.out_format)
+        if failed:
+            raise SystemExit(1)
+        return
+    start = time.time()
+    sketch = sketch_reads(args.inputs, args.ksize, args.scaled, args.min_abundance, args.reader_threads)
+    write_read_sketch(sketch, args.output)
+    print(f"finished signature for: {args.output} ({len(sketch.hashes)} kmers, {time.time() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
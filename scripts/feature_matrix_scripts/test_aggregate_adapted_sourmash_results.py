@@ -0,0 +1,121 @@
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+import aggregate_adapted_sourmash_results as aggregate
+
+"""
+checks that --workers, --out_of_core and --append give the same outputs as the default
+in-memory aggregate_adapted_sourmash_results.py, on sketches that have kmers with an N in them
+(which can't be 2-bit encoded). prints "(should be True)" lines like ext/test_kmers.py.
+
+Usage:
+python test_aggregate_adapted_sourmash_results.py
+"""
+
+separate_tests = lambda : print('\n------------------------------------------------\n')
+
+OUTPUTS = ["row_fnames.txt", "column_kmers.txt"]
+
+
+def write_sketches(directory, n_samples, ksize, seed):
+    random.seed(seed)
+    pool = {"".join(random.choice("ACGTN" if i % 3 else "ACGT") for _ in range(ksize)) for i in range(150)}
+    pool = sorted(pool | {"N" * ksize, "A" * (ksize - 1) + "N", "T" * ksize})
+    for i in range(n_samples):
+        with open(os.path.join(directory, f"sample_{i:02d}.txt"), "w") as f:
+            for kmer in random.sample(pool, 40):
+                f.write(f"{kmer} {random.randint(1, 20)}\n")
+
+
+def read_matrix(path, out_format):
+    if out_format == "csv":
+        return np.loadtxt(path, delimiter=",", dtype=np.int64, ndmin=2)
+    with np.load(path) as npz:
+        return scipy.sparse.csr_matrix((npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"])).toarray()
+
+
+def read_outputs(directory, out_format):
+    outputs = {fname: open(os.path.join(directory, fname)).read() for fname in OUTPUTS}
+    outputs["matrix"] = read_matrix(os.path.join(directory, f"feature_matrix_not_normalized.{out_format}"), out_format)
+    if out_format != "csv":
+        with np.load(os.path.join(directory, f"feature_matrix_not_normalized.{out_format}")) as npz:
+            outputs["column_kmers"] = npz["column_kmers"]
+    return outputs
+
+
+def same_outputs(a, b):
+    return all(np.array_equal(a[key], b[key]) if isinstance(a[key], np.ndarray) else a[key] == b[key] for key in a)
+
+
+def run(base_dir, name, ksize, seed, out_format, build):
+    directory = os.path.join(base_dir, name)
+    os.makedirs(directory)
+    write_sketches(directory, 10, ksize, seed)
+    build(directory)
+    return read_outputs(directory, out_format)
+
+
+def append_in_two_steps(directory, out_format):
+    """
+    makes the matrix of the first 6 sketches, appends the other 4 in two --append runs and puts
+    the full matrix back together from the first matrix, the column_changes.tsv and the new rows
+    """
+    new_dir = directory + "_new"
+    os.makedirs(new_dir)
+    new_paths = []
+    for fname in sorted(os.listdir(directory))[-4:]:
+        shutil.move(os.path.join(directory, fname), os.path.join(new_dir, fname))
+        new_paths.append(os.path.join(new_dir, fname))
+    aggregate.make_feature_matrix_out_of_core(directory, out_format=out_format)
+    outputs = read_outputs(directory, out_format)
+    matrix, columns = outputs["matrix"], outputs["column_kmers.txt"].split()
+    for paths in [new_paths[:2], new_paths[2:]]:
+        append_dir = aggregate.append_to_feature_matrix(directory, paths, out_format=out_format)
+        with open(os.path.join(append_dir, "column_changes.tsv")) as f:
+            changes = [line.rstrip("\n").split("\t") for line in f.readlines()[1:]]
+        new_columns = sorted(set(columns) | {kmer for _, kmer, _, _, _ in changes})
+        grown = np.zeros((matrix.shape[0], len(new_columns)), dtype=np.int64)
+        grown[:, [new_columns.index(kmer) for kmer in columns]] = matrix
+        for column, kmer, row, _, count in changes:
+            assert new_columns[int(column)] == kmer
+            if int(row) >= 0:
+                grown[int(row), int(column)] = int(count)
+        new_rows = read_matrix(os.path.join(append_dir, f"new_rows.{out_format}"), out_format)
+        matrix, columns = np.vstack([grown, new_rows]), new_columns
+    outputs = {fname: open(os.path.join(directory, fname)).read() for fname in OUTPUTS}
+    outputs["matrix"] = matrix
+    return outputs
+
+
+def main():
+    with tempfile.TemporaryDirectory() as base_dir:
+        for ksize, seed in [(5, 1), (21, 2), (32, 3)]:
+            for out_format in ["csv", "npz"]:
+                name = f"k{ksize}_{out_format}"
+                default = run(base_dir, name, ksize, seed, out_format,
+                              lambda d: aggregate.make_feature_matrix(d, out_format=out_format))
+                has_n = any("N" in kmer for kmer in default["column_kmers.txt"].split())
+                workers = run(base_dir, name + "_workers", ksize, seed, out_format,
+                              lambda d: aggregate.make_feature_matrix_parallel(d, workers=2, out_format=out_format))
+                out_of_core = run(base_dir, name + "_out_of_core", ksize, seed, out_format,
+                                  lambda d: aggregate.make_feature_matrix_out_of_core(d, out_format=out_format))
+                separate_tests()
+                print(f"ksize {ksize}, {out_format}: columns with an N: {has_n}  (should be True)")
+                print(f"--workers 2 == default: {same_outputs(default, workers)}  (should be True)")
+                print(f"--out_of_core == default: {same_outputs(default, out_of_core)}  (should be True)")
+
+                directory = os.path.join(base_dir, name + "_append")
+                os.makedirs(directory)
+                write_sketches(directory, 10, ksize, seed)
+                appended = append_in_two_steps(directory, out_format)
+                default.pop("column_kmers", None)
+                print(f"--out_of_core + --append == default: {same_outputs(default, appended)}  (should be True)")
+
+
+if __name__ == "__main__":
+    main()